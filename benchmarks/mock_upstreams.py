@@ -0,0 +1,161 @@
+# mock_upstreams.py
+# Local stand-ins for the OpenAI chat-completions API and the PayPal REST API, used by run_benchmark.py.
+# Point the API at it with OPENAI_API_BASE=http://127.0.0.1:<port>/v1 and PAYPAL_API_BASE=http://127.0.0.1:<port>.
+#
+#   uvicorn mock_upstreams:app --port 9100
+#
+# Configuration
+# MOCK_OPENAI_LATENCY_SECONDS: fixed time before the first token
+# MOCK_OPENAI_TOKENS_PER_SECOND: generation speed, so longer answers take longer (0 = instantaneous)
+# MOCK_OPENAI_ERROR_RATE: share of completions answered with a 503, to exercise retries and the circuit breaker
+# MOCK_PAYPAL_LATENCY_SECONDS: latency of every PayPal call
+# MOCK_PAYPAL_CERT_FILE: PEM served as the webhook signing certificate (written by run_benchmark.py from its fake CA)
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+import asyncio
+import itertools
+import json
+import os
+import random
+import re
+import time
+
+MOCK_OPENAI_LATENCY_SECONDS = float(os.getenv("MOCK_OPENAI_LATENCY_SECONDS", "0.3"))
+MOCK_OPENAI_TOKENS_PER_SECOND = float(os.getenv("MOCK_OPENAI_TOKENS_PER_SECOND", "0"))
+MOCK_OPENAI_ERROR_RATE = float(os.getenv("MOCK_OPENAI_ERROR_RATE", "0"))
+MOCK_PAYPAL_LATENCY_SECONDS = float(os.getenv("MOCK_PAYPAL_LATENCY_SECONDS", "0.2"))
+MOCK_PAYPAL_CERT_FILE = os.getenv("MOCK_PAYPAL_CERT_FILE")
+
+app = FastAPI()
+
+_ids = itertools.count(1)
+
+# Keys of the JSON structure block of the product prompt, e.g. '    "nom_produit": "..."'
+PROMPT_FIELD_PATTERN = re.compile(r'^\s*"(\w+)":', re.MULTILINE)
+PROMPT_NUM_IDEAS_PATTERN = re.compile(r"Génère (\d+) idées")
+
+
+def approximate_tokens(text):
+    return max(1, len(text.encode("utf-8")) // 4)
+
+
+def product_ideas_answer(prompt, choice=0):
+    match = PROMPT_NUM_IDEAS_PATTERN.search(prompt)
+    num_ideas = int(match.group(1)) if match else 1
+    fields = PROMPT_FIELD_PATTERN.findall(prompt) or ["nom_produit"]
+    ideas = []
+    for index in range(choice * num_ideas, (choice + 1) * num_ideas):
+        idea = {}
+        for field in fields:
+            if field == "avantages_client":
+                idea[field] = [f"Bénéfice {n} du produit {index + 1}" for n in range(1, 4)]
+            else:
+                idea[field] = f"{field} du produit {index + 1} - " + "texte généré " * 8
+        ideas.append(idea)
+    return json.dumps(ideas, ensure_ascii=False)
+
+
+def store_setup_answer(prompt):
+    return "Contenu généré pour la boutique. " * 60
+
+
+def completion_answer(body, choice=0):
+    prompt = " ".join(message.get("content", "") for message in body.get("messages", []))
+    content = product_ideas_answer(prompt, choice) if "tableau JSON" in prompt else store_setup_answer(prompt)
+    max_tokens = body.get("max_tokens")
+    finish_reason = "stop"
+    if max_tokens and approximate_tokens(content) > max_tokens:
+        content = content[: max_tokens * 4]
+        finish_reason = "length"
+    return prompt, content, finish_reason
+
+
+def generation_seconds(content):
+    if MOCK_OPENAI_TOKENS_PER_SECOND <= 0:
+        return 0.0
+    return approximate_tokens(content) / MOCK_OPENAI_TOKENS_PER_SECOND
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    await asyncio.sleep(MOCK_OPENAI_LATENCY_SECONDS)
+    if random.random() < MOCK_OPENAI_ERROR_RATE:
+        return JSONResponse(status_code=503, content={"error": {"message": "The server is overloaded", "type": "server_error"}})
+
+    prompt, content, finish_reason = completion_answer(body)
+    completion_id = f"chatcmpl-mock-{next(_ids)}"
+    created = int(time.time())
+    model = body.get("model", "gpt-3.5-turbo")
+
+    if body.get("stream"):
+        async def events():
+            pieces = [content[i:i + 16] for i in range(0, len(content), 16)]
+            delay = generation_seconds(content) / max(len(pieces), 1)
+            for piece in pieces:
+                if delay:
+                    await asyncio.sleep(delay)
+                chunk = {"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                         "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]}
+                yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+            done = {"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                    "choices": [{"index": 0, "delta": {}, "finish_reason": finish_reason}]}
+            yield f"data: {json.dumps(done)}\n\n"
+            yield "data: [DONE]\n\n"
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    # Choices of the n parameter are generated side by side: the answer takes as long as one of them
+    answers = [(content, finish_reason)] + [completion_answer(body, choice)[1:] for choice in range(1, body.get("n") or 1)]
+    await asyncio.sleep(generation_seconds(content))
+    completion_tokens = sum(approximate_tokens(answer) for answer, _ in answers)
+    return {
+        "id": completion_id,
+        "object": "chat.completion",
+        "created": created,
+        "model": model,
+        "choices": [{"index": index, "message": {"role": "assistant", "content": answer}, "finish_reason": reason} for index, (answer, reason) in enumerate(answers)],
+        "usage": {
+            "prompt_tokens": approximate_tokens(prompt),
+            "completion_tokens": completion_tokens,
+            "total_tokens": approximate_tokens(prompt) + completion_tokens,
+        },
+    }
+
+
+@app.post("/v1/oauth2/token")
+async def paypal_oauth_token():
+    await asyncio.sleep(MOCK_PAYPAL_LATENCY_SECONDS)
+    return {"scope": "https://uri.paypal.com/services/subscriptions", "access_token": "A21-mock-token", "token_type": "Bearer", "app_id": "APP-MOCK", "expires_in": 32400}
+
+
+@app.post("/v1/billing/subscriptions")
+async def paypal_create_subscription(request: Request):
+    body = await request.json()
+    await asyncio.sleep(MOCK_PAYPAL_LATENCY_SECONDS)
+    subscription_id = f"I-MOCK{next(_ids):08d}"
+    return JSONResponse(status_code=201, content={
+        "id": subscription_id,
+        "plan_id": body.get("plan_id"),
+        "status": "APPROVAL_PENDING",
+        "create_time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "links": [
+            {"href": f"https://www.sandbox.paypal.com/webapps/billing/subscriptions?ba_token=BA-{subscription_id}", "rel": "approve", "method": "GET"},
+            {"href": f"https://api-m.sandbox.paypal.com/v1/billing/subscriptions/{subscription_id}", "rel": "self", "method": "GET"},
+        ],
+    })
+
+
+@app.get("/v1/billing/subscriptions/{subscription_id}")
+async def paypal_get_subscription(subscription_id: str):
+    await asyncio.sleep(MOCK_PAYPAL_LATENCY_SECONDS)
+    return {"id": subscription_id, "status": "ACTIVE"}
+
+
+@app.get("/v1/notifications/certs/{cert_id}")
+async def paypal_webhook_certificate(cert_id: str):
+    await asyncio.sleep(MOCK_PAYPAL_LATENCY_SECONDS)
+    if not MOCK_PAYPAL_CERT_FILE:
+        return JSONResponse(status_code=404, content={"name": "RESOURCE_NOT_FOUND"})
+    with open(MOCK_PAYPAL_CERT_FILE) as f:
+        return PlainTextResponse(f.read(), media_type="application/x-pem-file")
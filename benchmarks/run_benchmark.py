@@ -0,0 +1,338 @@
+# run_benchmark.py
+# Offline load test of dropia_api: starts the local OpenAI/PayPal stand-ins (mock_upstreams.py) and the API
+# with uvicorn on a throw-away SQLite database, drives /generate-product, /assist-store-setup, /subscribe
+# and /webhooks/paypal at a fixed concurrency, then prints throughput, p50/p95/p99 and error rates as JSON.
+#
+#   pip install -r requirements.txt -r benchmarks/requirements.txt
+#   python benchmarks/run_benchmark.py --requests 500 --concurrency 32 --output report.json
+#
+# The exit code is 1 when a scenario exceeds --max-error-rate, so the script can gate a deploy.
+#
+# Webhooks are signed like PayPal does, with a certificate issued by a throw-away local CA that the API is told
+# to trust (PAYPAL_WEBHOOK_CA_BUNDLE): the scenario measures the real signature check and certificate cache.
+
+import argparse
+import asyncio
+import base64
+import datetime
+import json
+import os
+import re
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+from collections import Counter
+
+import httpx
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+
+SCENARIOS = ("generate_product", "assist_store_setup", "subscribe", "paypal_webhook")
+BENCH_PLAN_ID = "P-BENCHMARK"
+BENCH_WEBHOOK_ID = "WH-BENCHMARK"
+BENCH_METRICS_TOKEN = "metrics-benchmark"
+PAYPAL_CERT_COMMON_NAME = "messageverificationcerts.paypal.com"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark hors ligne de l'API DropIA avec des services OpenAI et PayPal simulés.")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="Scénarios à exécuter, séparés par des virgules.")
+    parser.add_argument("--requests", type=int, default=200, help="Nombre de requêtes mesurées par scénario.")
+    parser.add_argument("--concurrency", type=int, default=16, help="Requêtes simultanées par scénario.")
+    parser.add_argument("--warmup", type=int, default=10, help="Requêtes non mesurées envoyées avant chaque scénario.")
+    parser.add_argument("--num-ideas", type=int, default=3, help="Idées demandées par /generate-product.")
+    parser.add_argument("--unique-prompts", type=int, default=0, help="Nombre de prompts distincts pour /generate-product (0 = tous différents, sans cache).")
+    parser.add_argument("--webhook-duplicate-ratio", type=float, default=0.1, help="Part des webhooks renvoyés avec un id déjà reçu.")
+    parser.add_argument("--unsigned-webhooks", action="store_true", help="Envoyer les webhooks sans signature (validation désactivée côté API).")
+    parser.add_argument("--openai-latency", type=float, default=0.3, help="Latence simulée avant le premier token OpenAI (s).")
+    parser.add_argument("--openai-tokens-per-second", type=float, default=0, help="Vitesse de génération simulée (0 = instantanée).")
+    parser.add_argument("--openai-error-rate", type=float, default=0, help="Part des complétions simulées en erreur 503.")
+    parser.add_argument("--paypal-latency", type=float, default=0.2, help="Latence simulée de l'API PayPal (s).")
+    parser.add_argument("--workers", type=int, default=1, help="Workers uvicorn de l'API.")
+    parser.add_argument("--max-error-rate", type=float, default=None, help="Code de sortie 1 si un scénario dépasse ce taux d'erreur.")
+    parser.add_argument("--output", default=None, help="Fichier JSON du rapport (sinon sortie standard).")
+    parser.add_argument("--app-log", default=None, help="Fichier recevant la sortie de l'API (sinon ignorée).")
+    return parser.parse_args()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_uvicorn(module_app, port, cwd, env, log, workers=1):
+    command = [sys.executable, "-m", "uvicorn", module_app, "--host", "127.0.0.1", "--port", str(port),
+               "--log-level", "warning", "--loop", "asyncio", "--workers", str(workers)]
+    return subprocess.Popen(command, cwd=cwd, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+
+def wait_until_ready(url, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Le processus servant {url} s'est arrêté (code {process.returncode}).")
+        try:
+            httpx.get(url, timeout=1)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    raise RuntimeError(f"{url} ne répond pas après {timeout}s.")
+
+
+def seed_database(database_path, env, args):
+    # Same schema as production, created by the API's own init_db()
+    subprocess.run([sys.executable, "-c", "import dropia_api; dropia_api.init_db()"], cwd=REPO_DIR, env=env,
+                   stdout=subprocess.DEVNULL, check=True)
+    total = args.requests + args.warmup
+    conn = sqlite3.connect(database_path)
+    conn.executemany(
+        "INSERT INTO users (api_key, role, subscription_status, plan, paypal_subscription_id) VALUES (?, 'user', 'active', ?, ?)",
+        [(f"bench-premium-{i}", "Premium", None) for i in range(total)]
+        + [(f"bench-subscribe-{i}", "Gratuit", None) for i in range(total)]
+        + [(f"bench-webhook-{i}", "Gratuit", f"I-BENCH{i:08d}") for i in range(total)]
+    )
+    conn.commit()
+    conn.close()
+
+
+def create_fake_paypal_certificates(workdir):
+    # Local CA + PayPal-like signing certificate; returns the signing key and the paths of both PEM files
+    now = datetime.datetime.now(datetime.timezone.utc)
+    validity = (now - datetime.timedelta(days=1), now + datetime.timedelta(days=30))
+
+    def certificate(subject_name, issuer_name, public_key, signing_key, is_ca):
+        return (x509.CertificateBuilder()
+                .subject_name(x509.Name([x509.NameAttribute(x509.NameOID.COMMON_NAME, subject_name)]))
+                .issuer_name(x509.Name([x509.NameAttribute(x509.NameOID.COMMON_NAME, issuer_name)]))
+                .public_key(public_key)
+                .serial_number(x509.random_serial_number())
+                .not_valid_before(validity[0])
+                .not_valid_after(validity[1])
+                .add_extension(x509.BasicConstraints(ca=is_ca, path_length=None), critical=True)
+                .sign(signing_key, hashes.SHA256()))
+
+    ca_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    ca_cert = certificate("DropIA Benchmark CA", "DropIA Benchmark CA", ca_key.public_key(), ca_key, True)
+    signing_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    signing_cert = certificate(PAYPAL_CERT_COMMON_NAME, "DropIA Benchmark CA", signing_key.public_key(), ca_key, False)
+
+    ca_path, cert_path = os.path.join(workdir, "ca.pem"), os.path.join(workdir, "paypal-cert.pem")
+    with open(ca_path, "wb") as f:
+        f.write(ca_cert.public_bytes(serialization.Encoding.PEM))
+    with open(cert_path, "wb") as f:
+        f.write(signing_cert.public_bytes(serialization.Encoding.PEM))
+    return signing_key, ca_path, cert_path
+
+
+def sign_paypal_webhook(signing_key, cert_url, transmission_id, body):
+    # Same headers and signed string as PayPal: <transmission_id>|<transmission_time>|<webhook_id>|<crc32 of the body>
+    transmission_time = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+    message = f"{transmission_id}|{transmission_time}|{BENCH_WEBHOOK_ID}|{zlib.crc32(body) & 0xFFFFFFFF}".encode("utf-8")
+    signature = signing_key.sign(message, padding.PKCS1v15(), hashes.SHA256())
+    return {
+        "paypal-transmission-id": transmission_id,
+        "paypal-transmission-time": transmission_time,
+        "paypal-transmission-sig": base64.b64encode(signature).decode("ascii"),
+        "paypal-cert-url": cert_url,
+        "paypal-auth-algo": "SHA256withRSA",
+    }
+
+
+def percentile(ordered, p):
+    if not ordered:
+        return None
+    rank = max(0, min(len(ordered) - 1, int(round(p / 100 * len(ordered))) - 1))
+    return ordered[rank]
+
+
+def summarize(latencies, statuses, elapsed):
+    ordered = sorted(latencies)
+    total = sum(statuses.values())
+    errors = sum(count for status, count in statuses.items() if not (isinstance(status, int) and status < 400))
+    to_ms = lambda value: None if value is None else round(value * 1000, 2)
+    return {
+        "requests": total,
+        "errors": errors,
+        "error_rate": round(errors / total, 4) if total else 0,
+        "status_codes": {str(status): count for status, count in sorted(statuses.items(), key=lambda item: str(item[0]))},
+        "duration_seconds": round(elapsed, 3),
+        "throughput_rps": round(total / elapsed, 2) if elapsed else None,
+        "latency_ms": {
+            "mean": to_ms(sum(ordered) / len(ordered)) if ordered else None,
+            "p50": to_ms(percentile(ordered, 50)),
+            "p95": to_ms(percentile(ordered, 95)),
+            "p99": to_ms(percentile(ordered, 99)),
+            "max": to_ms(ordered[-1]) if ordered else None,
+        },
+    }
+
+
+async def drive(client, build_request, indexes, concurrency):
+    latencies = []
+    statuses = Counter()
+    pending = iter(indexes)
+
+    async def worker():
+        for index in pending:
+            request = build_request(index)
+            started = time.perf_counter()
+            try:
+                response = await client.request(**request)
+                await response.aread()
+                statuses[response.status_code] += 1
+            except httpx.HTTPError as e:
+                statuses[type(e).__name__] += 1
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, statuses, time.perf_counter() - started
+
+
+def request_builders(args, webhook_signer=None):
+    # One key per request: the per-key rate limiter is exercised without throttling the benchmark
+    premium_key = lambda index: f"bench-premium-{index}"
+    unique_prompts = args.unique_prompts or None
+    assistance_types = ("generate_about_us", "suggest_branding", "faq_content")
+    duplicate_every = int(1 / args.webhook_duplicate_ratio) if args.webhook_duplicate_ratio > 0 else 0
+
+    def generate_product(index):
+        niche = f"niche {index % unique_prompts if unique_prompts else index}"
+        return {"method": "POST", "url": "/generate-product", "headers": {"api-key": premium_key(index)},
+                "json": {"niche": niche, "persona": "Parents actifs qui manquent de temps", "num_ideas": args.num_ideas}}
+
+    def assist_store_setup(index):
+        return {"method": "POST", "url": "/assist-store-setup", "headers": {"api-key": premium_key(index)},
+                "json": {"store_type": "dropshipping", "niche": f"niche {index}", "target_audience": "Jeunes actifs urbains",
+                         "assistance_type": assistance_types[index % len(assistance_types)]}}
+
+    def subscribe(index):
+        return {"method": "POST", "url": "/subscribe", "headers": {"api-key": f"bench-subscribe-{index}"}, "json": {"plan_name": "Premium"}}
+
+    def paypal_webhook(index):
+        # Every n-th event is a PayPal redelivery of the previous one
+        event_index = index - 1 if duplicate_every and index % duplicate_every == 0 and index > 0 else index
+        event_type = "BILLING.SUBSCRIPTION.ACTIVATED" if event_index % 2 == 0 else "BILLING.SUBSCRIPTION.CANCELLED"
+        event = {"id": f"WH-BENCH-{event_index}", "event_type": event_type, "resource_type": "subscription",
+                 "resource": {"id": f"I-BENCH{event_index:08d}", "status": "ACTIVE"}}
+        body = json.dumps(event).encode("utf-8")
+        headers = {"content-type": "application/json"}
+        if webhook_signer is not None:
+            headers.update(webhook_signer(f"bench-transmission-{index}", body))
+        return {"method": "POST", "url": "/webhooks/paypal", "content": body, "headers": headers}
+
+    return {"generate_product": generate_product, "assist_store_setup": assist_store_setup, "subscribe": subscribe, "paypal_webhook": paypal_webhook}
+
+
+async def webhook_backlog_drain_seconds(client, timeout=60):
+    # Webhooks are acknowledged first and applied by the background worker: time until the backlog is empty
+    started = time.perf_counter()
+    while time.perf_counter() - started < timeout:
+        match = re.search(r"^dropia_webhook_backlog (\d+)", (await client.get("/metrics", headers={"authorization": f"Bearer {BENCH_METRICS_TOKEN}"})).text, re.MULTILINE)
+        if match is None or match.group(1) == "0":
+            return round(time.perf_counter() - started, 3) if match else None
+        await asyncio.sleep(0.1)
+    return None
+
+
+async def run(args, base_url, webhook_signer=None):
+    builders = request_builders(args, webhook_signer)
+    scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = set(scenarios) - set(builders)
+    if unknown:
+        raise SystemExit(f"Scénario(s) inconnu(s) : {', '.join(sorted(unknown))}. Disponibles : {', '.join(SCENARIOS)}.")
+
+    report = {}
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=120) as client:
+        for name in scenarios:
+            # Warm-up and measured requests use distinct indexes (users, prompts, subscription ids)
+            await drive(client, builders[name], range(args.warmup), args.concurrency)
+            latencies, statuses, elapsed = await drive(client, builders[name], range(args.warmup, args.warmup + args.requests), args.concurrency)
+            report[name] = summarize(latencies, statuses, elapsed)
+            if name == "paypal_webhook":
+                report[name]["backlog_drain_seconds"] = await webhook_backlog_drain_seconds(client)
+    return report
+
+
+def main():
+    args = parse_args()
+    workdir = tempfile.mkdtemp(prefix="dropia-bench-")
+    database_path = os.path.join(workdir, "dropia.db")
+    mock_port, app_port = free_port(), free_port()
+    mock_url = f"http://127.0.0.1:{mock_port}"
+    signing_key, ca_path, cert_path = create_fake_paypal_certificates(workdir)
+    cert_url = f"{mock_url}/v1/notifications/certs/CERT-BENCHMARK"
+
+    mock_env = dict(os.environ,
+                    MOCK_OPENAI_LATENCY_SECONDS=str(args.openai_latency),
+                    MOCK_OPENAI_TOKENS_PER_SECOND=str(args.openai_tokens_per_second),
+                    MOCK_OPENAI_ERROR_RATE=str(args.openai_error_rate),
+                    MOCK_PAYPAL_LATENCY_SECONDS=str(args.paypal_latency),
+                    MOCK_PAYPAL_CERT_FILE=cert_path)
+    app_env = dict(os.environ,
+                   DATABASE_URL=database_path,
+                   OPENAI_API_KEY="sk-benchmark",
+                   OPENAI_API_BASE=f"{mock_url}/v1",
+                   PAYPAL_CLIENT_ID="benchmark-client",
+                   PAYPAL_CLIENT_SECRET="benchmark-secret",
+                   PAYPAL_API_BASE=mock_url,
+                   PAYPAL_PREMIUM_PLAN_ID=BENCH_PLAN_ID,
+                   METRICS_TOKEN=BENCH_METRICS_TOKEN)
+    webhook_signer = None
+    if args.unsigned_webhooks:
+        app_env.pop("PAYPAL_WEBHOOK_ID", None)
+    else:
+        app_env.update(PAYPAL_WEBHOOK_ID=BENCH_WEBHOOK_ID, PAYPAL_CERT_HOSTS="127.0.0.1", PAYPAL_WEBHOOK_CA_BUNDLE=ca_path)
+        webhook_signer = lambda transmission_id, body: sign_paypal_webhook(signing_key, cert_url, transmission_id, body)
+
+    app_log = open(args.app_log, "w") if args.app_log else subprocess.DEVNULL
+    processes = []
+    try:
+        seed_database(database_path, app_env, args)
+        processes.append(start_uvicorn("mock_upstreams:app", mock_port, BENCHMARKS_DIR, mock_env, app_log))
+        wait_until_ready(f"{mock_url}/docs", processes[-1])
+        processes.append(start_uvicorn("dropia_api:app", app_port, REPO_DIR, app_env, app_log, args.workers))
+        wait_until_ready(f"http://127.0.0.1:{app_port}/metrics", processes[-1])
+
+        started = time.time()
+        scenarios = asyncio.run(run(args, f"http://127.0.0.1:{app_port}", webhook_signer))
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        if args.app_log:
+            app_log.close()
+
+    report = {
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(started)),
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "app_log")},
+        "scenarios": scenarios,
+    }
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    print(output)
+
+    if args.max_error_rate is not None:
+        failing = [name for name, result in scenarios.items() if result["error_rate"] > args.max_error_rate]
+        if failing:
+            print(f"Taux d'erreur supérieur à {args.max_error_rate} pour : {', '.join(failing)}", file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
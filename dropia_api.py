@@ -1,25 +1,372 @@
 
 # dropia_api.py
 
-from fastapi import FastAPI, HTTPException, Header, Depends, Request
+import time
+_import_started = time.perf_counter() # Cold start: time spent importing this module and its dependencies
+
+from fastapi import FastAPI, HTTPException, Header, Depends, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.middleware import Middleware
+from starlette.background import BackgroundTask
 from pydantic import BaseModel, Field
 import openai
 import os
-import uvicorn
-import nest_asyncio
+import asyncio
+import atexit
 # from google.colab import userdata # Commented out as userdata is Colab-specific
 import sqlite3
-import paypalrestsdk
+import queue
+import requests
 import json
+import base64
+import hashlib
+import itertools
+import bisect
+import contextvars
+import functools
+import hmac
+import math
+import random
+import re
+import sys
+import threading
+import traceback
+import unicodedata
+import uuid
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from datetime import datetime, timezone
+from types import SimpleNamespace
 from typing import List, Optional
+from urllib.parse import urlparse
 # from paypalcheckoutsdk.notifications.webhooks import VerificationApi, GenerateWebhookEventRequest # Commented out as paypal-checkout-sdk might not be installed
 # from paypalhttp import HttpHeaders # Commented out as paypal-checkout-sdk might not be installed
 # from pyngrok import ngrok # Import ngrok - Commented out as ngrok is for local testing
 
 
-nest_asyncio.apply()
+# Démarrage - durées d'import et de démarrage (en secondes), affichées au démarrage et exportées sur /metrics
+startup_timings = {}
 
-app = FastAPI()
+@contextmanager
+def startup_phase(name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        startup_timings[name] = time.perf_counter() - started
+
+@asynccontextmanager
+async def lifespan(app):
+    # Une seule fois par worker, avant la première requête : schéma et index, pool de connexions,
+    # templates de prompts, puis les tâches de fond. Les étapes sont définies plus bas dans ce module.
+    started = time.perf_counter()
+    with startup_phase("init_db"):
+        init_db()
+    with startup_phase("db_pool"):
+        get_db_pool()
+    with startup_phase("prompt_templates"):
+        warm_up_prompt_templates()
+    start_quota_flusher()
+    start_webhook_worker()
+    open_paypal_client()
+    startup_timings["startup"] = time.perf_counter() - started
+    log.info("startup_completed", "Démarrage terminé", **{f"{name}_ms": round(seconds * 1000, 1) for name, seconds in startup_timings.items()})
+    try:
+        yield
+    finally:
+        close_paypal_client()
+        close_db_pool()
+        log.flush()
+
+app = FastAPI(lifespan=lifespan)
+
+
+# Métriques
+# Per-stage latency histograms (auth, db_acquire, prompt_build, openai, parse, paypal_*, db_write...),
+# request counts and in-flight requests per route, exposed in the Prometheus text format on /metrics.
+# Recording a sample is a perf_counter() pair, a bisect and a locked increment.
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+METRICS_LATENCY_BUCKETS = tuple(float(b) for b in os.getenv(
+    "METRICS_LATENCY_BUCKETS", "0.001,0.005,0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5,10,30,60").split(","))
+# Bearer token the scraper sends (Authorization: Bearer <token>). Without it, /metrics answers 403.
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+# Route being served, so shared helpers (auth, pool, OpenAI client) label their stages without extra parameters.
+# Work done outside of a request (quota flush, webhook worker) is labelled "background".
+current_endpoint = contextvars.ContextVar("current_endpoint", default="background")
+
+
+def _metric_labels(**labels):
+    escaped = (f'{k}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34)).replace(chr(10), " ")}"' for k, v in labels.items())
+    return "{" + ",".join(escaped) + "}"
+
+
+class MetricsRegistry:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._stages = {}     # (endpoint, stage) -> [per-bucket counts..., +Inf count, sum]
+        self._requests = {}   # (endpoint, status) -> count
+        self._in_flight = {}  # endpoint -> requests being served
+        self._routes = None
+
+    def observe(self, stage, seconds, endpoint=None):
+        key = (endpoint or current_endpoint.get(), stage)
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            series = self._stages.get(key)
+            if series is None:
+                series = self._stages[key] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += seconds
+
+    @contextmanager
+    def stage(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            if METRICS_ENABLED:
+                self.observe(stage, time.perf_counter() - started)
+
+    def endpoint_label(self, path):
+        # Unknown paths share one label, so scanners cannot blow up the number of series
+        if self._routes is None:
+            self._routes = {route.path for route in app.routes}
+        return path if path in self._routes else "other"
+
+    def request_started(self, endpoint):
+        with self._lock:
+            self._in_flight[endpoint] = self._in_flight.get(endpoint, 0) + 1
+
+    def request_finished(self, endpoint, status, seconds):
+        with self._lock:
+            self._in_flight[endpoint] -= 1
+            self._requests[(endpoint, status)] = self._requests.get((endpoint, status), 0) + 1
+        self.observe("total", seconds, endpoint)
+
+    def render(self):
+        with self._lock:
+            stages = {key: list(series) for key, series in self._stages.items()}
+            requests = dict(self._requests)
+            in_flight = dict(self._in_flight)
+        lines = [
+            "# HELP dropia_stage_duration_seconds Durée de chaque étape du traitement, par route.",
+            "# TYPE dropia_stage_duration_seconds histogram",
+        ]
+        for (endpoint, stage), series in sorted(stages.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"dropia_stage_duration_seconds_bucket{_metric_labels(endpoint=endpoint, stage=stage, le=le)} {cumulative}")
+            lines.append(f"dropia_stage_duration_seconds_sum{_metric_labels(endpoint=endpoint, stage=stage)} {series[-1]}")
+            lines.append(f"dropia_stage_duration_seconds_count{_metric_labels(endpoint=endpoint, stage=stage)} {cumulative}")
+        lines += ["# HELP dropia_requests_total Requêtes servies, par route et code HTTP.", "# TYPE dropia_requests_total counter"]
+        lines += [f"dropia_requests_total{_metric_labels(endpoint=endpoint, status=status)} {count}" for (endpoint, status), count in sorted(requests.items())]
+        lines += ["# HELP dropia_requests_in_flight Requêtes en cours, par route.", "# TYPE dropia_requests_in_flight gauge"]
+        lines += [f"dropia_requests_in_flight{_metric_labels(endpoint=endpoint)} {count}" for endpoint, count in sorted(in_flight.items())]
+        return lines
+
+
+metrics = MetricsRegistry(METRICS_LATENCY_BUCKETS)
+
+
+class MetricsMiddleware:
+    # Plain ASGI middleware: cheaper than BaseHTTPMiddleware, and a streamed response is timed until its last chunk
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        endpoint = metrics.endpoint_label(scope["path"])
+        token = current_endpoint.set(endpoint)
+        status = [500]
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        metrics.request_started(endpoint)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            metrics.request_finished(endpoint, status[0], time.perf_counter() - started)
+            current_endpoint.reset(token)
+
+if METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware)
+
+
+# Journalisation
+# Une ligne JSON par événement (format compris par Cloud Logging : severity, message), écrite sur stdout
+# par un thread dédié : la requête ne fait qu'un put_nowait dans une file bornée, jamais d'écriture bloquante.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "info").lower()
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000")) # Au-delà, les lignes sont abandonnées (et comptées)
+LOG_MAX_FIELD_CHARS = int(os.getenv("LOG_MAX_FIELD_CHARS", "1000")) # Réponses OpenAI, erreurs PayPal, tracebacks...
+# Share of the high-volume success lines that are kept, per event ("event=rate,..."); warnings and errors are never sampled
+LOG_SAMPLE_RATES = {
+    "generation_succeeded": 0.1,
+    "generation_cache_hit": 0.1,
+    "webhook_received": 0.1,
+    "webhook_duplicate": 0.1,
+}
+LOG_SAMPLE_RATES.update({
+    event.strip(): float(rate)
+    for event, rate in (item.split("=", 1) for item in os.getenv("LOG_SAMPLE_RATES", "").split(",") if "=" in item)
+})
+
+LOG_LEVELS = {"debug": 10, "info": 20, "warning": 30, "error": 40}
+# Field names whose value is a secret: an API key is replaced by a short fingerprint, still usable to correlate lines
+REDACTED_FIELD_NAMES = {"api_key", "authorization", "secret", "password", "token"}
+REDACTED_FIELD_SUFFIXES = ("_key", "_secret", "_password", "_token")
+
+# Correlation id of the request being served (X-Request-ID), added to every line logged while serving it
+current_request_id = contextvars.ContextVar("current_request_id", default=None)
+REQUEST_ID_PATTERN = re.compile(r"^[A-Za-z0-9._-]{1,64}$")
+
+
+def redact_secret(value):
+    if not value:
+        return value
+    value = str(value)
+    return "sha256:" + hashlib.sha256(value.encode("utf-8")).hexdigest()[:12]
+
+def truncate_log_value(value, limit=LOG_MAX_FIELD_CHARS):
+    if isinstance(value, str) and len(value) > limit:
+        return f"{value[:limit]}…(+{len(value) - limit})"
+    return value
+
+
+class StructuredLogger:
+    def __init__(self, level, queue_size, sample_rates):
+        self.level = LOG_LEVELS.get(level, 20)
+        self.sample_rates = sample_rates
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self.counts = {"written": 0, "dropped": 0, "sampled_out": 0}
+        self._thread = threading.Thread(target=self._write_loop, name="structured-logger", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _count(self, result):
+        with self._lock:
+            self.counts[result] += 1
+
+    def log(self, level, event, message=None, **fields):
+        level_value = LOG_LEVELS[level]
+        if level_value < self.level:
+            return
+        sample_rate = self.sample_rates.get(event, 1.0) if level_value <= LOG_LEVELS["info"] else 1.0
+        if sample_rate < 1.0:
+            if random.random() >= sample_rate:
+                self._count("sampled_out")
+                return
+            fields["sample_rate"] = sample_rate
+        record = {"time": time.time(), "severity": level.upper(), "event": event, "message": message or event}
+        request_id = current_request_id.get()
+        if request_id is not None:
+            record["request_id"] = request_id
+            record["endpoint"] = current_endpoint.get()
+        for name, value in fields.items():
+            if name.lower() in REDACTED_FIELD_NAMES or name.lower().endswith(REDACTED_FIELD_SUFFIXES):
+                value = redact_secret(value)
+            record[name] = truncate_log_value(value)
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self._count("dropped")
+
+    def debug(self, event, message=None, **fields):
+        self.log("debug", event, message, **fields)
+
+    def info(self, event, message=None, **fields):
+        self.log("info", event, message, **fields)
+
+    def warning(self, event, message=None, **fields):
+        self.log("warning", event, message, **fields)
+
+    def error(self, event, message=None, **fields):
+        self.log("error", event, message, **fields)
+
+    def exception(self, event, message=None, **fields):
+        # To be called from an except block: the traceback is formatted here, only on the error path
+        self.log("error", event, message, traceback=traceback.format_exc(), **fields)
+
+    def _write_loop(self):
+        while True:
+            record = self._queue.get()
+            try:
+                if record is None:
+                    break
+                sys.stdout.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+                if self._queue.empty():
+                    sys.stdout.flush()
+                self._count("written")
+            except Exception:
+                self._count("dropped")
+            finally:
+                self._queue.task_done()
+
+    def flush(self):
+        # Wait until every queued line is written (shutdown)
+        if self._thread.is_alive():
+            self._queue.join()
+
+    def close(self):
+        # Drain what is queued (shutdown, interpreter exit); the thread stops after the last record
+        if self._thread.is_alive():
+            try:
+                self._queue.put(None, timeout=5)
+            except queue.Full:
+                return
+            self._thread.join(timeout=5)
+
+    def stats(self):
+        with self._lock:
+            counts = dict(self.counts)
+        counts["queued"] = self._queue.qsize()
+        return counts
+
+
+log = StructuredLogger(LOG_LEVEL, LOG_QUEUE_SIZE, LOG_SAMPLE_RATES)
+
+
+class RequestIdMiddleware:
+    # Reuses the caller's (or the load balancer's) X-Request-ID when it is well formed, else makes one, and returns it
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        request_id = None
+        for name, value in scope["headers"]:
+            if name == b"x-request-id":
+                candidate = value.decode("latin-1")
+                if REQUEST_ID_PATTERN.match(candidate):
+                    request_id = candidate
+                break
+        request_id = request_id or uuid.uuid4().hex[:16]
+        token = current_request_id.set(request_id)
+
+        async def send_with_request_id(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + [(b"x-request-id", request_id.encode("latin-1"))]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_request_id)
+        finally:
+            current_request_id.reset(token)
+
+# Added after MetricsMiddleware, so it runs first and the whole request (metrics included) carries the id
+app.add_middleware(RequestIdMiddleware)
 
 
 # Configuration OpenAI - Read from environment variable
@@ -27,26 +374,673 @@ openai.api_key = os.getenv("OPENAI_API_KEY")
 if not openai.api_key:
     # Consider using python-dotenv for local development, but for Cloud Run, direct env vars are used.
     # For local testing without dotenv, you'd need to set the env var manually before running.
-    print("Attention: La variable d'environnement OPENAI_API_KEY n'est pas définie.")
+    log.warning("config_missing", "La variable d'environnement OPENAI_API_KEY n'est pas définie.", setting="OPENAI_API_KEY")
     # In a production API, you might want to raise an error or handle this more gracefully
     # raise ValueError("La variable d'environnement OPENAI_API_KEY n'est pas définie.")
 
+# Nombre maximum d'appels OpenAI simultanés par processus (par worker uvicorn).
+# Les requêtes au-delà de cette limite attendent leur tour sans bloquer la boucle d'événements.
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "32"))
+
+# The semaphore is created lazily so that it is bound to the running event loop
+_openai_semaphore = None
+
+def get_openai_semaphore():
+    global _openai_semaphore
+    if _openai_semaphore is None:
+        _openai_semaphore = asyncio.Semaphore(OPENAI_MAX_CONCURRENCY)
+    return _openai_semaphore
+
+# Identical completion requests (same rendered prompt and parameters) that are in flight at the
+# same time share one upstream call. Disable with OPENAI_COALESCE_ENABLED=false.
+OPENAI_COALESCE_ENABLED = os.getenv("OPENAI_COALESCE_ENABLED", "true").lower() == "true"
+
+
+class SingleFlight:
+    def __init__(self):
+        self._calls = {}
+        self.leaders = 0    # upstream calls actually made
+        self.coalesced = 0  # callers that joined an in-flight call instead of making their own
+        self.abandoned = 0  # shared calls cancelled because every caller went away
+
+    async def do(self, key, fn):
+        call = self._calls.get(key)
+        if call is None:
+            call = {"task": asyncio.ensure_future(fn()), "waiters": 0}
+            self._calls[key] = call
+            call["task"].add_done_callback(lambda _task, key=key, call=call: self._forget(key, call))
+            self.leaders += 1
+        else:
+            self.coalesced += 1
+
+        call["waiters"] += 1
+        try:
+            # shield: a disconnecting client only cancels its own wait, not the shared call
+            return await asyncio.shield(call["task"])
+        finally:
+            call["waiters"] -= 1
+            if call["waiters"] == 0 and not call["task"].done():
+                call["task"].cancel()
+                self.abandoned += 1
+
+    def _forget(self, key, call):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+
+    def in_flight(self):
+        return len(self._calls)
+
+    def stats(self):
+        return {"in_flight": len(self._calls), "upstream_calls": self.leaders, "coalesced": self.coalesced, "abandoned": self.abandoned}
+
+
+completion_single_flight = SingleFlight()
+
+
+# Résilience des appels OpenAI
+# Each setting can be overridden for one endpoint with its name as suffix,
+# e.g. OPENAI_TIMEOUT_SECONDS_ASSIST_STORE_SETUP=60 or OPENAI_HEDGE_PERCENTILE_GENERATE_PRODUCT=95.
+# Endpoints: GENERATE_PRODUCT, GENERATE_PRODUCT_STREAM, GENERATE_PRODUCT_BATCH, GENERATE_PRODUCT_SPLIT, ASSIST_STORE_SETUP, ASSIST_STORE_SETUP_BUNDLE,
+# and GENERATE_PRODUCT_REASK / GENERATE_PRODUCT_BATCH_REASK for the re-asks of missing ideas.
+def endpoint_setting(name, endpoint, default):
+    return os.getenv(f"{name}_{endpoint.upper()}", os.getenv(name, default))
+
+
+class UpstreamPolicy:
+    def __init__(self, endpoint):
+        self.timeout = float(endpoint_setting("OPENAI_TIMEOUT_SECONDS", endpoint, "30"))  # per attempt
+        self.max_attempts = max(1, int(endpoint_setting("OPENAI_MAX_ATTEMPTS", endpoint, "3")))
+        self.backoff_base = float(endpoint_setting("OPENAI_RETRY_BACKOFF_SECONDS", endpoint, "0.5"))
+        self.backoff_max = float(endpoint_setting("OPENAI_RETRY_BACKOFF_MAX_SECONDS", endpoint, "8"))
+        # Hedging sends a second identical request when the first one is slower than this percentile
+        # of the recent successful latencies (e.g. 95). It costs extra tokens, so 0 (disabled) by default.
+        self.hedge_percentile = float(endpoint_setting("OPENAI_HEDGE_PERCENTILE", endpoint, "0"))
+        self.hedge_min_samples = int(endpoint_setting("OPENAI_HEDGE_MIN_SAMPLES", endpoint, "20"))
+        self.breaker_failure_threshold = max(1, int(endpoint_setting("OPENAI_BREAKER_FAILURE_THRESHOLD", endpoint, "5")))
+        self.breaker_cooldown = float(endpoint_setting("OPENAI_BREAKER_COOLDOWN_SECONDS", endpoint, "30"))
+
+
+class UpstreamUnavailableError(Exception):
+    # OpenAI is degraded: circuit open or every attempt failed. Surfaced as a 503 with Retry-After.
+    def __init__(self, retry_after, reason):
+        super().__init__(reason)
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+def is_retryable_upstream_error(e):
+    # Timeouts, connection errors, rate limits and 5xx are worth another attempt; 4xx (bad request, auth) are not
+    if isinstance(e, (asyncio.TimeoutError, openai.error.Timeout, openai.error.APIConnectionError, openai.error.RateLimitError,
+                      openai.error.ServiceUnavailableError, openai.error.TryAgain)):
+        return True
+    if isinstance(e, openai.error.APIError):
+        return e.http_status is None or e.http_status >= 500
+    return False
+
+
+class CircuitBreaker:
+    # closed -> open after `failure_threshold` consecutive failed attempts. While open every call fails fast
+    # for `cooldown` seconds, then half-open lets a single probe through: success closes it, failure re-opens it.
+    def __init__(self, failure_threshold, cooldown):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self.opens = 0
+        self.rejected = 0
+
+    def retry_after(self):
+        if self.state == "open":
+            return max(1.0, self.opened_at + self.cooldown - time.monotonic())
+        return 1.0
+
+    def check_available(self):
+        # Read-only check, to fail fast before any work (quota reservation, streaming response) is started
+        if self.state == "open" and time.monotonic() - self.opened_at < self.cooldown:
+            raise UpstreamUnavailableError(self.retry_after(), "circuit ouvert")
+
+    def before_call(self):
+        if self.state == "open":
+            if time.monotonic() - self.opened_at < self.cooldown:
+                self.rejected += 1
+                raise UpstreamUnavailableError(self.retry_after(), "circuit ouvert")
+            self.state = "half_open"
+            self.probe_in_flight = False
+        if self.state == "half_open":
+            if self.probe_in_flight:
+                self.rejected += 1
+                raise UpstreamUnavailableError(self.retry_after(), "service en cours de rétablissement")
+            self.probe_in_flight = True
+
+    def record_success(self):
+        self.state = "closed"
+        self.failures = 0
+        self.probe_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        self.probe_in_flight = False
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            if self.state != "open":
+                self.opens += 1
+                log.warning("openai_breaker_opened", "Circuit OpenAI ouvert", cooldown_seconds=self.cooldown, consecutive_failures=self.failures)
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+    def abort(self):
+        # The attempt was cancelled (client gone, hedge lost): no verdict on the provider
+        self.probe_in_flight = False
+
+    def stats(self):
+        return {"state": self.state, "consecutive_failures": self.failures, "opens": self.opens, "rejected": self.rejected}
+
+
+class LatencyWindow:
+    # Latencies of the last successful attempts, used to pick the hedging delay
+    def __init__(self, size=200):
+        self._samples = deque(maxlen=size)
+
+    def add(self, seconds):
+        self._samples.append(seconds)
+
+    def percentile(self, p):
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+    def __len__(self):
+        return len(self._samples)
+
+
+class UpstreamGuard:
+    # Per-endpoint resilience around one upstream call: per-attempt timeout, jittered exponential
+    # retries on retryable errors, optional hedged second request, and a circuit breaker.
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.policy = UpstreamPolicy(endpoint)
+        self.breaker = CircuitBreaker(self.policy.breaker_failure_threshold, self.policy.breaker_cooldown)
+        self.latencies = LatencyWindow()
+        self.attempts = 0
+        self.retries = 0
+        self.timeouts = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def backoff(self, attempt):
+        # "Full jitter": spreads the retries of concurrent requests instead of synchronising them
+        return random.uniform(0, min(self.policy.backoff_max, self.policy.backoff_base * 2 ** (attempt - 1)))
+
+    def hedge_delay(self):
+        if self.policy.hedge_percentile <= 0 or len(self.latencies) < self.policy.hedge_min_samples:
+            return None
+        return self.latencies.percentile(self.policy.hedge_percentile)
+
+    async def _attempt(self, fn, slot=None, keep_slot=False):
+        # The local concurrency slot is taken before the breaker check and the timeout start: time
+        # queued behind our own semaphore is neither a provider timeout nor a latency sample.
+        # With keep_slot, a successful attempt keeps it (a stream still reading): the caller releases it.
+        if slot is None:
+            return await self._provider_attempt(fn)
+        semaphore = slot()
+        await semaphore.acquire()
+        try:
+            result = await self._provider_attempt(fn)
+        except BaseException:
+            semaphore.release()
+            raise
+        if not keep_slot:
+            semaphore.release()
+        return result
+
+    async def _provider_attempt(self, fn):
+        self.breaker.before_call()
+        self.attempts += 1
+        started = time.monotonic()
+        try:
+            result = await asyncio.wait_for(fn(), self.policy.timeout)
+        except asyncio.CancelledError:
+            self.breaker.abort()
+            raise
+        except Exception as e:
+            if isinstance(e, asyncio.TimeoutError):
+                self.timeouts += 1
+            if is_retryable_upstream_error(e):
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success() # The provider answered, the request itself was wrong
+            raise
+        self.latencies.add(time.monotonic() - started)
+        self.breaker.record_success()
+        return result
+
+    async def _hedged_attempt(self, fn, slot=None):
+        delay = self.hedge_delay()
+        primary = asyncio.ensure_future(self._attempt(fn, slot))
+        if delay is None:
+            return await primary
+        pending = {primary}
+        try:
+            done, _ = await asyncio.wait(pending, timeout=delay)
+            if not done:
+                self.hedges += 1
+                pending.add(asyncio.ensure_future(self._attempt(fn, slot)))
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not primary:
+                            self.hedge_wins += 1
+                        return task.result()
+                    error = error or task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def call(self, fn, hedge=True, slot=None, keep_slot=False):
+        # slot: semaphore factory (e.g. get_openai_semaphore) held for each attempt only, never during the backoff
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                if hedge:
+                    return await self._hedged_attempt(fn, slot)
+                return await self._attempt(fn, slot, keep_slot)
+            except UpstreamUnavailableError:
+                raise
+            except Exception as e:
+                if not is_retryable_upstream_error(e):
+                    raise
+                reason = f"{type(e).__name__}: {e}" if str(e) else type(e).__name__
+                if attempt >= self.policy.max_attempts:
+                    raise UpstreamUnavailableError(self.breaker.retry_after(), f"{attempt} tentative(s) échouée(s), dernière erreur {reason}") from e
+                self.retries += 1
+                log.warning("openai_retry", "Appel OpenAI en échec, nouvelle tentative", upstream_endpoint=self.endpoint, reason=reason, attempt=attempt + 1, max_attempts=self.policy.max_attempts)
+                await asyncio.sleep(self.backoff(attempt))
+
+    def stats(self):
+        return {
+            "breaker": self.breaker.stats(),
+            "attempts": self.attempts,
+            "retries": self.retries,
+            "timeouts": self.timeouts,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+        }
+
+
+upstream_guards = {}
+
+def get_upstream_guard(endpoint):
+    guard = upstream_guards.get(endpoint)
+    if guard is None:
+        guard = upstream_guards[endpoint] = UpstreamGuard(endpoint)
+    return guard
+
+def upstream_unavailable_http_error(e):
+    retry_after = math.ceil(e.retry_after)
+    return HTTPException(
+        status_code=503,
+        detail=f"Le service OpenAI est temporairement indisponible ({e.reason}). Veuillez réessayer dans {retry_after} seconde(s).",
+        headers={"Retry-After": str(retry_after)},
+    )
+
+async def _create_chat_completion_upstream(kwargs):
+    # Native async client (openai<1 ships ChatCompletion.acreate on top of aiohttp),
+    # so a slow completion never freezes auth, webhooks or the other requests of this worker.
+    # The concurrency slot is taken by the guard, outside of the per-attempt timeout.
+    return await openai.ChatCompletion.acreate(**kwargs)
+
+async def _guarded_chat_completion(guard, endpoint, kwargs):
+    # Runs once per upstream call (by the leader when coalesced), so token usage is recorded once
+    response = await guard.call(lambda: _create_chat_completion_upstream(kwargs), slot=get_openai_semaphore)
+    token_budgeter.record_response(endpoint, kwargs.get("max_tokens") or 0, response)
+    return response
+
+async def create_chat_completion(endpoint="generate_product", **kwargs):
+    guard = get_upstream_guard(endpoint)
+    with metrics.stage("openai"):
+        if not OPENAI_COALESCE_ENABLED:
+            return await _guarded_chat_completion(guard, endpoint, kwargs)
+        key = hashlib.sha256(json.dumps(kwargs, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+        return await completion_single_flight.do(key, lambda: _guarded_chat_completion(guard, endpoint, kwargs))
+
+async def stream_chat_completion(endpoint="generate_product_stream", **kwargs):
+    # Yields the content deltas of a streamed completion; the concurrency slot is held until the stream ends.
+    # Only opening the stream is retried (never hedged); once content went out, a failure is final.
+    # Like create_chat_completion, the slot is taken per attempt: a failing open does not keep it while backing off.
+    guard = get_upstream_guard(endpoint)
+    started = time.perf_counter()
+    with metrics.stage("openai_stream_open"):
+        chunks = await guard.call(lambda: openai.ChatCompletion.acreate(stream=True, **kwargs), hedge=False, slot=get_openai_semaphore, keep_slot=True)
+    try:
+        first_token = True
+        iterator = chunks.__aiter__()
+        while True:
+            try:
+                # The per-attempt timeout also bounds the silence between two chunks
+                chunk = await asyncio.wait_for(iterator.__anext__(), guard.policy.timeout)
+            except StopAsyncIteration:
+                break
+            if not chunk.choices:
+                continue
+            content = chunk.choices[0].delta.get("content")
+            if content:
+                if first_token:
+                    first_token = False
+                    metrics.observe("openai_first_token", time.perf_counter() - started)
+                yield content
+        metrics.observe("openai", time.perf_counter() - started)
+    finally:
+        get_openai_semaphore().release()
+
+
+# Cache des réponses de génération
+# GENERATION_CACHE_HIT_QUOTA_POLICY: "charge" (un hit est décompté comme une génération normale)
+# ou "free" (un hit ne consomme pas de quota).
+GENERATION_CACHE_ENABLED = os.getenv("GENERATION_CACHE_ENABLED", "true").lower() == "true"
+GENERATION_CACHE_MAX_ENTRIES = int(os.getenv("GENERATION_CACHE_MAX_ENTRIES", "1024"))
+GENERATION_CACHE_TTL_SECONDS = float(os.getenv("GENERATION_CACHE_TTL_SECONDS", "3600"))
+GENERATION_CACHE_HIT_QUOTA_POLICY = os.getenv("GENERATION_CACHE_HIT_QUOTA_POLICY", "charge")
+
+if GENERATION_CACHE_HIT_QUOTA_POLICY not in ("charge", "free"):
+    log.warning("config_invalid", "GENERATION_CACHE_HIT_QUOTA_POLICY non reconnue, utilisation de 'charge'.", setting="GENERATION_CACHE_HIT_QUOTA_POLICY", value=GENERATION_CACHE_HIT_QUOTA_POLICY)
+    GENERATION_CACHE_HIT_QUOTA_POLICY = "charge"
+
+
+class LRUTTLCache:
+    # Size-bounded LRU cache whose entries also expire after ttl seconds.
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                self.evictions += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            return entry[0] if entry is not None else None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._entries), "max_entries": self.max_entries, "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+
+generation_cache = LRUTTLCache(GENERATION_CACHE_MAX_ENTRIES, GENERATION_CACHE_TTL_SECONDS)
+
+def _normalize_text(value):
+    return " ".join(value.split()).casefold()
+
+def generation_cache_key(data, fields_to_include):
+    # Two prompts that only differ by case or whitespace render the same completion request
+    normalized = {
+        "niche": _normalize_text(data.niche),
+        "persona": _normalize_text(data.persona),
+        "num_ideas": data.num_ideas,
+        "fields": list(fields_to_include),
+        "prompt_version": prompt_templates.version,
+        "temperature": round(data.temperature, 4),
+        "top_p": round(data.top_p, 4),
+        "frequency_penalty": round(data.frequency_penalty, 4),
+        "presence_penalty": round(data.presence_penalty, 4),
+    }
+    return hashlib.sha256(json.dumps(normalized, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+def cache_bypass_requested(cache_control):
+    # Le client peut désactiver le cache avec l'en-tête "Cache-Control: no-cache" (ou no-store)
+    if not cache_control:
+        return False
+    directives = {d.strip().lower() for d in cache_control.split(",")}
+    return "no-cache" in directives or "no-store" in directives
+
 
 # Configuration PayPal - Read from environment variables
 PAYPAL_CLIENT_ID = os.getenv("PAYPAL_CLIENT_ID")
 PAYPAL_CLIENT_SECRET = os.getenv("PAYPAL_CLIENT_SECRET")
 PAYPAL_WEBHOOK_ID = os.getenv("PAYPAL_WEBHOOK_ID") # Read Webhook ID from env var
+PAYPAL_API_BASE = os.getenv("PAYPAL_API_BASE") # Optional: another REST endpoint than the sandbox (e.g. the benchmark stand-in)
 
 if not PAYPAL_CLIENT_ID or not PAYPAL_CLIENT_SECRET:
-     print("Attention: Les clés API PayPal ne sont pas définies dans les variables d'environnement. L'intégration PayPal ne fonctionnera pas.")
+     log.warning("config_missing", "Les clés API PayPal ne sont pas définies dans les variables d'environnement. L'intégration PayPal ne fonctionnera pas.", setting="PAYPAL_CLIENT_ID/PAYPAL_CLIENT_SECRET")
 if not PAYPAL_WEBHOOK_ID:
-     print("Attention: L'ID du Webhook PayPal n'est pas défini dans les variables d'environnement. La validation des webhooks ne fonctionnera pas.")
+     log.warning("config_missing", "L'ID du Webhook PayPal n'est pas défini dans les variables d'environnement. La validation des webhooks ne fonctionnera pas.", setting="PAYPAL_WEBHOOK_ID")
+
+# Client PayPal partagé
+PAYPAL_MODE = os.getenv("PAYPAL_MODE", "sandbox") # "sandbox" ou "live", doit correspondre aux clés
+PAYPAL_HTTP_POOL_SIZE = int(os.getenv("PAYPAL_HTTP_POOL_SIZE", "8")) # Connexions keep-alive et threads des appels PayPal
+PAYPAL_TIMEOUT_SECONDS = float(os.getenv("PAYPAL_TIMEOUT_SECONDS", "15"))
+PAYPAL_TOKEN_REFRESH_MARGIN_SECONDS = float(os.getenv("PAYPAL_TOKEN_REFRESH_MARGIN_SECONDS", "300"))
+PAYPAL_PREFETCH_TOKEN = os.getenv("PAYPAL_PREFETCH_TOKEN", "false").lower() in ("1", "true", "yes") # Jeton OAuth obtenu dès le démarrage (importe le SDK)
+
+
+@functools.lru_cache(maxsize=None)
+def paypal_client_class():
+    # The PayPal SDK is only imported by the first billing call, not on every cold start
+    import paypalrestsdk
+
+    class PayPalClient(paypalrestsdk.Api):
+        # Long-lived REST SDK client shared by every request: one HTTP session (keep-alive, pooled connections)
+        # and one OAuth token, renewed a little before it expires, by a single caller at a time.
+        def __init__(self, options):
+            super().__init__(options)
+            self._session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=PAYPAL_HTTP_POOL_SIZE)
+            self._session.mount("https://", adapter)
+            self._session.mount("http://", adapter)
+            self._token_lock = threading.Lock()
+            self._token_expires_at = 0.0
+            self.token_refreshes = 0
+
+        def http_call(self, url, method, **kwargs):
+            # Same as the SDK, through the shared session instead of a new connection per call
+            response = self._session.request(method, url, proxies=self.proxies, timeout=PAYPAL_TIMEOUT_SECONDS, **kwargs)
+            return self.handle_response(response, response.content.decode("utf-8"))
+
+        def get_token_hash(self, authorization_code=None, refresh_token=None, headers=None):
+            if authorization_code is not None or refresh_token is not None:
+                return super().get_token_hash(authorization_code=authorization_code, refresh_token=refresh_token, headers=headers)
+            with self._token_lock:
+                if self.token_hash is None or time.monotonic() >= self._token_expires_at:
+                    self.token_hash = None # Also set by the SDK after a 401, to force a new token
+                    with metrics.stage("paypal_oauth_token"):
+                        token = super().get_token_hash(headers=headers)
+                    self._token_expires_at = time.monotonic() + float(token.get("expires_in") or 0) - PAYPAL_TOKEN_REFRESH_MARGIN_SECONDS
+                    self.token_refreshes += 1
+                return self.token_hash
+
+        def close(self):
+            self._session.close()
+
+    return PayPalClient
+
+
+paypal_client = None
+_paypal_executor = None
+_paypal_client_lock = threading.Lock()
+
+def get_paypal_client():
+    global paypal_client
+    if not PAYPAL_CLIENT_ID or not PAYPAL_CLIENT_SECRET:
+        return None
+    if paypal_client is None:
+        with _paypal_client_lock:
+            if paypal_client is None:
+                options = {"mode": PAYPAL_MODE, "client_id": PAYPAL_CLIENT_ID, "client_secret": PAYPAL_CLIENT_SECRET}
+                if PAYPAL_API_BASE:
+                    options["endpoint"] = PAYPAL_API_BASE # Local stand-in (benchmarks/mock_upstreams.py)
+                paypal_client = paypal_client_class()(options)
+    return paypal_client
+
+async def run_paypal_call(fn, *args, **kwargs):
+    # The SDK is blocking: run it on the PayPal threads (bounded like the HTTP pool), never on the event loop.
+    # The context is copied so the metrics of the call keep the route label.
+    global _paypal_executor
+    if _paypal_executor is None:
+        _paypal_executor = ThreadPoolExecutor(max_workers=PAYPAL_HTTP_POOL_SIZE, thread_name_prefix="paypal")
+    call = functools.partial(contextvars.copy_context().run, fn, *args, **kwargs)
+    return await asyncio.get_running_loop().run_in_executor(_paypal_executor, call)
+
+
+# Vérification des webhooks PayPal
+# La signature est vérifiée localement (CRC32 du corps + RSA du certificat PayPal), sans appel à l'API de vérification.
+PAYPAL_WEBHOOK_VERIFY = os.getenv("PAYPAL_WEBHOOK_VERIFY", "true").lower() in ("1", "true", "yes")
+PAYPAL_CERT_HOSTS = {host.strip().lower() for host in os.getenv("PAYPAL_CERT_HOSTS", "api.paypal.com,api-m.paypal.com,api.sandbox.paypal.com,api-m.sandbox.paypal.com").split(",") if host.strip()}
+PAYPAL_CERT_CACHE_TTL_SECONDS = float(os.getenv("PAYPAL_CERT_CACHE_TTL_SECONDS", "86400"))
+PAYPAL_CERT_COMMON_NAME = os.getenv("PAYPAL_CERT_COMMON_NAME", "messageverificationcerts.paypal.com")
+PAYPAL_WEBHOOK_CA_BUNDLE = os.getenv("PAYPAL_WEBHOOK_CA_BUNDLE") # Optional: PEM of the only issuers accepted (e.g. the benchmark's fake CA)
+
+# Algorithmes annoncés dans l'en-tête paypal-auth-algo
+PAYPAL_SIGNATURE_HASHES = {"SHA256withRSA": "SHA256", "SHA384withRSA": "SHA384", "SHA512withRSA": "SHA512"}
+LOOPBACK_HOSTS = {"127.0.0.1", "localhost", "::1"}
+
+
+class WebhookSignatureError(Exception):
+    pass
+
+
+paypal_cert_cache = LRUTTLCache(32, PAYPAL_CERT_CACHE_TTL_SECONDS)
+paypal_cert_flight = SingleFlight()
+webhook_signature_results = {"valid": 0, "invalid": 0}
+_paypal_trusted_issuers = None
+
+def check_paypal_cert_url(cert_url):
+    # The cert URL comes from the request itself: only PayPal's hosts (over https) are ever fetched.
+    # Plain http is only accepted for an allowlisted loopback host (local stand-in).
+    parsed = urlparse(cert_url or "")
+    host = (parsed.hostname or "").lower()
+    if host not in PAYPAL_CERT_HOSTS:
+        raise WebhookSignatureError(f"Hôte du certificat non autorisé : {host or cert_url!r}")
+    if parsed.scheme != "https" and not (parsed.scheme == "http" and host in LOOPBACK_HOSTS):
+        raise WebhookSignatureError("Le certificat PayPal doit être servi en https")
+
+def _load_paypal_trusted_issuers():
+    global _paypal_trusted_issuers
+    if _paypal_trusted_issuers is None:
+        from cryptography import x509
+        with open(PAYPAL_WEBHOOK_CA_BUNDLE, "rb") as f:
+            _paypal_trusted_issuers = x509.load_pem_x509_certificates(f.read())
+    return _paypal_trusted_issuers
+
+def _certificate_validity(cert):
+    # cryptography >= 42 exposes timezone-aware dates, older versions naive UTC ones
+    not_before = getattr(cert, "not_valid_before_utc", None) or cert.not_valid_before.replace(tzinfo=timezone.utc)
+    not_after = getattr(cert, "not_valid_after_utc", None) or cert.not_valid_after.replace(tzinfo=timezone.utc)
+    return not_before, not_after
+
+def check_paypal_certificate(cert):
+    from cryptography import x509
+    not_before, not_after = _certificate_validity(cert)
+    now = datetime.now(timezone.utc)
+    if now < not_before or now > not_after:
+        raise WebhookSignatureError("Certificat PayPal expiré ou pas encore valide")
+    common_names = [attribute.value for attribute in cert.subject.get_attributes_for_oid(x509.NameOID.COMMON_NAME)]
+    if PAYPAL_CERT_COMMON_NAME and PAYPAL_CERT_COMMON_NAME not in common_names:
+        raise WebhookSignatureError(f"Certificat inattendu : {common_names}")
+    if PAYPAL_WEBHOOK_CA_BUNDLE:
+        for issuer in _load_paypal_trusted_issuers():
+            try:
+                cert.verify_directly_issued_by(issuer)
+                return
+            except Exception:
+                continue
+        raise WebhookSignatureError("Certificat PayPal non émis par une autorité de confiance")
+
+def _fetch_paypal_certificate(cert_url):
+    from cryptography import x509
+    with metrics.stage("paypal_cert_fetch"):
+        response = requests.get(cert_url, timeout=PAYPAL_TIMEOUT_SECONDS)
+        response.raise_for_status()
+    cert = x509.load_pem_x509_certificate(response.content)
+    check_paypal_certificate(cert)
+    return cert
+
+async def get_paypal_certificate(cert_url):
+    # Un certificat n'est téléchargé qu'une fois par TTL ; les webhooks simultanés partagent le même téléchargement
+    cert = paypal_cert_cache.get(cert_url)
+    if cert is None:
+        try:
+            cert = await paypal_cert_flight.do(cert_url, lambda: run_paypal_call(_fetch_paypal_certificate, cert_url))
+        except WebhookSignatureError:
+            raise
+        except Exception as e:
+            raise WebhookSignatureError(f"Certificat PayPal indisponible : {e}")
+        paypal_cert_cache.set(cert_url, cert)
+    return cert
+
+def paypal_signed_message(headers, body, webhook_id):
+    # Chaîne signée par PayPal : <transmission_id>|<transmission_time>|<webhook_id>|<crc32 décimal du corps brut>
+    crc = zlib.crc32(body) & 0xFFFFFFFF
+    return f"{headers['paypal-transmission-id']}|{headers['paypal-transmission-time']}|{webhook_id}|{crc}".encode("utf-8")
+
+async def verify_paypal_webhook(headers, body, webhook_id):
+    from cryptography.exceptions import InvalidSignature
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import padding
+
+    missing = [name for name in ("paypal-transmission-id", "paypal-transmission-time", "paypal-transmission-sig", "paypal-cert-url", "paypal-auth-algo") if not headers.get(name)]
+    if missing:
+        raise WebhookSignatureError(f"En-têtes de signature manquants : {', '.join(missing)}")
+    hash_name = PAYPAL_SIGNATURE_HASHES.get(headers["paypal-auth-algo"])
+    if hash_name is None:
+        raise WebhookSignatureError(f"Algorithme de signature non supporté : {headers['paypal-auth-algo']}")
+    check_paypal_cert_url(headers["paypal-cert-url"])
+    cert = await get_paypal_certificate(headers["paypal-cert-url"])
+    # The cache TTL may outlive the certificate itself
+    not_before, not_after = _certificate_validity(cert)
+    if datetime.now(timezone.utc) > not_after:
+        paypal_cert_cache.pop(headers["paypal-cert-url"])
+        raise WebhookSignatureError("Certificat PayPal expiré")
+
+    try:
+        signature = base64.b64decode(headers["paypal-transmission-sig"], validate=True)
+    except ValueError:
+        raise WebhookSignatureError("Signature de webhook mal encodée")
+    with metrics.stage("webhook_verify"):
+        try:
+            cert.public_key().verify(signature, paypal_signed_message(headers, body, webhook_id), padding.PKCS1v15(), getattr(hashes, hash_name)())
+        except InvalidSignature:
+            raise WebhookSignatureError("Signature de webhook invalide")
 
 
 # Database Configuration
 # WARNING: SQLite on Cloud Run's ephemeral filesystem is NOT suitable for persistent production data.
 # Consider migrating to Google Cloud SQL or another persistent database for production.
-DATABASE_URL = "dropia.db"
+DATABASE_URL = os.getenv("DATABASE_URL", "dropia.db")
 
 # Ensure the database file exists and the table is created on startup
 # This is a workaround for ephemeral storage - data will be reset on new instances
@@ -61,40 +1055,302 @@ def init_db():
             plan TEXT,
             monthly_generations_count INTEGER DEFAULT 0,
             paypal_subscription_id TEXT, -- Added column for PayPal subscription ID
-            store_assistance_used BOOLEAN DEFAULT FALSE
+            store_assistance_used BOOLEAN DEFAULT FALSE,
+            billing_period TEXT -- 'YYYY-MM' of monthly_generations_count, older periods count as 0
         )
     ''')
     conn.commit()
+    apply_migrations(conn)
     conn.close()
 
+# Schema changes for databases created before the column/index existed.
+# Each migration is idempotent and runs at startup.
+def _migration_add_billing_period(conn):
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(users)")]
+    if "billing_period" not in columns:
+        conn.execute("ALTER TABLE users ADD COLUMN billing_period TEXT")
+        # Existing counters belong to the current month
+        conn.execute("UPDATE users SET billing_period = ? WHERE billing_period IS NULL", (current_billing_period(),))
+
+def _migration_index_paypal_subscription_id(conn):
+    # Webhooks look users up by their PayPal subscription id
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_paypal_subscription_id ON users (paypal_subscription_id)")
+
+def _migration_create_webhook_events(conn):
+    # Raw PayPal events, stored before acknowledging and applied by the webhook worker
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS paypal_webhook_events (
+            event_id TEXT PRIMARY KEY, -- PayPal event id, deduplicates redeliveries
+            event_type TEXT,
+            payload TEXT NOT NULL,
+            received_at REAL NOT NULL,
+            processed_at REAL,
+            attempts INTEGER DEFAULT 0,
+            last_error TEXT
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_paypal_webhook_events_pending ON paypal_webhook_events (processed_at, received_at)")
+
+def _migration_create_rate_limit_buckets(conn):
+    # Token buckets of the per-key rate limiter, shared by every uvicorn worker
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS rate_limit_buckets (
+            bucket_key TEXT PRIMARY KEY,
+            tokens REAL NOT NULL,
+            updated_at REAL NOT NULL
+        ) WITHOUT ROWID
+    ''')
+
+def _migration_create_generation_history(conn):
+    # Generated ideas and store-setup texts, per user, with an FTS5 index (kept in sync by triggers)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS generation_history (
+            id INTEGER PRIMARY KEY,
+            api_key TEXT NOT NULL,
+            kind TEXT NOT NULL, -- 'product' ou 'store_setup'
+            niche TEXT NOT NULL,
+            persona TEXT, -- persona (produits) ou public cible (boutique)
+            store_type TEXT,
+            assistance_type TEXT,
+            details TEXT,
+            fields TEXT, -- JSON des champs demandés (produits)
+            num_ideas INTEGER,
+            output TEXT NOT NULL, -- JSON des idées (produits) ou texte généré (boutique)
+            prompt_version TEXT,
+            created_at REAL NOT NULL
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_generation_history_user ON generation_history (api_key, created_at)")
+    # Porter stemming so that "mats" matches "mat"; accents are ignored
+    conn.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS generation_history_fts USING fts5(
+            niche, persona, output,
+            content='generation_history', content_rowid='id',
+            tokenize='porter unicode61 remove_diacritics 2'
+        )
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS generation_history_fts_insert AFTER INSERT ON generation_history BEGIN
+            INSERT INTO generation_history_fts (rowid, niche, persona, output) VALUES (new.id, new.niche, new.persona, new.output);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS generation_history_fts_delete AFTER DELETE ON generation_history BEGIN
+            INSERT INTO generation_history_fts (generation_history_fts, rowid, niche, persona, output) VALUES ('delete', old.id, old.niche, old.persona, old.output);
+        END
+    ''')
+
+def _migration_create_idempotency_keys(conn):
+    # Responses replayed for a repeated Idempotency-Key, per API key (see IdempotencyMiddleware)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS idempotency_keys (
+            api_key TEXT NOT NULL,
+            idempotency_key TEXT NOT NULL,
+            request_hash TEXT NOT NULL, -- SHA-256 du chemin et du corps de la requête
+            status TEXT NOT NULL, -- 'in_progress' ou 'completed'
+            response_status INTEGER,
+            response_headers TEXT, -- JSON
+            response_body BLOB,
+            created_at REAL NOT NULL,
+            expires_at REAL NOT NULL, -- fin du verrou (in_progress) ou de la conservation (completed)
+            PRIMARY KEY (api_key, idempotency_key)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_idempotency_keys_expires_at ON idempotency_keys (expires_at)")
+
+MIGRATIONS = [
+    _migration_add_billing_period,
+    _migration_index_paypal_subscription_id,
+    _migration_create_webhook_events,
+    _migration_create_rate_limit_buckets,
+    _migration_create_generation_history,
+    _migration_create_idempotency_keys,
+]
+
+def apply_migrations(conn):
+    if conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'users'").fetchone() is None:
+        return
+    for migration in MIGRATIONS:
+        migration(conn)
+    conn.commit()
+
 # Initialize the database when the app starts
-# NOTE: This init_db() call here will create/update the DB file in your Drive
-# if you run this cell. On Cloud Run, this part runs when the container starts.
-# For deployment, you need to ensure your Cloud Run service can write to /app
+# NOTE: init_db() runs in the lifespan (see lifespan above), once per worker when the server starts,
+# not at import: importing this module (notebook, benchmark seeding) does not create/modify dropia.db.
+# On Cloud Run it runs when the container starts: the service must be able to write to /app,
 # or use a persistent volume if you need the DB to survive container restarts.
-# For this deployment step, the focus is getting the code files to GitHub.
-# init_db() # Commenting this out to avoid creating/modifying dropia.db in Drive during file generation
 
 
-def get_db():
-    conn = sqlite3.connect(DATABASE_URL)
+# Connection pool
+# Les connexions sont ouvertes une seule fois (au démarrage) en mode WAL : les lectures ne sont pas
+# bloquées par les UPDATE users, et le cache de requêtes préparées de chaque connexion reste chaud.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+DB_POOL_MAX_OVERFLOW = int(os.getenv("DB_POOL_MAX_OVERFLOW", "32"))
+DB_POOL_TIMEOUT_SECONDS = float(os.getenv("DB_POOL_TIMEOUT_SECONDS", "5"))
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", "16384"))
+DB_MMAP_SIZE_BYTES = int(os.getenv("DB_MMAP_SIZE_BYTES", str(64 * 1024 * 1024)))
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "256"))
+
+
+def create_db_connection():
+    # Sync dependencies run in the threadpool while the async endpoints use the connection
+    # on the event loop thread, so the connection must not be pinned to its creating thread.
+    conn = sqlite3.connect(DATABASE_URL, check_same_thread=False, cached_statements=DB_STATEMENT_CACHE_SIZE)
     conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL") # Safe with WAL, avoids an fsync per commit
+    conn.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KB}")
+    conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE_BYTES}")
+    conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
+
+class SQLitePool:
+    # Connections are only held for short synchronous blocks (auth miss, rate limit, writes), never across
+    # an OpenAI or PayPal await; bursts above `size` get temporary overflow connections (closed on release).
+    def __init__(self, size, max_overflow):
+        self.size = size
+        self.max_overflow = max_overflow
+        self._idle = queue.LifoQueue(maxsize=size) # LIFO keeps the most recently used (warmest) connections busy
+        self._lock = threading.Lock()
+        self._overflow = 0
+        self._in_use = 0
+        for _ in range(size):
+            self._idle.put(create_db_connection())
+
+    def acquire(self, timeout=DB_POOL_TIMEOUT_SECONDS):
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = None
+            with self._lock:
+                if self._overflow < self.max_overflow:
+                    self._overflow += 1
+                    create_overflow = True
+                else:
+                    create_overflow = False
+            if create_overflow:
+                try:
+                    conn = create_db_connection()
+                except Exception:
+                    with self._lock:
+                        self._overflow -= 1
+                    raise
+            else:
+                try:
+                    conn = self._idle.get(timeout=timeout)
+                except queue.Empty:
+                    raise HTTPException(status_code=503, detail="Base de données saturée, veuillez réessayer.")
+        with self._lock:
+            self._in_use += 1
+        return conn
+
+    def release(self, conn):
+        # Never hand out a connection with a transaction left open by a failed request
+        if conn.in_transaction:
+            conn.rollback()
+        with self._lock:
+            self._in_use -= 1
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+            with self._lock:
+                self._overflow -= 1
+
+    def in_use(self):
+        return self._in_use
+
+    def stats(self):
+        with self._lock:
+            return {"size": self.size, "in_use": self._in_use, "idle": self._idle.qsize(), "overflow": self._overflow, "max_overflow": self.max_overflow}
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+db_pool = None
+_db_pool_lock = threading.Lock()
+
+def get_db_pool():
+    global db_pool
+    if db_pool is None:
+        with _db_pool_lock:
+            if db_pool is None:
+                db_pool = SQLitePool(DB_POOL_SIZE, DB_POOL_MAX_OVERFLOW)
+    return db_pool
+
+def open_paypal_client():
+    # Off by default: the PayPal SDK is then only imported by the first billing request, not on cold start
+    if not PAYPAL_PREFETCH_TOKEN or not PAYPAL_CLIENT_ID or not PAYPAL_CLIENT_SECRET:
+        return
+
+    async def prefetch_token():
+        # Fetch the OAuth token ahead of the first /subscribe; a failure here is retried by that request
+        try:
+            client = await run_paypal_call(get_paypal_client)
+            await run_paypal_call(client.get_token_hash)
+        except Exception as e:
+            log.warning("paypal_token_prefetch_failed", "Impossible d'obtenir le jeton OAuth PayPal au démarrage", error=str(e))
+
+    asyncio.create_task(prefetch_token())
+
+def close_paypal_client():
+    global paypal_client, _paypal_executor
+    if _paypal_executor is not None:
+        _paypal_executor.shutdown(wait=True)
+        _paypal_executor = None
+    if paypal_client is not None:
+        paypal_client.close()
+        paypal_client = None
+
+def close_db_pool():
+    global db_pool
+    # Write-behind quota increments must reach the database before its connections go away
+    if _quota_flush_task is not None:
+        _quota_flush_task.cancel()
+    quota_manager.flush()
+    if _webhook_worker_task is not None:
+        _webhook_worker_task.cancel()
+        process_webhook_batch() # Apply what was acknowledged but not processed yet
+    if db_pool is not None:
+        db_pool.close()
+        db_pool = None
+
+
+def get_db():
+    # Only for sync routes (/history): async endpoints take a short-lived db_connection() block instead,
+    # so a pooled connection is never held while a request awaits OpenAI or PayPal
+    pool = get_db_pool()
+    with metrics.stage("db_acquire"):
+        conn = pool.acquire()
     try:
-        yield conn # Corrected 'connconng' to 'conn'
+        yield conn
     finally:
-        conn.close()
+        pool.release(conn)
+
+# Same connection lifecycle as get_db, for short blocks outside of the request dependencies
+db_connection = contextmanager(get_db)
 
 subscription_plans = {
     "Gratuit": {
         "description": "Accès limité à la génération d'idées de produits.",
         "monthly_generations_limit": 5,
+        "rate_limit": {"requests_per_minute": 6, "burst": 3}, # Appels aux endpoints IA
         "features": ["Génération de produit de base"]
     },
     "Premium": {
         "description": "Accès illimité à la génération d'idées et fonctionnalités supplémentaires.",
         "monthly_generations_limit": -1,
+        "rate_limit": {"requests_per_minute": 60, "burst": 20},
         "features": ["Génération de produit illimitée", "Accès aux fonctionnalités premium", "Assistance IA à la création de boutique"],
-        "paypal_plan_id": "P-14D73578B05390914NCFMMSI" # Votre ID de plan PayPal - REMPLACEZ CECI
+        "paypal_plan_id": os.getenv("PAYPAL_PREMIUM_PLAN_ID", "P-14D73578B05390914NCFMMSI") # Votre ID de plan PayPal - REMPLACEZ CECI (ou PAYPAL_PREMIUM_PLAN_ID)
     }
 }
 
@@ -109,6 +1365,10 @@ class ProductPrompt(BaseModel):
     presence_penalty: float = Field(0.0, description="Diminue la probabilité que le modèle parle de nouveaux sujets (entre -2.0 et 2.0).")
     # Add optional parameter to specify desired fields
     fields: Optional[List[str]] = Field(None, description="Liste des champs souhaités dans la réponse (ex: ['nom_produit', 'description_courte']). Si vide ou nulle, tous les champs sont inclus.")
+    # Optional reuse of a close generation from the user's history instead of a new completion
+    reuse_similar: bool = Field(False, description="Servir une génération précédente proche (mêmes champs, niche et persona similaires) au lieu d'appeler le modèle.")
+    similarity_threshold: Optional[float] = Field(None, description="Similarité minimale (entre 0 et 1) pour réutiliser une génération précédente. Par défaut : HISTORY_REUSE_MIN_SIMILARITY.")
+    generation_mode: Optional[str] = Field(None, description="'single' (une complétion pour toutes les idées), 'parallel' (une complétion par idée, en parallèle) ou 'n' (une requête, n réponses). Par défaut : GENERATION_SPLIT_MODE.")
 
 class StoreSetupPrompt(BaseModel):
     store_type: str = Field(..., description="Le type de boutique e-commerce (ex: dropshipping, marque privée, artisanale).")
@@ -116,23 +1376,1090 @@ class StoreSetupPrompt(BaseModel):
     target_audience: str = Field(..., description="La description détaillée du public cible.")
     assistance_type: str = Field(..., description="Le type d'assistance IA demandé (ex: 'generate_about_us', 'suggest_branding', 'faq_content').")
     details: Optional[str] = Field(None, description="Détails supplémentaires ou contexte pour l'assistance demandée.")
+    reuse_similar: bool = Field(False, description="Servir un texte précédent proche (même type d'assistance, niche et public cible similaires, sans détails) au lieu d'appeler le modèle.")
+    similarity_threshold: Optional[float] = Field(None, description="Similarité minimale (entre 0 et 1) pour réutiliser un texte précédent. Par défaut : HISTORY_REUSE_MIN_SIMILARITY.")
+
+class StoreSetupBundlePrompt(BaseModel):
+    store_type: str = Field(..., description="Le type de boutique e-commerce (ex: dropshipping, marque privée, artisanale).")
+    niche: str = Field(..., description="La niche principale de la boutique.")
+    target_audience: str = Field(..., description="La description détaillée du public cible.")
+    assistance_types: List[str] = Field(..., description="Les types d'assistance IA demandés, générés en parallèle (ex: ['generate_about_us', 'suggest_branding', 'faq_content']).")
+    details: Optional[str] = Field(None, description="Détails supplémentaires ou contexte, communs à toutes les sections.")
+
+class BatchProductPrompt(BaseModel):
+    prompts: List[ProductPrompt] = Field(..., description="Liste des demandes de génération. Les demandes identiques ne sont générées qu'une seule fois.")
+    max_concurrency: Optional[int] = Field(None, description="Nombre maximum de générations simultanées pour ce lot (plafonné par la configuration du serveur).")
 
 
 class SubscribeRequest(BaseModel):
     plan_name: str
 
-def get_current_user(api_key: str = Header(...), db: sqlite3.Connection = Depends(get_db)):
-    cursor = db.cursor()
-    cursor.execute('SELECT * FROM users WHERE api_key = ?', (api_key,))
-    user = cursor.fetchone()
+# Cache d'authentification
+# Les lignes users sont gardées en mémoire par clé API; les clés invalides sont aussi mises en cache
+# (cache négatif) pour amortir les tentatives de force brute. Chaque écriture sur users dans ce
+# processus invalide ou rafraîchit l'entrée; le TTL borne la fraîcheur entre workers uvicorn.
+AUTH_CACHE_MAX_ENTRIES = int(os.getenv("AUTH_CACHE_MAX_ENTRIES", "10000"))
+AUTH_CACHE_TTL_SECONDS = float(os.getenv("AUTH_CACHE_TTL_SECONDS", "60"))
+AUTH_NEGATIVE_CACHE_MAX_ENTRIES = int(os.getenv("AUTH_NEGATIVE_CACHE_MAX_ENTRIES", "50000"))
+AUTH_NEGATIVE_CACHE_TTL_SECONDS = float(os.getenv("AUTH_NEGATIVE_CACHE_TTL_SECONDS", "30"))
+
+auth_cache = LRUTTLCache(AUTH_CACHE_MAX_ENTRIES, AUTH_CACHE_TTL_SECONDS)
+invalid_api_key_cache = LRUTTLCache(AUTH_NEGATIVE_CACHE_MAX_ENTRIES, AUTH_NEGATIVE_CACHE_TTL_SECONDS)
+
+def invalidate_cached_user(api_key):
+    auth_cache.pop(api_key)
+
+def get_current_user(api_key: str = Header(...)):
+    with metrics.stage("auth"):
+        return _authenticate(api_key)
+
+def _authenticate(api_key):
+    cached_user = auth_cache.get(api_key)
+    if cached_user is not None:
+        return dict(cached_user) # Copy so a handler can never alter the cached row
+    if invalid_api_key_cache.get(api_key) is not None:
+        raise HTTPException(status_code=401, detail="Clé API invalide")
+
+    # Short-lived connection: it goes back to the pool before the endpoint awaits OpenAI or PayPal
+    with db_connection() as db:
+        user = db.execute('SELECT * FROM users WHERE api_key = ?', (api_key,)).fetchone()
     if user is None:
+        invalid_api_key_cache.set(api_key, True)
         raise HTTPException(status_code=401, detail="Clé API invalide")
+    user = dict(user)
+    auth_cache.set(api_key, user)
     return dict(user)
 
-@app.post("/generate-product")
-async def generate_product(data: ProductPrompt, current_user: dict = Depends(get_current_user), db: sqlite3.Connection = Depends(get_db)):
+# Quota accounting
+# Plans limités (Gratuit) : la réservation est un UPDATE conditionnel dans la table users
+# (check-and-reserve atomique), donc la limite tient aussi avec plusieurs workers uvicorn ; les
+# remboursements sont des décréments différés. Plans illimités : rien à vérifier, les générations
+# sont comptées en mémoire. Dans les deux cas, les incréments restants sont regroupés et écrits par
+# lots toutes les QUOTA_FLUSH_INTERVAL_SECONDS. Le compteur mensuel est remis à zéro paresseusement :
+# une ligne dont billing_period n'est pas le mois courant compte pour 0.
+QUOTA_FLUSH_INTERVAL_SECONDS = float(os.getenv("QUOTA_FLUSH_INTERVAL_SECONDS", "2"))
+QUOTA_ACCOUNT_IDLE_SECONDS = float(os.getenv("QUOTA_ACCOUNT_IDLE_SECONDS", "300"))
+
+def current_billing_period():
+    return time.strftime("%Y-%m", time.gmtime())
+
+
+class QuotaExceededError(Exception):
+    def __init__(self, remaining):
+        super().__init__(f"Quota dépassé, {remaining} restant(s)")
+        self.remaining = remaining
+
+
+class QuotaReservation:
+    def __init__(self, api_key, period, amount, stored_count=None):
+        self.api_key = api_key
+        self.period = period
+        self.amount = amount
+        self.stored_count = stored_count # Counter after the reservation, when it was written to the database
+        self.settled = False
+
+
+class QuotaManager:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._accounts = {}
+
+    def _account(self, user, period):
+        api_key = user["api_key"]
+        stored = (user.get("monthly_generations_count") or 0) if user.get("billing_period") == period else 0
+        account = self._accounts.get(api_key)
+        if account is None or account["period"] != period:
+            # First use in this process, or a new billing period: the counter restarts lazily
+            account = {"period": period, "used": stored, "reserved": 0, "pending": 0}
+            self._accounts[api_key] = account
+        elif account["reserved"] == 0 and account["pending"] == 0:
+            # Nothing in flight here, pick up increments flushed by other workers
+            account["used"] = max(account["used"], stored)
+        account["touched"] = time.monotonic()
+        return account
+
+    # The limit is checked against the row itself, not this process' view of it: two workers can never
+    # both take the last generations. Counts pending in this process are included in the check.
+    RESERVE_SQL = '''
+        UPDATE users SET
+            monthly_generations_count = (CASE WHEN billing_period = :period THEN COALESCE(monthly_generations_count, 0) ELSE 0 END) + :amount,
+            billing_period = :period
+        WHERE api_key = :api_key
+          AND (CASE WHEN billing_period = :period THEN COALESCE(monthly_generations_count, 0) ELSE 0 END) + :pending + :amount <= :limit
+    '''
+
+    def reserve(self, user, amount, limit):
+        # Blocking for limited plans (SQLite UPDATE): reserve_generation_quota runs it in the threadpool
+        period = current_billing_period()
+        if limit == -1:
+            with self._lock:
+                account = self._account(user, period)
+                account["reserved"] += amount
+            return QuotaReservation(user["api_key"], period, amount)
+
+        with self._lock:
+            pending = self._account(user, period)["pending"]
+        with db_connection() as conn, metrics.stage("quota_reserve"):
+            cursor = conn.execute(self.RESERVE_SQL, {"api_key": user["api_key"], "period": period, "amount": amount, "pending": pending, "limit": limit})
+            row = conn.execute('SELECT monthly_generations_count, billing_period FROM users WHERE api_key = ?', (user["api_key"],)).fetchone()
+            conn.commit()
+        stored = (row["monthly_generations_count"] or 0) if row is not None and row["billing_period"] == period else 0
+        if cursor.rowcount != 1:
+            raise QuotaExceededError(max(limit - stored - pending, 0))
+        with self._lock:
+            account = self._account(user, period)
+            account["reserved"] += amount
+            account["used"] = stored + account["pending"]
+        return QuotaReservation(user["api_key"], period, amount, stored_count=stored)
+
+    def commit(self, reservation, amount=None):
+        # The reserved generations are now consumed and will be written by the next flush.
+        # With `amount`, only that part is charged and the rest of the reservation is released.
+        consumed = reservation.amount if amount is None else max(0, min(amount, reservation.amount))
+        with self._lock:
+            if reservation.settled:
+                return None
+            reservation.settled = True
+            account = self._accounts.get(reservation.api_key)
+            if account is None or account["period"] != reservation.period:
+                return None
+            account["reserved"] -= reservation.amount
+            if reservation.stored_count is not None:
+                # Already counted in the database: only the released part is given back, by the next flush
+                account["pending"] -= reservation.amount - consumed
+                account["used"] = reservation.stored_count + account["pending"]
+                return account["used"]
+            account["used"] += consumed
+            account["pending"] += consumed
+            return account["used"]
+
+    def refund(self, reservation):
+        with self._lock:
+            if reservation.settled:
+                return
+            reservation.settled = True
+            account = self._accounts.get(reservation.api_key)
+            if account is not None and account["period"] == reservation.period:
+                account["reserved"] -= reservation.amount
+                if reservation.stored_count is not None:
+                    account["pending"] -= reservation.amount
+
+    def stats(self):
+        with self._lock:
+            return {
+                "accounts": len(self._accounts),
+                "reserved": sum(account["reserved"] for account in self._accounts.values()),
+                "pending": sum(account["pending"] for account in self._accounts.values()),
+            }
+
+    def reset(self, api_key):
+        # The counter was reset in the database (e.g. subscription activated), drop the local state
+        with self._lock:
+            self._accounts.pop(api_key, None)
+
+    def flush(self):
+        with self._lock:
+            batch = [(key, account["period"], account["pending"]) for key, account in self._accounts.items() if account["pending"]]
+            for key, _, _ in batch:
+                self._accounts[key]["pending"] = 0
+            idle_before = time.monotonic() - QUOTA_ACCOUNT_IDLE_SECONDS
+            for key in [k for k, a in self._accounts.items() if not a["pending"] and not a["reserved"] and a["touched"] < idle_before]:
+                del self._accounts[key]
+        if not batch:
+            return 0
+
+        try:
+            with db_connection() as conn, metrics.stage("quota_flush"):
+                # Relative increments, so workers flushing the same user never overwrite each other
+                conn.executemany(
+                    # (refunds of limited plans are negative deltas, hence the MAX)
+                    'UPDATE users SET monthly_generations_count = MAX(0, CASE WHEN billing_period = ? THEN COALESCE(monthly_generations_count, 0) + ? ELSE ? END), billing_period = ? WHERE api_key = ?',
+                    [(period, delta, delta, period, key) for key, period, delta in batch]
+                )
+                conn.commit()
+        except Exception as e:
+            log.error("quota_flush_failed", "Erreur lors de l'écriture des compteurs de génération", error=str(e))
+            with self._lock:
+                for key, period, delta in batch:
+                    account = self._accounts.get(key)
+                    if account is not None and account["period"] == period:
+                        account["pending"] += delta
+            return 0
+        return len(batch)
+
+
+quota_manager = QuotaManager()
+_quota_flush_task = None
+
+async def quota_flush_loop():
+    while True:
+        await asyncio.sleep(QUOTA_FLUSH_INTERVAL_SECONDS)
+        await asyncio.to_thread(quota_manager.flush)
+
+def start_quota_flusher():
+    global _quota_flush_task
+    _quota_flush_task = asyncio.create_task(quota_flush_loop())
+
+async def reserve_generation_quota(current_user, amount):
     user_plan = current_user.get("plan")
     plan_details = subscription_plans.get(user_plan)
+    limit = plan_details["monthly_generations_limit"] if plan_details else -1
+    try:
+        if limit == -1:
+            return quota_manager.reserve(current_user, amount, limit) # In memory only
+        return await asyncio.to_thread(quota_manager.reserve, current_user, amount, limit)
+    except QuotaExceededError as e:
+        raise HTTPException(status_code=429, detail=f"Limite de génération ({limit} par mois) atteinte pour votre plan {user_plan}. Vous pouvez encore générer {e.remaining} idée(s). Veuillez passer à un plan supérieur pour des générations illimitées.")
+
+
+# Admission control
+# Deux protections devant les endpoints IA, vérifiées avant tout appel à OpenAI :
+# - un token bucket par clé API (débit et rafale du plan, "rate_limit" dans subscription_plans) -> 429.
+#   RATE_LIMIT_BACKEND=sqlite partage les buckets entre workers uvicorn via la base, "memory" les garde
+#   dans le processus, "off" désactive la limite.
+# - une file d'attente bornée par worker : au plus ADMISSION_MAX_IN_FLIGHT requêtes IA en cours, les
+#   suivantes attendent leur tour. Une requête est rejetée tout de suite (503) quand la file est pleine
+#   ou que l'attente estimée dépasse ADMISSION_QUEUE_TIMEOUT_SECONDS, plutôt qu'après le délai.
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "sqlite").lower()
+ADMISSION_MAX_IN_FLIGHT = int(os.getenv("ADMISSION_MAX_IN_FLIGHT", "64"))
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "256"))
+ADMISSION_QUEUE_TIMEOUT_SECONDS = float(os.getenv("ADMISSION_QUEUE_TIMEOUT_SECONDS", "10"))
+
+
+class SQLiteRateLimiter:
+    # One UPSERT per request: refill since updated_at, then take `cost` tokens only if enough are available
+    CONSUME_SQL = '''
+        INSERT INTO rate_limit_buckets (bucket_key, tokens, updated_at) VALUES (:key, :burst - :cost, :now)
+        ON CONFLICT(bucket_key) DO UPDATE SET
+            tokens = MIN(:burst, tokens + MAX(0, :now - updated_at) * :rate) - :cost,
+            updated_at = :now
+        WHERE MIN(:burst, tokens + MAX(0, :now - updated_at) * :rate) >= :cost
+    '''
+
+    def __init__(self):
+        self.rejected = 0
+
+    def consume(self, key, rate, burst, cost=1):
+        # Returns 0 when admitted, otherwise the seconds to wait before `cost` tokens are available
+        now = time.time()
+        with db_connection() as db:
+            cursor = db.execute(self.CONSUME_SQL, {"key": key, "burst": burst, "cost": cost, "now": now, "rate": rate})
+            admitted = cursor.rowcount == 1
+            if not admitted:
+                row = db.execute('SELECT tokens, updated_at FROM rate_limit_buckets WHERE bucket_key = ?', (key,)).fetchone()
+            db.commit()
+        if admitted:
+            return 0
+        self.rejected += 1
+        available = min(burst, row["tokens"] + max(0, now - row["updated_at"]) * rate)
+        return max(0.0, (cost - available) / rate)
+
+    def stats(self):
+        return {"backend": "sqlite", "rejected": self.rejected}
+
+
+class MemoryRateLimiter:
+    # Same buckets kept in this process only (one limit per worker)
+    def __init__(self, max_entries=100000):
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict() # key -> [tokens, updated_at], least recently used first
+        self.max_entries = max_entries
+        self.rejected = 0
+
+    def consume(self, key, rate, burst, cost=1):
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.pop(key, None) or [burst, now]
+            tokens = min(burst, bucket[0] + max(0, now - bucket[1]) * rate)
+            self._buckets[key] = bucket
+            if len(self._buckets) > self.max_entries:
+                self._buckets.popitem(last=False)
+            bucket[1] = now
+            if tokens >= cost:
+                bucket[0] = tokens - cost
+                return 0
+            bucket[0] = tokens
+            self.rejected += 1
+            return (cost - tokens) / rate
+
+    def stats(self):
+        with self._lock:
+            return {"backend": "memory", "rejected": self.rejected, "buckets": len(self._buckets)}
+
+
+RATE_LIMIT_BACKENDS = {"sqlite": SQLiteRateLimiter, "memory": MemoryRateLimiter, "off": lambda: None}
+
+if RATE_LIMIT_BACKEND not in RATE_LIMIT_BACKENDS:
+    # Only an explicit "off" disables the limit, a typo must not
+    log.warning("config_invalid", "RATE_LIMIT_BACKEND non reconnu, utilisation de 'sqlite'.", setting="RATE_LIMIT_BACKEND", value=RATE_LIMIT_BACKEND)
+    RATE_LIMIT_BACKEND = "sqlite"
+
+rate_limiter = RATE_LIMIT_BACKENDS[RATE_LIMIT_BACKEND]()
+
+def plan_rate_limit(user_plan):
+    plan_details = subscription_plans.get(user_plan) or subscription_plans["Gratuit"]
+    rate_limit = plan_details.get("rate_limit") or subscription_plans["Gratuit"]["rate_limit"]
+    return rate_limit["requests_per_minute"] / 60.0, rate_limit["burst"]
+
+def consume_rate_limit(current_user, cost=1):
+    # Blocking (SQLite UPSERT): call it from a sync dependency or through asyncio.to_thread.
+    # Raises a 429 when the plan's bucket does not hold `cost` tokens.
+    if rate_limiter is None:
+        return
+    rate, burst = plan_rate_limit(current_user.get("plan"))
+    with metrics.stage("rate_limit"):
+        retry_after = rate_limiter.consume(current_user["api_key"], rate, burst, min(cost, burst))
+    if retry_after:
+        retry_after = math.ceil(retry_after)
+        raise HTTPException(
+            status_code=429,
+            detail=f"Trop de requêtes pour votre plan {current_user.get('plan')}. Veuillez réessayer dans {retry_after} seconde(s).",
+            headers={"Retry-After": str(retry_after)},
+        )
+
+def rate_limited_user(current_user: dict = Depends(get_current_user)):
+    # Sync dependency, so the bucket UPSERT runs in the threadpool and never blocks the event loop
+    consume_rate_limit(current_user)
+    return current_user
+
+
+class AdmissionRejectedError(Exception):
+    def __init__(self, retry_after, reason):
+        super().__init__(reason)
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class AdmissionTicket:
+    def __init__(self, controller):
+        self._controller = controller
+        self._started = time.monotonic()
+        self._released = False
+
+    def release(self):
+        # Idempotent: streamed responses release from the generator and from a background task
+        if not self._released:
+            self._released = True
+            self._controller._release(time.monotonic() - self._started)
+
+
+class AdmissionController:
+    # Bounded FIFO in front of the AI endpoints, per worker. The expected wait is estimated from the
+    # recent service time, so requests that would time out in the queue are shed on arrival.
+    def __init__(self, max_in_flight, max_queue, queue_timeout):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._in_flight = 0
+        self._waiters = deque()
+        self._service_time = None # moving average, seconds
+        self.admitted = 0
+        self.shed = 0
+        self.timed_out = 0
+
+    def expected_wait(self, position):
+        if self._service_time is None:
+            return 0.0
+        return position * self._service_time / self.max_in_flight
+
+    def _reject(self, retry_after, reason):
+        self.shed += 1
+        raise AdmissionRejectedError(max(1.0, retry_after), reason)
+
+    async def acquire(self):
+        if self._in_flight < self.max_in_flight and not self._waiters:
+            self._in_flight += 1
+            self.admitted += 1
+            return AdmissionTicket(self)
+        if len(self._waiters) >= self.max_queue:
+            self._reject(self.expected_wait(len(self._waiters)), "file d'attente pleine")
+        expected_wait = self.expected_wait(len(self._waiters) + 1)
+        if expected_wait > self.queue_timeout:
+            self._reject(expected_wait, "attente estimée trop longue")
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.queue_timeout)
+        except BaseException as e:
+            if waiter.done() and not waiter.cancelled():
+                self._release(None) # The slot was handed over just as we gave up: pass it on
+            else:
+                waiter.cancel()
+            try:
+                self._waiters.remove(waiter)
+            except ValueError:
+                pass
+            if isinstance(e, asyncio.TimeoutError):
+                self.timed_out += 1
+                self._reject(self.expected_wait(len(self._waiters)), "délai d'attente dépassé")
+            raise
+        self.admitted += 1
+        return AdmissionTicket(self)
+
+    def _release(self, service_time):
+        if service_time is not None:
+            self._service_time = service_time if self._service_time is None else 0.9 * self._service_time + 0.1 * service_time
+        # Hand the slot to the oldest waiter still waiting, in_flight stays the same
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self._in_flight -= 1
+
+    def stats(self):
+        return {"in_flight": self._in_flight, "queued": len(self._waiters), "admitted": self.admitted, "shed": self.shed, "timed_out": self.timed_out}
+
+
+admission_controller = AdmissionController(ADMISSION_MAX_IN_FLIGHT, ADMISSION_MAX_QUEUE, ADMISSION_QUEUE_TIMEOUT_SECONDS)
+
+async def acquire_admission():
+    try:
+        with metrics.stage("admission_queue"):
+            return await admission_controller.acquire()
+    except AdmissionRejectedError as e:
+        retry_after = math.ceil(e.retry_after)
+        raise HTTPException(
+            status_code=503,
+            detail=f"Le service est surchargé ({e.reason}). Veuillez réessayer dans {retry_after} seconde(s).",
+            headers={"Retry-After": str(retry_after)},
+        )
+
+async def admission_slot():
+    # Slot in the admission queue for the duration of the request
+    ticket = await acquire_admission()
+    try:
+        yield ticket
+    finally:
+        ticket.release()
+
+async def admitted_user(ticket: AdmissionTicket = Depends(admission_slot), current_user: dict = Depends(rate_limited_user)):
+    # Admission first (dependencies are solved in order): excess load is shed before auth and the rate
+    # limit touch the connection pool. Auth failures and 429s give their slot back right away.
+    return current_user
+
+
+# Idempotence
+# L'application mobile renvoie ses requêtes sur un réseau instable : un POST répété avec le même en-tête
+# Idempotency-Key (pour la même clé API) reçoit la réponse de la première exécution, sans nouvel appel
+# OpenAI/PayPal ni nouvelle génération décomptée. Un doublon qui arrive pendant l'exécution d'origine l'attend.
+IDEMPOTENCY_ENABLED = os.getenv("IDEMPOTENCY_ENABLED", "true").lower() == "true"
+IDEMPOTENCY_TTL_SECONDS = float(os.getenv("IDEMPOTENCY_TTL_SECONDS", "86400")) # Durée de conservation d'une réponse
+IDEMPOTENCY_MAX_ENTRIES = int(os.getenv("IDEMPOTENCY_MAX_ENTRIES", "100000")) # Au-delà, les réponses les plus anciennes sont purgées
+IDEMPOTENCY_LOCK_TIMEOUT_SECONDS = float(os.getenv("IDEMPOTENCY_LOCK_TIMEOUT_SECONDS", "120")) # Exécution d'origine sans réponse (worker arrêté) : reprise possible
+IDEMPOTENCY_WAIT_TIMEOUT_SECONDS = float(os.getenv("IDEMPOTENCY_WAIT_TIMEOUT_SECONDS", "60")) # Attente maximale d'un doublon, sinon 409
+IDEMPOTENCY_POLL_INTERVAL_SECONDS = float(os.getenv("IDEMPOTENCY_POLL_INTERVAL_SECONDS", "0.1")) # Exécution d'origine dans un autre worker
+IDEMPOTENCY_MAX_RESPONSE_BYTES = int(os.getenv("IDEMPOTENCY_MAX_RESPONSE_BYTES", "1048576"))
+IDEMPOTENCY_PURGE_INTERVAL_SECONDS = 60
+IDEMPOTENT_PATHS = ("/generate-product", "/assist-store-setup", "/assist-store-setup/bundle", "/subscribe")
+
+_idempotency_last_purge = 0.0
+
+
+def purge_idempotency_keys(conn, now):
+    global _idempotency_last_purge
+    if now - _idempotency_last_purge < IDEMPOTENCY_PURGE_INTERVAL_SECONDS:
+        return
+    _idempotency_last_purge = now
+    conn.execute('DELETE FROM idempotency_keys WHERE expires_at < ?', (now,))
+    excess = conn.execute('SELECT COUNT(*) FROM idempotency_keys').fetchone()[0] - IDEMPOTENCY_MAX_ENTRIES
+    if excess > 0:
+        conn.execute(
+            'DELETE FROM idempotency_keys WHERE (api_key, idempotency_key) IN '
+            "(SELECT api_key, idempotency_key FROM idempotency_keys WHERE status = 'completed' ORDER BY expires_at LIMIT ?)",
+            (excess,)
+        )
+
+def claim_idempotency_key(api_key, key, request_hash):
+    # Returns ("execute", None), ("replay", row), ("mismatch", None) or ("wait", None).
+    # BEGIN IMMEDIATE: two workers can never both claim the same key.
+    now = time.time()
+    with db_connection() as conn, metrics.stage("idempotency"):
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute('SELECT * FROM idempotency_keys WHERE api_key = ? AND idempotency_key = ?', (api_key, key)).fetchone()
+            if row is None or row["expires_at"] < now:
+                # New key, expired response, or an original execution that died without answering
+                conn.execute(
+                    "INSERT OR REPLACE INTO idempotency_keys (api_key, idempotency_key, request_hash, status, created_at, expires_at) VALUES (?, ?, ?, 'in_progress', ?, ?)",
+                    (api_key, key, request_hash, now, now + IDEMPOTENCY_LOCK_TIMEOUT_SECONDS)
+                )
+                purge_idempotency_keys(conn, now)
+                conn.commit()
+                return "execute", None
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    if row["request_hash"] != request_hash:
+        return "mismatch", None
+    if row["status"] == "completed":
+        return "replay", row
+    return "wait", None
+
+def complete_idempotency_key(api_key, key, status, headers, body):
+    with db_connection() as conn, metrics.stage("idempotency"):
+        conn.execute(
+            "UPDATE idempotency_keys SET status = 'completed', response_status = ?, response_headers = ?, response_body = ?, expires_at = ? WHERE api_key = ? AND idempotency_key = ?",
+            (status, json.dumps(headers), body, time.time() + IDEMPOTENCY_TTL_SECONDS, api_key, key)
+        )
+        conn.commit()
+
+def release_idempotency_key(api_key, key):
+    # The original failed (error, 4xx/5xx, client gone): the next retry executes again
+    with db_connection() as conn:
+        conn.execute("DELETE FROM idempotency_keys WHERE api_key = ? AND idempotency_key = ? AND status = 'in_progress'", (api_key, key))
+        conn.commit()
+
+
+def idempotent_response_storable(status, headers, body):
+    if status is None or not 200 <= status < 300 or len(body) > IDEMPOTENCY_MAX_RESPONSE_BYTES:
+        return False
+    # Streamed NDJSON answers (bundle) are always 200: only a complete stream whose final
+    # {"type": "done"} line reports no failed section is replayed, otherwise the retry runs again
+    if dict(headers).get("content-type", "").startswith("application/x-ndjson"):
+        try:
+            done = json.loads(body.rstrip(b"\n").rsplit(b"\n", 1)[-1])
+        except ValueError:
+            return False
+        return isinstance(done, dict) and done.get("type") == "done" and not done.get("failed")
+    return True
+
+
+class IdempotencyMiddleware:
+    # Only 2xx responses are stored: a refused request (quota, rate limit, upstream unavailable) is retried for real.
+    def __init__(self, app):
+        self.app = app
+        self._in_flight = {} # (api_key, key) -> Event set when the execution in this worker ends
+        self.stats = {"executed": 0, "replayed": 0, "waited": 0, "conflicts": 0}
+
+    async def __call__(self, scope, receive, send):
+        if not IDEMPOTENCY_ENABLED or scope["type"] != "http" or scope["method"] != "POST" or scope["path"] not in IDEMPOTENT_PATHS:
+            return await self.app(scope, receive, send)
+        headers = dict(scope["headers"])
+        key, api_key = headers.get(b"idempotency-key"), headers.get(b"api-key")
+        if key is None or api_key is None:
+            return await self.app(scope, receive, send)
+        key, api_key = key.decode("latin-1"), api_key.decode("latin-1")
+        if not 1 <= len(key) <= 255:
+            return await JSONResponse({"detail": "L'en-tête Idempotency-Key doit contenir entre 1 et 255 caractères."}, status_code=400)(scope, receive, send)
+        # Unknown keys never claim anything: the endpoint answers its 401 (from the negative cache after the first one)
+        if auth_cache.get(api_key) is None:
+            try:
+                await asyncio.to_thread(_authenticate, api_key)
+            except HTTPException:
+                return await self.app(scope, receive, send)
+
+        # The body is read once to fingerprint the request, then handed to the endpoint unchanged
+        chunks, more_body = [], True
+        while more_body:
+            message = await receive()
+            chunks.append(message.get("body", b""))
+            more_body = message.get("more_body", False)
+        body = b"".join(chunks)
+        request_hash = hashlib.sha256(scope["path"].encode("utf-8") + b"\n" + body).hexdigest()
+
+        async def replay_receive():
+            nonlocal body
+            if body is None:
+                return await receive() # http.disconnect
+            message, body = {"type": "http.request", "body": body, "more_body": False}, None
+            return message
+
+        identity = (api_key, key)
+        deadline = time.monotonic() + IDEMPOTENCY_WAIT_TIMEOUT_SECONDS
+        waited = False
+        while True:
+            outcome, row = await asyncio.to_thread(claim_idempotency_key, api_key, key, request_hash)
+            if outcome == "execute":
+                self.stats["executed"] += 1
+                return await self._execute(identity, scope, replay_receive, send)
+            if outcome == "replay":
+                self.stats["replayed"] += 1
+                log.info("idempotent_replay", "Réponse rejouée pour une requête déjà exécutée", api_key=api_key, idempotency_key=key, waited=waited)
+                stored_headers = [(name.encode("latin-1"), value.encode("latin-1")) for name, value in json.loads(row["response_headers"])]
+                await send({"type": "http.response.start", "status": row["response_status"], "headers": stored_headers + [(b"idempotent-replayed", b"true")]})
+                await send({"type": "http.response.body", "body": row["response_body"]})
+                return
+            if outcome == "mismatch":
+                self.stats["conflicts"] += 1
+                return await JSONResponse({"detail": "Cette Idempotency-Key a déjà été utilisée pour une requête différente."}, status_code=422)(scope, receive, send)
+
+            # Same request still being executed: wait for it, then replay its response (or run it if it failed)
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self.stats["conflicts"] += 1
+                return await JSONResponse({"detail": "Une requête avec cette Idempotency-Key est encore en cours. Veuillez réessayer."},
+                                          status_code=409, headers={"Retry-After": "1"})(scope, receive, send)
+            if not waited:
+                waited = True
+                self.stats["waited"] += 1
+            event = self._in_flight.get(identity)
+            if event is not None:
+                try:
+                    await asyncio.wait_for(event.wait(), timeout=remaining)
+                except asyncio.TimeoutError:
+                    pass
+            else:
+                await asyncio.sleep(min(IDEMPOTENCY_POLL_INTERVAL_SECONDS, remaining))
+
+    async def _execute(self, identity, scope, receive, send):
+        event = self._in_flight[identity] = asyncio.Event()
+        response = {"status": None, "headers": [], "body": []}
+
+        async def capture_send(message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+                response["headers"] = [(name.decode("latin-1"), value.decode("latin-1")) for name, value in message.get("headers", [])]
+            elif message["type"] == "http.response.body":
+                response["body"].append(message.get("body", b""))
+            await send(message)
+
+        stored = False
+        try:
+            await self.app(scope, receive, capture_send)
+            body = b"".join(response["body"])
+            if idempotent_response_storable(response["status"], response["headers"], body):
+                await asyncio.to_thread(complete_idempotency_key, *identity, response["status"], response["headers"], body)
+                stored = True
+        finally:
+            try:
+                if not stored:
+                    # Shielded: a cancelled request still unlocks its key (instead of leaving it locked
+                    # until its timeout), and the pool wait happens in the threadpool, not on the event loop
+                    await asyncio.shield(asyncio.to_thread(release_idempotency_key, *identity))
+            finally:
+                del self._in_flight[identity]
+                event.set()
+
+
+idempotency_middleware = None
+
+class _IdempotencyMiddlewareEntry(IdempotencyMiddleware):
+    # Keeps a handle on the instance built by Starlette, for /metrics
+    def __init__(self, app):
+        global idempotency_middleware
+        super().__init__(app)
+        idempotency_middleware = self
+
+# Innermost middleware (appended, not inserted first like add_middleware): it runs after the request id and
+# metrics middlewares, so replays and waits are timed and logged, and the stored headers carry no request id.
+app.user_middleware.append(Middleware(_IdempotencyMiddlewareEntry))
+
+
+# Define all possible fields and their descriptions for the prompt
+all_fields_description = {
+    "nom_produit": "Un nom percutant, unique et facile à retenir pour ce marché",
+    "description_courte": "1 à 3 phrases décrivant le produit et son principal avantage pour le persona, utilise un langage émotionnel et inclut un emoji pertinent",
+    "accroche_marketing": "Une phrase courte et très attrayante pour les publicités ou les réseaux sociaux, utilise un verbe d'action",
+    "avantages_client": ["Bénéfice clé 1 : Explique clairement ce que le client gagne.", "Bénéfice clé 2 : Un autre avantage concret.", "Bénéfice clé 3 : Un troisième bénéfice ou caractéristique différenciante."],
+    "public_cible_specifique": "Décris en 1-2 phrases le sous-segment précis du persona ciblé par ce produit.",
+    "probleme_resolu": "Décris en 1 phrase le problème spécifique que ce produit résout pour le persona.",
+    "idee_prix": "Une fourchette de prix suggérée, justifiée brièvement (ex: 'Entre 30€ et 50€ - prix premium justifié par la qualité')"
+}
+
+
+# Prompt templates
+# Everything that does not depend on the request is rendered once when the registry is built:
+# the JSON structure block of every valid `fields` subset and the prompt of every assistance type.
+PRODUCT_PROMPT_TEMPLATE = (
+    "Tu es un expert en e-commerce avec une forte expertise en marketing de niche. "
+    "Génère {num_ideas} idées de produits innovantes et potentiellement très rentables, "
+    "spécifiquement conçues pour la niche '{niche}' et ciblant le persona détaillé suivant : '{persona}'. "
+    "Chaque produit doit résoudre un problème ou répondre à un besoin spécifique de ce persona dans cette niche. "
+    "Fournis les informations structurées au format JSON uniquement. La sortie doit être un tableau JSON contenant {num_ideas} objets, chacun avec les clés suivantes et leurs valeurs correspondantes:\n"
+    "{json_structure_description}"
+    "\nAssure-toi que la sortie soit STRICTEMENT un tableau JSON valide et complet, SANS AUCUN texte supplémentaire avant ou après le tableau JSON."
+)
+
+# Appended to the product prompt when only some ideas are asked again
+PRODUCT_REASK_SUFFIX_TEMPLATE = " Ne propose aucun des produits suivants, déjà générés : {existing_names}."
+
+# Split generation: each idea of a multi-idea request is asked separately, with its own angle so they don't overlap
+PRODUCT_DIVERSITY_ANGLES = [
+    "un produit phare, simple et facile à comprendre",
+    "un accessoire ou un complément d'un produit courant de la niche",
+    "un produit haut de gamme",
+    "un consommable ou un produit d'achat récurrent",
+    "un produit original ou innovant, encore peu vu dans la niche",
+]
+PRODUCT_SPLIT_SUFFIX_TEMPLATE = (
+    " Cette idée fait partie d'une série de {total} idées générées séparément : "
+    "pour celle-ci, propose {angle}. Les autres idées de la série couvrent : {other_angles}."
+)
+# Same prompt for every choice (parameter n): only a generic hint is possible
+PRODUCT_VARIANT_SUFFIX_TEMPLATE = " Plusieurs idées sont générées en parallèle à partir de cette même demande : évite le produit le plus évident de la niche."
+
+STORE_SETUP_BASE_TEMPLATE = (
+    "Tu es un expert en création de boutiques e-commerce pour la niche '{niche}' "
+    "et ciblant le public '{target_audience}'. "
+    "La boutique est de type '{store_type}'. "
+)
+
+store_setup_instructions = {
+    "generate_about_us": (
+        "Génère un texte convaincant pour la page 'À propos de nous' de cette boutique. "
+        "Le texte doit raconter l'histoire de la marque, expliquer sa mission, et créer un lien émotionnel avec le public cible. "
+    ),
+    "suggest_branding": (
+        "Suggère des idées de branding (nom de boutique, slogan, style visuel) pour cette boutique. "
+        "Fournis les suggestions dans un format clair et structuré. "
+    ),
+    "faq_content": (
+        "Génère des questions-réponses courantes (FAQ) pertinentes pour les clients potentiels de cette boutique. "
+        "Structure la réponse en une liste de questions et leurs réponses. "
+    ),
+    # Add more assistance types here as needed
+    # This type is specifically for the Free user's one-time product fiche assistance
+    "generate_product_fiche": (
+        "Génère une fiche produit détaillée pour un produit potentiel dans cette niche et pour ce public cible. "
+        "Inclure le nom du produit, une description détaillée, les avantages clés, une idée de prix, et une suggestion d'image. "
+    ),
+}
+
+STORE_SETUP_DETAILS_TEMPLATE = "Détails supplémentaires : {details}"
+
+
+class PromptTemplateRegistry:
+    def __init__(self, fields_description, store_instructions):
+        self.fields_description = fields_description
+        self.field_names = list(fields_description.keys())
+        self._field_positions = {name: i for i, name in enumerate(self.field_names)}
+
+        # One JSON structure block (without the trailing "répéter pour N objets") per non-empty subset of fields
+        self._structure_blocks = {}
+        for size in range(1, len(self.field_names) + 1):
+            for subset in itertools.combinations(self.field_names, size):
+                self._structure_blocks[subset] = self._render_structure_block(subset)
+
+        self._store_setup_instructions = dict(store_instructions)
+        self._store_setup_templates = {
+            assistance_type: STORE_SETUP_BASE_TEMPLATE + instruction + STORE_SETUP_DETAILS_TEMPLATE
+            for assistance_type, instruction in store_instructions.items()
+        }
+
+        # Any change to a template or a field description changes the version (and thus the cache keys)
+        fingerprint = json.dumps([PRODUCT_PROMPT_TEMPLATE, PRODUCT_REASK_SUFFIX_TEMPLATE, PRODUCT_SPLIT_SUFFIX_TEMPLATE, PRODUCT_VARIANT_SUFFIX_TEMPLATE,
+                                  PRODUCT_DIVERSITY_ANGLES, fields_description, self._store_setup_templates], sort_keys=True, ensure_ascii=False)
+        self.version = hashlib.sha256(fingerprint.encode("utf-8")).hexdigest()[:12]
+
+    def _render_structure_block(self, fields):
+        lines = []
+        for field in fields:
+            description = self.fields_description[field]
+            # Handle list type fields for description
+            if isinstance(description, list):
+                description_str = '[\n' + ',\n'.join([f'      "{item}"' for item in description]) + '\n    ]'
+            else:
+                description_str = f'"{description}"'
+            lines.append(f'    "{field}": {description_str}')
+        return '[\n  {\n' + ',\n'.join(lines) + '\n  }\n'
+
+    def resolve_fields(self, fields):
+        # Si vide ou nulle, tous les champs sont inclus. Returned in canonical order, without duplicates.
+        if not fields:
+            return tuple(self.field_names)
+        unknown = [field for field in fields if field not in self._field_positions]
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Champ(s) non reconnu(s) : {', '.join(unknown)}. Champs disponibles : {', '.join(self.field_names)}.")
+        return tuple(sorted(set(fields), key=self._field_positions.__getitem__))
+
+    def render_product_prompt(self, data, fields_to_include, num_ideas=None):
+        num_ideas = data.num_ideas if num_ideas is None else num_ideas
+        json_structure_description = self._structure_blocks[tuple(fields_to_include)] + f'  // ... répéter pour {num_ideas} objets\n]'
+        return PRODUCT_PROMPT_TEMPLATE.format(
+            num_ideas=num_ideas,
+            niche=data.niche,
+            persona=data.persona,
+            json_structure_description=json_structure_description,
+        )
+
+    def render_reask_prompt(self, data, fields_to_include, missing, existing_ideas):
+        prompt = self.render_product_prompt(data, fields_to_include, num_ideas=missing)
+        existing_names = [idea["nom_produit"] for idea in existing_ideas if idea.get("nom_produit")]
+        if existing_names:
+            prompt += PRODUCT_REASK_SUFFIX_TEMPLATE.format(existing_names=", ".join(existing_names))
+        return prompt
+
+    def render_split_prompt(self, data, fields_to_include, position, total):
+        # One idea per completion; position None is the shared prompt of the n-choices mode
+        prompt = self.render_product_prompt(data, fields_to_include, num_ideas=1)
+        if position is None:
+            return prompt + PRODUCT_VARIANT_SUFFIX_TEMPLATE
+        angles = [PRODUCT_DIVERSITY_ANGLES[i % len(PRODUCT_DIVERSITY_ANGLES)] for i in range(total)]
+        other_angles = "; ".join(angle for i, angle in enumerate(angles) if i != position and angle != angles[position])
+        return prompt + PRODUCT_SPLIT_SUFFIX_TEMPLATE.format(total=total, angle=angles[position], other_angles=other_angles or "rien d'autre")
+
+    def assistance_types(self):
+        return list(self._store_setup_templates.keys())
+
+    def warm_up(self):
+        # Render every template once: a broken placeholder fails the startup instead of the first request
+        sample = SimpleNamespace(niche="niche", persona="persona", num_ideas=1, store_type="dropshipping", target_audience="audience", details=None)
+        prompts = [self.render_reask_prompt(sample, tuple(self.field_names), 1, [{"nom_produit": "produit"}]),
+                   self.render_split_prompt(sample, tuple(self.field_names), 0, 2), self.render_split_prompt(sample, tuple(self.field_names), None, 2)]
+        for assistance_type in self._store_setup_templates:
+            sample.assistance_type = assistance_type
+            prompts.append(self.render_store_setup_prompt(sample))
+        prompts.extend(self.render_store_setup_bundle_prompts(sample, self.assistance_types()).values())
+        return prompts
+
+    def render_store_setup_prompt(self, data):
+        template = self._store_setup_templates.get(data.assistance_type)
+        if template is None:
+            raise HTTPException(status_code=400, detail=f"Type d'assistance '{data.assistance_type}' non reconnu.")
+        return template.format(
+            niche=data.niche,
+            target_audience=data.target_audience,
+            store_type=data.store_type,
+            details=data.details if data.details else 'Aucun.',
+        )
+
+    def render_store_setup_bundle_prompts(self, data, assistance_types):
+        # Same text as render_store_setup_prompt, but the shared context is rendered once: every section
+        # starts with the same prefix and differs only by its instruction
+        unknown = [assistance_type for assistance_type in assistance_types if assistance_type not in self._store_setup_instructions]
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Type(s) d'assistance non reconnu(s) : {', '.join(unknown)}. Types disponibles : {', '.join(self.assistance_types())}.")
+        prefix = STORE_SETUP_BASE_TEMPLATE.format(niche=data.niche, target_audience=data.target_audience, store_type=data.store_type)
+        suffix = STORE_SETUP_DETAILS_TEMPLATE.format(details=data.details if data.details else 'Aucun.')
+        return {assistance_type: prefix + self._store_setup_instructions[assistance_type] + suffix for assistance_type in assistance_types}
+
+
+prompt_templates = PromptTemplateRegistry(all_fields_description, store_setup_instructions)
+
+
+# Token budgeting
+# max_tokens is sized per request from the number of ideas and the requested fields instead of a
+# fixed 1500: short requests stop earlier, long ones are no longer truncated into invalid JSON.
+OPENAI_CONTEXT_WINDOW = int(os.getenv("OPENAI_CONTEXT_WINDOW", "4096")) # gpt-3.5-turbo
+TOKEN_BUDGET_SAFETY_MARGIN = float(os.getenv("TOKEN_BUDGET_SAFETY_MARGIN", "1.3"))
+TOKEN_BUDGET_MIN_TOKENS = int(os.getenv("TOKEN_BUDGET_MIN_TOKENS", "64"))
+
+# Estimated output tokens of one value of each field (French text), calibrate with token_budgeter.stats()
+product_field_token_estimates = {
+    "nom_produit": 15,
+    "description_courte": 80,
+    "accroche_marketing": 35,
+    "avantages_client": 120,
+    "public_cible_specifique": 60,
+    "probleme_resolu": 40,
+    "idee_prix": 40,
+}
+
+# Estimated output tokens of each assistance type (details excluded)
+store_setup_token_estimates = {
+    "generate_about_us": 500,
+    "suggest_branding": 450,
+    "faq_content": 900,
+    "generate_product_fiche": 650,
+}
+
+CHAT_MESSAGE_OVERHEAD_TOKENS = 8 # role and separators added around each chat message
+
+
+class TokenBudgeter:
+    def __init__(self, model="gpt-3.5-turbo"):
+        self.model = model
+        self._encoding = None
+        self._encoding_loaded = False
+        self._lock = threading.Lock()
+        self._stats = {}
+        self._key_overhead = {}
+
+    def _get_encoding(self):
+        # tiktoken is optional: without it (or without its encoding files) token counts are approximated
+        if not self._encoding_loaded:
+            try:
+                import tiktoken
+                self._encoding = tiktoken.encoding_for_model(self.model)
+            except Exception as e:
+                log.warning("tiktoken_unavailable", "tiktoken indisponible, estimation approximative des tokens.", error=str(e))
+                self._encoding = None
+            self._encoding_loaded = True
+        return self._encoding
+
+    def count_tokens(self, text):
+        encoding = self._get_encoding()
+        if encoding is not None:
+            return len(encoding.encode(text))
+        # ~4 bytes of UTF-8 per token for French text
+        return -(-len(text.encode("utf-8")) // 4)
+
+    def _fit(self, prompt, estimate):
+        prompt_tokens = self.count_tokens(prompt) + CHAT_MESSAGE_OVERHEAD_TOKENS
+        available = OPENAI_CONTEXT_WINDOW - prompt_tokens
+        budget = max(TOKEN_BUDGET_MIN_TOKENS, int(estimate * TOKEN_BUDGET_SAFETY_MARGIN))
+        if available < TOKEN_BUDGET_MIN_TOKENS:
+            raise HTTPException(status_code=400, detail=f"La demande est trop longue ({prompt_tokens} tokens) pour le modèle. Veuillez raccourcir la niche, le persona ou les détails.")
+        if budget > available:
+            # Better a smaller answer than a request the API rejects
+            budget = available
+        return budget
+
+    def product_budget(self, prompt, num_ideas, fields_to_include):
+        per_idea = 0
+        for field in fields_to_include:
+            if field not in self._key_overhead:
+                self._key_overhead[field] = self.count_tokens(f'    "{field}": "",\n')
+            per_idea += product_field_token_estimates.get(field, 60) + self._key_overhead[field]
+        return self._fit(prompt, num_ideas * (per_idea + 4) + 4) # braces per object, brackets of the array
+
+    def store_setup_budget(self, prompt, assistance_type, details):
+        estimate = store_setup_token_estimates.get(assistance_type, 600)
+        if details:
+            estimate += self.count_tokens(details) # the answer tends to grow with the context given
+        return self._fit(prompt, estimate)
+
+    def record(self, endpoint, budget, completion_tokens, truncated, prompt_tokens=0):
+        # Estimated versus actual usage, per endpoint, to calibrate the estimates above
+        with self._lock:
+            stats = self._stats.setdefault(endpoint, {"requests": 0, "budget_tokens": 0, "prompt_tokens": 0, "completion_tokens": 0, "truncated": 0})
+            stats["requests"] += 1
+            stats["budget_tokens"] += budget
+            stats["prompt_tokens"] += prompt_tokens
+            stats["completion_tokens"] += completion_tokens
+            stats["truncated"] += 1 if truncated else 0
+
+    def record_response(self, endpoint, budget, response):
+        usage = response.get("usage") or {}
+        completion_tokens = usage.get("completion_tokens")
+        if completion_tokens is None:
+            completion_tokens = self.count_tokens(response.choices[0].message["content"] or "")
+        self.record(endpoint, budget, completion_tokens, response.choices[0].get("finish_reason") == "length", usage.get("prompt_tokens") or 0)
+
+    def stats(self):
+        with self._lock:
+            return {endpoint: dict(stats) for endpoint, stats in self._stats.items()}
+
+
+token_budgeter = TokenBudgeter()
+
+def warm_up_prompt_templates():
+    # Also loads the tiktoken encoding and the per-field key overheads, otherwise paid by the first generation
+    product_prompt, split_prompt, variant_prompt, *store_prompts = prompt_templates.warm_up()
+    for prompt in (product_prompt, split_prompt, variant_prompt):
+        token_budgeter.product_budget(prompt, 1, prompt_templates.field_names)
+    for store_prompt in store_prompts:
+        token_budgeter.count_tokens(store_prompt)
+
+
+# Historique des générations
+# Chaque résultat servi par le modèle (idées de produits, textes de boutique) est conservé dans generation_history,
+# avec un index FTS5 sur la niche, le persona et la sortie : historique paginé, recherche, et réutilisation
+# d'une génération proche ("yoga mats" / "yoga mat") au lieu d'un nouvel appel au modèle.
+HISTORY_ENABLED = os.getenv("HISTORY_ENABLED", "true").lower() == "true"
+HISTORY_REUSE_MIN_SIMILARITY = float(os.getenv("HISTORY_REUSE_MIN_SIMILARITY", "0.85")) # Seuil par défaut, entre 0 et 1
+HISTORY_REUSE_CANDIDATES = int(os.getenv("HISTORY_REUSE_CANDIDATES", "20")) # Meilleurs résultats FTS comparés au prompt
+HISTORY_PAGE_SIZE_MAX = int(os.getenv("HISTORY_PAGE_SIZE_MAX", "100"))
+
+HISTORY_KINDS = ("product", "store_setup")
+_word_pattern = re.compile(r"\w+")
+
+
+def similarity_tokens(text):
+    # Casse, accents et pluriels simples ignorés : "Tapis de Yoga" ~ "tapis de yoga", "mats" ~ "mat"
+    text = unicodedata.normalize("NFKD", (text or "").casefold())
+    tokens = set()
+    for token in _word_pattern.findall("".join(c for c in text if not unicodedata.combining(c))):
+        if len(token) > 3 and token[-1] in "sx":
+            token = token[:-1]
+        tokens.add(token)
+    return tokens
+
+def text_similarity(a, b):
+    tokens_a, tokens_b = similarity_tokens(a), similarity_tokens(b)
+    if not tokens_a and not tokens_b:
+        return 1.0
+    return len(tokens_a & tokens_b) / len(tokens_a | tokens_b)
+
+def fts_query(text, operator="AND"):
+    # User input never reaches the FTS5 syntax as is: every word becomes a quoted prefix term
+    terms = [f'"{token}"*' for token in _word_pattern.findall(text or "")]
+    return f" {operator} ".join(terms)
+
+def check_similarity_threshold(threshold):
+    if threshold is None:
+        return HISTORY_REUSE_MIN_SIMILARITY
+    if not 0 < threshold <= 1:
+        raise HTTPException(status_code=400, detail="similarity_threshold doit être compris entre 0 (exclu) et 1.")
+    return threshold
+
+
+def record_generation_history(api_key, kind, niche, persona, output, fields=None, num_ideas=None, store_type=None, assistance_type=None, details=None):
+    if not HISTORY_ENABLED:
+        return None
+    with db_connection() as conn, metrics.stage("history_write"):
+        cursor = conn.execute(
+            'INSERT INTO generation_history (api_key, kind, niche, persona, store_type, assistance_type, details, fields, num_ideas, output, prompt_version, created_at) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (api_key, kind, niche, persona, store_type, assistance_type, details,
+             json.dumps(list(fields)) if fields is not None else None, num_ideas,
+             output if isinstance(output, str) else json.dumps(output, ensure_ascii=False),
+             prompt_templates.version, time.time())
+        )
+        conn.commit()
+        return cursor.lastrowid
+
+def find_similar_generation(api_key, kind, niche, persona, threshold, fields=None, num_ideas=None, store_type=None, assistance_type=None):
+    # Candidates come from the FTS index (niche words, any of them), the decision from the similarity of niche and persona.
+    # Only the user's own history is reused, with the same fields / assistance type and enough ideas.
+    query = fts_query(niche, "OR")
+    if not HISTORY_ENABLED or not query:
+        return None
+    with db_connection() as conn, metrics.stage("history_lookup"):
+        rows = conn.execute(
+            'SELECT h.id, h.niche, h.persona, h.store_type, h.assistance_type, h.details, h.fields, h.num_ideas, h.output '
+            'FROM generation_history_fts JOIN generation_history h ON h.id = generation_history_fts.rowid '
+            'WHERE generation_history_fts MATCH ? AND h.api_key = ? AND h.kind = ? '
+            'ORDER BY generation_history_fts.rank LIMIT ?',
+            (f"niche : ({query})", api_key, kind, HISTORY_REUSE_CANDIDATES)
+        ).fetchall()
+
+    best, best_score = None, 0.0
+    for row in rows:
+        if kind == "product" and (json.loads(row["fields"] or "[]") != list(fields) or (row["num_ideas"] or 0) < num_ideas):
+            continue
+        if kind == "store_setup" and (row["assistance_type"] != assistance_type or row["details"] or _normalize_text(row["store_type"] or "") != _normalize_text(store_type or "")):
+            continue
+        score = 0.7 * text_similarity(niche, row["niche"]) + 0.3 * text_similarity(persona, row["persona"])
+        if score >= threshold and score > best_score:
+            best, best_score = row, score
+    if best is None:
+        return None
+    output = json.loads(best["output"]) if kind == "product" else best["output"]
+    if kind == "product":
+        output = output[:num_ideas]
+    return {"id": best["id"], "similarity": round(best_score, 3), "output": output}
+
+async def save_generation_history(*args, **kwargs):
+    # The result is already paid for and served: a failed history write is logged, never returned to the client
+    try:
+        return await asyncio.to_thread(record_generation_history, *args, **kwargs)
+    except Exception as e:
+        log.error("history_write_failed", "Erreur lors de l'enregistrement de l'historique", error=str(e))
+
+def history_item(row, snippet=None):
+    item = {
+        "id": row["id"],
+        "kind": row["kind"],
+        "niche": row["niche"],
+        "persona": row["persona"],
+        "created_at": row["created_at"],
+        "result": json.loads(row["output"]) if row["kind"] == "product" else row["output"],
+    }
+    if row["kind"] == "product":
+        item.update(fields=json.loads(row["fields"] or "[]"), num_ideas=row["num_ideas"])
+    else:
+        item.update(store_type=row["store_type"], assistance_type=row["assistance_type"], details=row["details"])
+    if snippet is not None:
+        item["snippet"] = snippet
+    return item
+
+
+def check_product_generation_allowed(data, current_user):
+    user_plan = current_user.get("plan")
 
     # Check if subscription is active (moved up for early exit)
     if current_user.get("subscription_status") != "active":
@@ -169,130 +2496,589 @@ async def generate_product(data: ProductPrompt, current_user: dict = Depends(get
              raise HTTPException(status_code=400, detail=f"Le plan Gratuit est limité à 1 idée par requête pour la génération de produit.")
         # The check for 'store_assistance_used' for free users should be on the /assist-store-setup endpoint.
 
+    # The monthly limit itself (for ALL plans) is enforced atomically by reserve_generation_quota.
+
+def resolve_product_fields(data):
+    # Determine which fields to include in the prompt based on the 'fields' parameter
+    return prompt_templates.resolve_fields(data.fields)
+
+def build_product_prompt(data, fields_to_include):
+    with metrics.stage("prompt_build"):
+        return prompt_templates.render_product_prompt(data, fields_to_include)
+
+async def request_product_completion(data, prompt, max_tokens, endpoint="generate_product", n=1):
+    response = await create_chat_completion(
+        endpoint=endpoint,
+        model="gpt-3.5-turbo",
+        messages=[{"role": "user", "content": prompt}],
+        temperature=data.temperature, # Use parameter from request
+        top_p=data.top_p, # Use parameter from request
+        frequency_penalty=data.frequency_penalty, # Use parameter from request
+        presence_penalty=data.presence_penalty, # Use parameter from request
+        max_tokens=max_tokens, # Sized by token_budgeter
+        n=n # 1 response containing the JSON array, or n single-idea responses (GENERATION_SPLIT_MODE "n")
+    )
+    return response
 
-    elif plan_details and plan_details["monthly_generations_limit"] != -1 and current_user["monthly_generations_count"] + data.num_ideas > plan_details["monthly_generations_limit"]:
-        remaining = plan_details["monthly_generations_limit"] - current_user["monthly_generations_count"]
-        raise HTTPException(status_code=429, detail=f"Limite de génération ({plan_details['monthly_generations_limit']} par mois) atteinte pour votre plan {user_plan}. Vous pouvez encore générer {remaining} idée(s). Veuillez passer à un plan supérieur pour des générations illimitées.")
-
+@app.post("/generate-product")
+async def generate_product(data: ProductPrompt, http_response: Response, current_user: dict = Depends(admitted_user), cache_control: Optional[str] = Header(None)):
+    check_product_generation_allowed(data, current_user)
+
+    fields_to_include = resolve_product_fields(data)
+    similarity_threshold = check_similarity_threshold(data.similarity_threshold) if data.reuse_similar else None
+    generation_mode = resolve_generation_mode(data)
+
+    # Serve identical prompts from the response cache instead of a new completion
+    use_cache = GENERATION_CACHE_ENABLED and not cache_bypass_requested(cache_control)
+    cache_key = generation_cache_key(data, fields_to_include)
+    if use_cache:
+        cached_result = generation_cache.get(cache_key)
+        if cached_result is not None:
+            http_response.headers["X-Cache"] = "HIT"
+            if GENERATION_CACHE_HIT_QUOTA_POLICY == "charge":
+                new_count = quota_manager.commit(await reserve_generation_quota(current_user, data.num_ideas))
+                log.info("generation_cache_hit", "Génération servie depuis le cache", api_key=current_user["api_key"], monthly_count=new_count)
+            return {"result": cached_result}
+
+    # Mode "reuse similar": a close prior generation of this user is served like a cache hit
+    if similarity_threshold is not None:
+        similar = await asyncio.to_thread(find_similar_generation, current_user["api_key"], "product", data.niche, data.persona, similarity_threshold,
+                                          fields=fields_to_include, num_ideas=data.num_ideas)
+        if similar is not None:
+            http_response.headers["X-Cache"] = "SIMILAR"
+            if GENERATION_CACHE_HIT_QUOTA_POLICY == "charge":
+                quota_manager.commit(await reserve_generation_quota(current_user, data.num_ideas))
+            log.info("generation_reused", "Génération proche réutilisée depuis l'historique", api_key=current_user["api_key"], history_id=similar["id"], similarity=similar["similarity"])
+            return {"result": similar["output"], "reused_from": {"id": similar["id"], "similarity": similar["similarity"]}}
+    http_response.headers["X-Cache"] = "MISS" if use_cache else "BYPASS"
+
+    if generation_mode != "single":
+        return await serve_split_product_generation(data, fields_to_include, current_user, generation_mode, cache_key if use_cache else None)
+
+    prompt = build_product_prompt(data, fields_to_include)
+    max_tokens = token_budgeter.product_budget(prompt, data.num_ideas, fields_to_include)
+
+    # Reserve the ideas up front so concurrent requests cannot exceed the plan limit
+    reservation = await reserve_generation_quota(current_user, data.num_ideas)
 
     try:
-        # Define all possible fields and their descriptions for the prompt
-        all_fields_description = {
-            "nom_produit": "Un nom percutant, unique et facile à retenir pour ce marché",
-            "description_courte": "1 à 3 phrases décrivant le produit et son principal avantage pour le persona, utilise un langage émotionnel et inclut un emoji pertinent",
-            "accroche_marketing": "Une phrase courte et très attrayante pour les publicités ou les réseaux sociaux, utilise un verbe d'action",
-            "avantages_client": ["Bénéfice clé 1 : Explique clairement ce que le client gagne.", "Bénéfice clé 2 : Un autre avantage concret.", "Bénéfice clé 3 : Un troisième bénéfice ou caractéristique différenciante."],
-            "public_cible_specifique": "Décris en 1-2 phrases le sous-segment précis du persona ciblé par ce produit.",
-            "probleme_resolu": "Décris en 1 phrase le problème spécifique que ce produit résout pour le persona.",
-            "idee_prix": "Une fourchette de prix suggérée, justifiée brièvement (ex: 'Entre 30€ et 50€ - prix premium justifié par la qualité')"
-        }
-
-        # Determine which fields to include in the prompt based on the 'fields' parameter
-        fields_to_include = data.fields if data.fields is not None and len(data.fields) > 0 else list(all_fields_description.keys())
-
-        # Construct the JSON structure description for the prompt dynamically
-        json_structure_description = '[
-'
-        json_structure_description += '  {
-'
-        for i, field in enumerate(fields_to_include):
-            if field in all_fields_description:
-                description = all_fields_description[field]
-                # Handle list type fields for description
-                if isinstance(description, list):
-                     description_str = '[
-' + ',
-'.join([f'      "{item}"' for item in description]) + '
-    ]'
-                else:
-                     description_str = f'"{description}"'
-                json_structure_description += f'    "{field}": {description_str}'
-                if i < len(fields_to_include) - 1:
-                    json_structure_description += ',
-'
-                else:
-                    json_structure_description += '
-' # No comma after the last field
-            else:
-                # Handle case where a requested field is not defined
-                print(f"Warning: Requested field '{field}' is not recognized and will be ignored.")
-        json_structure_description += '  }
-'
-        json_structure_description += f'  // ... répéter pour {data.num_ideas} objets
-'
-        json_structure_description += ']'
-
-
-        # Prompt to generate N ideas in JSON array format with specified fields
-        prompt = (
-            f"Tu es un expert en e-commerce avec une forte expertise en marketing de niche. "
-            f"Génère {data.num_ideas} idées de produits innovantes et potentiellement très rentables, "
-            f"spécifiquement conçues pour la niche '{data.niche}' et ciblant le persona détaillé suivant : '{data.persona}'. "
-            "Chaque produit doit résoudre un problème ou répondre à un besoin spécifique de ce persona dans cette niche. "
-            f"Fournis les informations structurées au format JSON uniquement. La sortie doit être un tableau JSON contenant {data.num_ideas} objets, chacun avec les clés suivantes et leurs valeurs correspondantes:
-"
-            f"{json_structure_description}" # Use the dynamically generated structure description
-            "
-Assure-toi que la sortie soit STRICTEMENT un tableau JSON valide et complet, SANS AUCUN texte supplémentaire avant ou après le tableau JSON."
-        )
-
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=data.temperature, # Use parameter from request
-            top_p=data.top_p, # Use parameter from request
-            frequency_penalty=data.frequency_penalty, # Use parameter from request
-            presence_penalty=data.presence_penalty, # Use parameter from request
-            max_tokens=1500,
-            n=1 # Always request 1 response from OpenAI, which should contain the JSON array
-        )
+        try:
+            response = await request_product_completion(data, prompt, max_tokens)
+        except BaseException:
+            # The upstream call failed (or the client went away): give the reservation back
+            quota_manager.refund(reservation)
+            raise
 
         # Increment the generation count by the number of ideas requested
-        new_count = current_user["monthly_generations_count"] + data.num_ideas
-        cursor = db.cursor()
-        cursor.execute('UPDATE users SET monthly_generations_count = ? WHERE api_key = ?', (new_count, current_user["api_key"]))
+        new_count = quota_manager.commit(reservation)
         # The store_assistance_used flag logic is moved to /assist-store-setup
-        db.commit()
-        print(f"Génération réussie pour l'utilisateur {current_user['api_key']}. Compteur incrémenté de {data.num_ideas}. Nouveau compteur: {new_count}")
+        log.info("generation_succeeded", "Génération réussie", api_key=current_user["api_key"], charged=data.num_ideas, monthly_count=new_count)
 
 
         # Attempt to parse JSON response, handle potential errors
         try:
             ai_response_content = response.choices[0].message["content"]
-            json_result = json.loads(ai_response_content)
-            # Validate that the result is a list/array as requested
-            if not isinstance(json_result, list):
-                 print(f"Erreur: La réponse d'OpenAI n'est pas un tableau JSON comme attendu. Réponse reçue: {ai_response_content}")
-                 # Attempt to salvage if it's a single JSON object instead of an array of one object
-                 if isinstance(json_result, dict):
-                      print("Tentative de traiter comme un objet JSON unique dans un tableau.")
-                      json_result = [json_result]
-                 else:
-                      raise HTTPException(status_code=500, detail=f"La réponse d'OpenAI n'est pas au format tableau JSON attendu. Réponse reçue : {ai_response_content}")
+            # Tolerant extraction + repair + schema validation, with a targeted re-ask for missing ideas
+            json_result = await finalize_product_ideas(data, fields_to_include, ai_response_content)
 
             # Optional: Basic validation that the number of items matches num_ideas (OpenAI might not always comply perfectly)
-            # if len(json_result) != data.num_ideas:
-            #      print(f"Avertissement: Le nombre d'idées retournées par OpenAI ({len(json_result)}) ne correspond pas au nombre demandé ({data.num_ideas}).")
+            if len(json_result) != data.num_ideas:
+                 log.warning("generation_count_mismatch", "Le nombre d'idées retournées par OpenAI ne correspond pas au nombre demandé", returned=len(json_result), requested=data.num_ideas)
 
+            if use_cache:
+                generation_cache.set(cache_key, json_result)
+            await save_generation_history(current_user["api_key"], "product", data.niche, data.persona, json_result,
+                                          fields=fields_to_include, num_ideas=len(json_result))
 
             return {"result": json_result}
-        except json.JSONDecodeError:
-            print(f"Erreur de décodage JSON de la réponse OpenAI. Réponse reçue : {ai_response_content}")
+        except ValueError:
+            log.error("openai_output_invalid", "Erreur de décodage JSON de la réponse OpenAI", response=ai_response_content)
             raise HTTPException(status_code=500, detail=f"La réponse d'OpenAI n'était pas au format JSON attendu. Réponse reçue : {ai_response_content}")
         except Exception as json_err:
-            print(f"Erreur inattendue lors du traitement de la réponse OpenAI : {json_err}")
+            log.exception("openai_output_error", "Erreur inattendue lors du traitement de la réponse OpenAI", error=str(json_err))
             raise HTTPException(status_code=500, detail=f"Erreur interne lors du traitement de la réponse OpenAI : {json_err}")
 
 
+    except UpstreamUnavailableError as e:
+        log.warning("openai_unavailable", "OpenAI indisponible pour la génération du produit", reason=e.reason, retry_after=e.retry_after)
+        raise upstream_unavailable_http_error(e)
     except Exception as e:
-        print(f"Erreur lors de la génération du produit : {e}")
+        quota_manager.refund(reservation) # No-op once the completion has been charged
+        log.exception("generation_failed", "Erreur lors de la génération du produit", error=str(e))
         raise HTTPException(status_code=500, detail=f"Une erreur est survenue lors de la génération de l'idée de produit : {str(e)}")
 
+class IncrementalIdeaParser:
+    # Parses the streamed JSON array and returns each idea object as soon as its closing brace arrives.
+    # Text before the array is skipped, brackets in that text included ("Voici [3] idées", "Note {important}"),
+    # and a bare JSON object is salvaged as a single idea (same dict-to-list salvage as /generate-product).
+    def __init__(self):
+        self.root = None
+        self.done = False
+        self._buffer = []
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._pair_ends = [] # buffer offsets of the commas separating the pairs of the current idea
+
+    def feed(self, text):
+        ideas = []
+        for ch in text:
+            if self.done:
+                break
+            if self._depth == 0:
+                if self.root == '[' and ch not in '{],' and not ch.isspace():
+                    self.root = None # "[3]" in the prose: not the array of ideas
+                if self.root is None:
+                    if ch == '[':
+                        self.root = '['
+                        continue
+                    if ch != '{':
+                        continue
+                    self.root = '{'
+                if ch == '{':
+                    self._depth = 1
+                    self._buffer = ['{']
+                    self._pair_ends = []
+                elif ch == ']' and self.root == '[':
+                    self.done = True
+                continue
+
+            self._buffer.append(ch)
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == '\\':
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                continue
+            if ch == '"':
+                self._in_string = True
+            elif ch == ',' and self._depth == 1:
+                self._pair_ends.append(len(self._buffer) - 1)
+            elif ch in '{[':
+                self._depth += 1
+            elif ch in '}]':
+                self._depth -= 1
+                if self._depth == 0:
+                    try:
+                        item = json.loads(''.join(self._buffer))
+                    except json.JSONDecodeError:
+                        item = None
+                    self._buffer = []
+                    if isinstance(item, dict) and (self.root == '[' or is_idea_object(item)):
+                        ideas.append(item)
+                        if self.root == '{':
+                            self.done = True
+                    elif self.root == '{':
+                        self.root = None # "{important}" or '{"a": 1}' in the prose: keep looking
+        return ideas
+
+    def repair_pending(self):
+        # Output cut off inside an idea: keep its complete key/value pairs and close the object
+        if self._depth == 0:
+            return None
+        for end in reversed(self._pair_ends):
+            try:
+                item = json.loads(''.join(self._buffer[:end]) + '}')
+            except json.JSONDecodeError:
+                continue
+            return item if isinstance(item, dict) else None
+        return None
+
+
+# Model output parsing
+# The model sometimes wraps the array in prose or a ```json fence, or is cut off by max_tokens.
+# Instead of a hard 500 (and a full, expensive retry by the client), the first JSON array or object
+# is extracted, a truncated trailing idea is repaired, every idea is checked against the requested
+# fields, and only the missing ideas are asked again.
+OUTPUT_REASK_MAX_ATTEMPTS = int(os.getenv("OUTPUT_REASK_MAX_ATTEMPTS", "1"))
+
+JSON_START_PATTERN = re.compile(r'[\[{]')
+IDEA_ARRAY_START_PATTERN = re.compile(r'\[\s*\{')
+
+def is_idea_object(value):
+    return isinstance(value, dict) and any(field in value for field in all_fields_description)
+
+def extract_product_ideas(text):
+    # Returns (complete ideas, repaired idea or None): fast path for well-formed output, tolerant scan otherwise.
+    # Each '[' or '{' is tried in turn, so brackets in the prose before the array ("Voici [3] idées") are skipped.
+    decoder = json.JSONDecoder()
+    for match in JSON_START_PATTERN.finditer(text):
+        try:
+            value, _ = decoder.raw_decode(text, match.start()) # Ignores any text after the value
+        except json.JSONDecodeError:
+            if IDEA_ARRAY_START_PATTERN.match(text, match.start()):
+                break # Truncated array of ideas: its objects must not be decoded one by one
+            continue
+        # A decoy value in the prose ('{"a": 1}', '[3]') is skipped: only objects with a known idea field count
+        if is_idea_object(value):
+            return [value], None # Salvage a single JSON object instead of an array of one object
+        if isinstance(value, list) and any(is_idea_object(item) for item in value):
+            return [item for item in value if isinstance(item, dict)], None
+    parser = IncrementalIdeaParser()
+    ideas = parser.feed(text)
+    return ideas, None if parser.done else parser.repair_pending()
+
+def validate_product_idea(idea, fields_to_include, require_all=False):
+    # Keeps only the requested fields with the expected type. The product name (or the first requested
+    # field) is mandatory; a truncated idea (require_all) must have every requested field.
+    cleaned = {}
+    for field in fields_to_include:
+        value = idea.get(field)
+        if isinstance(all_fields_description[field], list):
+            if isinstance(value, str):
+                value = [value]
+            valid = isinstance(value, list) and bool(value) and all(isinstance(item, str) for item in value)
+        else:
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                value = str(value)
+            valid = isinstance(value, str) and bool(value.strip())
+        if valid:
+            cleaned[field] = value
+        elif require_all:
+            return None
+    required_field = "nom_produit" if "nom_produit" in fields_to_include else fields_to_include[0]
+    return cleaned if required_field in cleaned else None
+
+def parse_product_ideas(ai_response_content, fields_to_include):
+    with metrics.stage("parse"):
+        return _parse_product_ideas(ai_response_content, fields_to_include)
+
+def _parse_product_ideas(ai_response_content, fields_to_include):
+    candidates, truncated_idea = extract_product_ideas(ai_response_content)
+    ideas = [idea for idea in (validate_product_idea(c, fields_to_include) for c in candidates) if idea is not None]
+    if truncated_idea is not None:
+        candidates.append(truncated_idea)
+        truncated_idea = validate_product_idea(truncated_idea, fields_to_include, require_all=True)
+        if truncated_idea is not None:
+            ideas.append(truncated_idea)
+    if len(ideas) != len(candidates) or truncated_idea is not None:
+        log.info("openai_output_repaired", "Réponse OpenAI réparée", kept=len(ideas), extracted=len(candidates))
+    return ideas
+
+async def finalize_product_ideas(data, fields_to_include, ai_response_content, endpoint="generate_product"):
+    ideas = parse_product_ideas(ai_response_content, fields_to_include)
+    attempts = 0
+    while len(ideas) < data.num_ideas and attempts < OUTPUT_REASK_MAX_ATTEMPTS:
+        attempts += 1
+        missing = data.num_ideas - len(ideas)
+        # Targeted re-ask: only the missing ideas, told which products already exist
+        prompt = prompt_templates.render_reask_prompt(data, fields_to_include, missing, ideas)
+        try:
+            max_tokens = token_budgeter.product_budget(prompt, missing, fields_to_include)
+            response = await request_product_completion(data, prompt, max_tokens, endpoint=f"{endpoint}_reask")
+        except Exception as e:
+            log.warning("openai_reask_failed", "Erreur lors de la relance pour les idées manquantes", missing=missing, error=str(e))
+            break
+        ideas += parse_product_ideas(response.choices[0].message["content"], fields_to_include)[:missing]
+    if not ideas:
+        raise ValueError("Aucune idée exploitable dans la réponse d'OpenAI.")
+    return ideas[:data.num_ideas] # The model sometimes returns more ideas than asked (and charged)
+
+
+# Split generation
+# "single" : une seule complétion pour tout le tableau d'idées (sa durée croît avec le nombre d'idées).
+# "parallel" : une complétion par idée, toutes en parallèle, chacune avec son angle (PRODUCT_DIVERSITY_ANGLES).
+# "n" : une seule requête avec le paramètre n (un prompt, n réponses d'une idée chacune).
+# En "parallel" et "n", 5 idées prennent à peu près le temps d'une seule, une idée en échec n'emporte pas
+# les autres, et seules les idées livrées sont décomptées du quota.
+GENERATION_SPLIT_MODE = os.getenv("GENERATION_SPLIT_MODE", "parallel")
+GENERATION_SPLIT_MIN_IDEAS = int(os.getenv("GENERATION_SPLIT_MIN_IDEAS", "2")) # En dessous, toujours "single"
+GENERATION_MODES = ("single", "parallel", "n")
+
+if GENERATION_SPLIT_MODE not in GENERATION_MODES:
+    log.warning("config_invalid", "GENERATION_SPLIT_MODE non reconnu, utilisation de 'single'.", setting="GENERATION_SPLIT_MODE", value=GENERATION_SPLIT_MODE)
+    GENERATION_SPLIT_MODE = "single"
+
+def resolve_generation_mode(data):
+    mode = data.generation_mode or GENERATION_SPLIT_MODE
+    if mode not in GENERATION_MODES:
+        raise HTTPException(status_code=400, detail=f"Mode de génération '{mode}' non reconnu. Modes disponibles : {', '.join(GENERATION_MODES)}.")
+    return mode if data.num_ideas >= GENERATION_SPLIT_MIN_IDEAS else "single"
+
+def product_idea_identity(idea):
+    # Two completions may still come up with the same product: only the first one is kept (and charged)
+    return _normalize_text(str(idea.get("nom_produit") or json.dumps(idea, sort_keys=True, ensure_ascii=False)))
+
+async def request_split_product_ideas(data, fields_to_include, mode):
+    # Returns the distinct ideas delivered (at most num_ideas) and the errors of the completions that failed
+    total = data.num_ideas
+    with metrics.stage("prompt_build"):
+        positions = [None] if mode == "n" else range(total)
+        prompts = [prompt_templates.render_split_prompt(data, fields_to_include, position, total) for position in positions]
+    max_tokens = token_budgeter.product_budget(prompts[0], 1, fields_to_include)
+
+    async def request_ideas(prompt):
+        response = await request_product_completion(data, prompt, max_tokens, endpoint="generate_product_split", n=total if mode == "n" else 1)
+        return [idea for choice in response.choices for idea in parse_product_ideas(choice.message["content"], fields_to_include)[:1]]
+
+    results = await asyncio.gather(*(request_ideas(prompt) for prompt in prompts), return_exceptions=True)
+    ideas, errors, seen = [], [], set()
+    for result in results:
+        if isinstance(result, BaseException):
+            errors.append(result)
+            continue
+        for idea in result:
+            identity = product_idea_identity(idea)
+            if identity not in seen:
+                seen.add(identity)
+                ideas.append(idea)
+    return ideas[:total], errors
+
+async def serve_split_product_generation(data, fields_to_include, current_user, mode, cache_key=None):
+    # The reservation covers num_ideas; the commit only charges the ideas that came back
+    reservation = await reserve_generation_quota(current_user, data.num_ideas)
+    try:
+        ideas, errors = await request_split_product_ideas(data, fields_to_include, mode)
+    except BaseException:
+        quota_manager.refund(reservation)
+        raise
+
+    error_details = "; ".join(f"{type(e).__name__}: {e}" for e in errors)
+    if not ideas:
+        quota_manager.refund(reservation)
+        unavailable = next((e for e in errors if isinstance(e, UpstreamUnavailableError)), None)
+        if unavailable is not None:
+            log.warning("openai_unavailable", "OpenAI indisponible pour la génération du produit", reason=unavailable.reason, retry_after=unavailable.retry_after, mode=mode)
+            raise upstream_unavailable_http_error(unavailable)
+        log.error("generation_failed", "Aucune idée exploitable dans les générations séparées", mode=mode, errors=error_details)
+        raise HTTPException(status_code=500, detail="Une erreur est survenue lors de la génération de l'idée de produit : aucune idée exploitable dans la réponse d'OpenAI.")
+
+    new_count = quota_manager.commit(reservation, len(ideas))
+    log.info("generation_succeeded", "Génération réussie", api_key=current_user["api_key"], charged=len(ideas), monthly_count=new_count, mode=mode)
+    result = {"result": ideas}
+    if len(ideas) < data.num_ideas:
+        # Partial success: the delivered ideas are returned (and charged), the missing ones are not cached
+        log.warning("generation_partial", "Génération partielle : certaines idées n'ont pas pu être générées", requested=data.num_ideas, delivered=len(ideas), mode=mode, errors=error_details)
+        result["partial"] = {"requested": data.num_ideas, "delivered": len(ideas)}
+    elif cache_key is not None:
+        generation_cache.set(cache_key, ideas)
+    await save_generation_history(current_user["api_key"], "product", data.niche, data.persona, ideas, fields=fields_to_include, num_ideas=len(ideas))
+    return result
+
+
+def ndjson_line(payload):
+    return json.dumps(payload, ensure_ascii=False) + "\n"
+
+# Streaming variant of /generate-product: one NDJSON line per idea as soon as it is complete,
+# then a final {"type": "done"} line (or {"type": "error"} if the generation failed midway).
+@app.post("/generate-product/stream")
+async def generate_product_stream(data: ProductPrompt, current_user: dict = Depends(rate_limited_user), cache_control: Optional[str] = Header(None)):
+    check_product_generation_allowed(data, current_user)
+
+    fields_to_include = resolve_product_fields(data)
+    use_cache = GENERATION_CACHE_ENABLED and not cache_bypass_requested(cache_control)
+    cache_key = generation_cache_key(data, fields_to_include)
+    cached_result = generation_cache.get(cache_key) if use_cache else None
+    prompt = build_product_prompt(data, fields_to_include) if cached_result is None else None
+    max_tokens = token_budgeter.product_budget(prompt, data.num_ideas, fields_to_include) if prompt is not None else None
+    if cached_result is None:
+        # Fail fast with a real 503 while the circuit is open, before the 200 streaming response starts
+        try:
+            get_upstream_guard("generate_product_stream").breaker.check_available()
+        except UpstreamUnavailableError as e:
+            raise upstream_unavailable_http_error(e)
+    # The admission slot is held until the stream ends, so it is taken here and released by the generator
+    # (or by the background task if the client left before the first chunk)
+    ticket = await acquire_admission() if cached_result is None else None
+    charge_quota = cached_result is None or GENERATION_CACHE_HIT_QUOTA_POLICY == "charge"
+    try:
+        reservation = await reserve_generation_quota(current_user, data.num_ideas) if charge_quota else None
+    except HTTPException:
+        if ticket is not None:
+            ticket.release()
+        raise
+
+    async def idea_stream():
+        ideas = []
+        try:
+            if cached_result is not None:
+                ideas = list(cached_result)
+                for index, idea in enumerate(ideas):
+                    yield ndjson_line({"type": "idea", "index": index, "idea": idea})
+            else:
+                parser = IncrementalIdeaParser()
+                streamed = []
+                async for delta in stream_chat_completion(
+                    model="gpt-3.5-turbo",
+                    messages=[{"role": "user", "content": prompt}],
+                    temperature=data.temperature,
+                    top_p=data.top_p,
+                    frequency_penalty=data.frequency_penalty,
+                    presence_penalty=data.presence_penalty,
+                    max_tokens=max_tokens,
+                    n=1
+                ):
+                    streamed.append(delta)
+                    for idea in parser.feed(delta):
+                        idea = validate_product_idea(idea, fields_to_include)
+                        if idea is None or len(ideas) >= data.num_ideas:
+                            continue # Incomplete idea, not worth showing, or more ideas than asked
+                        yield ndjson_line({"type": "idea", "index": len(ideas), "idea": idea})
+                        ideas.append(idea)
+                if not parser.done and len(ideas) < data.num_ideas:
+                    # Cut off by max_tokens: salvage the trailing idea if all its fields made it through
+                    truncated_idea = parser.repair_pending()
+                    if truncated_idea is not None:
+                        truncated_idea = validate_product_idea(truncated_idea, fields_to_include, require_all=True)
+                    if truncated_idea is not None:
+                        yield ndjson_line({"type": "idea", "index": len(ideas), "idea": truncated_idea})
+                        ideas.append(truncated_idea)
+                # Streamed completions carry no usage block, count the output locally
+                completion_tokens = token_budgeter.count_tokens("".join(streamed))
+                token_budgeter.record("generate_product_stream", max_tokens, completion_tokens, not parser.done, token_budgeter.count_tokens(prompt))
+
+            # Same accounting as /generate-product: the completion went through, so the ideas are charged
+            if reservation is not None:
+                new_count = quota_manager.commit(reservation)
+                log.info("generation_succeeded", "Génération (stream) réussie", api_key=current_user["api_key"], charged=data.num_ideas, monthly_count=new_count)
+
+            if not ideas:
+                yield ndjson_line({"type": "error", "detail": "La réponse d'OpenAI n'était pas au format JSON attendu."})
+                return
+            if cached_result is None:
+                if use_cache:
+                    generation_cache.set(cache_key, ideas)
+                await save_generation_history(current_user["api_key"], "product", data.niche, data.persona, ideas,
+                                              fields=fields_to_include, num_ideas=len(ideas))
+            yield ndjson_line({"type": "done", "count": len(ideas)})
+
+        except UpstreamUnavailableError as e:
+            log.warning("openai_unavailable", "OpenAI indisponible pour la génération du produit (stream)", reason=e.reason, retry_after=e.retry_after)
+            error = upstream_unavailable_http_error(e)
+            yield ndjson_line({"type": "error", "status_code": error.status_code, "detail": error.detail, "retry_after": error.headers["Retry-After"]})
+        except Exception as e:
+            log.exception("generation_failed", "Erreur lors de la génération du produit (stream)", error=str(e))
+            yield ndjson_line({"type": "error", "detail": f"Une erreur est survenue lors de la génération de l'idée de produit : {str(e)}"})
+        finally:
+            # Upstream failure or client disconnect before the completion finished: nothing is charged
+            if reservation is not None:
+                quota_manager.refund(reservation)
+            if ticket is not None:
+                ticket.release()
+
+    cache_status = "BYPASS" if not use_cache else ("HIT" if cached_result is not None else "MISS")
+    return StreamingResponse(idea_stream(), media_type="application/x-ndjson", headers={"X-Cache": cache_status},
+                             background=BackgroundTask(ticket.release) if ticket is not None else None)
+
+# Batch generation
+BATCH_MAX_PROMPTS = int(os.getenv("BATCH_MAX_PROMPTS", "500"))
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "8"))
+
+# Batch variant of /generate-product for merchandising jobs: one authentication and one quota
+# reservation for the whole batch, identical prompts generated once, bounded fan-out to the model.
+# Results are streamed as NDJSON in completion order: one {"type": "result"} or {"type": "error"}
+# line per prompt (with its index in the request), then a final {"type": "done"} line.
+@app.post("/generate-product/batch")
+async def generate_product_batch(data: BatchProductPrompt, current_user: dict = Depends(rate_limited_user), cache_control: Optional[str] = Header(None)):
+    if not data.prompts:
+        raise HTTPException(status_code=400, detail="Le lot ne contient aucune demande.")
+    if len(data.prompts) > BATCH_MAX_PROMPTS:
+        raise HTTPException(status_code=400, detail=f"Le lot est limité à {BATCH_MAX_PROMPTS} demandes.")
+    if current_user.get("subscription_status") != "active":
+        raise HTTPException(status_code=403, detail="Abonnement inactif. Veuillez activer votre abonnement.")
+
+    use_cache = GENERATION_CACHE_ENABLED and not cache_bypass_requested(cache_control)
+    rejected = []   # (index, status_code, detail)
+    jobs = {}       # cache key -> {"data", "fields", "prompt", "max_tokens", "indexes", "cached"}
+    for index, prompt_data in enumerate(data.prompts):
+        try:
+            check_product_generation_allowed(prompt_data, current_user)
+            fields_to_include = resolve_product_fields(prompt_data)
+            prompt = build_product_prompt(prompt_data, fields_to_include)
+            max_tokens = token_budgeter.product_budget(prompt, prompt_data.num_ideas, fields_to_include)
+        except HTTPException as e:
+            rejected.append((index, e.status_code, e.detail))
+            continue
+        cache_key = generation_cache_key(prompt_data, fields_to_include)
+        job = jobs.get(cache_key)
+        if job is None:
+            cached_result = generation_cache.get(cache_key) if use_cache else None
+            job = jobs[cache_key] = {"data": prompt_data, "fields": fields_to_include, "prompt": prompt, "max_tokens": max_tokens, "indexes": [], "cached": cached_result}
+        job["indexes"].append(index)
+
+    # Deduplicated prompts are charged once; free cache hits are not reserved at all
+    charge_hits = GENERATION_CACHE_HIT_QUOTA_POLICY == "charge"
+    to_reserve = sum(job["data"].num_ideas for job in jobs.values() if job["cached"] is None or charge_hits)
+    # One admission slot for the whole batch, its own fan-out is bounded below
+    ticket = await acquire_admission()
+    try:
+        reservation = await reserve_generation_quota(current_user, to_reserve) if to_reserve else None
+    except HTTPException:
+        ticket.release()
+        raise
+    concurrency = max(1, min(data.max_concurrency or BATCH_MAX_CONCURRENCY, BATCH_MAX_CONCURRENCY))
+    semaphore = asyncio.Semaphore(concurrency)
+    # Every generated prompt costs a rate-limit token, like a /generate-product call; the request's own
+    # token (rate_limited_user) covers the first one. Prompts over the plan's rate get a 429 line.
+    prepaid_tokens = [1]
+
+    async def run_job(cache_key, job):
+        if job["cached"] is not None:
+            return job, job["cached"], (job["data"].num_ideas if charge_hits else 0), None
+        async with semaphore:
+            try:
+                if prepaid_tokens[0]:
+                    prepaid_tokens[0] -= 1
+                else:
+                    await asyncio.to_thread(consume_rate_limit, current_user)
+            except HTTPException as e:
+                return job, None, 0, (e.status_code, e.detail)
+            try:
+                response = await request_product_completion(job["data"], job["prompt"], job["max_tokens"], endpoint="generate_product_batch")
+            except UpstreamUnavailableError as e:
+                error = upstream_unavailable_http_error(e)
+                return job, None, 0, (error.status_code, error.detail)
+            except Exception as e:
+                return job, None, 0, (500, f"Une erreur est survenue lors de la génération de l'idée de produit : {str(e)}")
+            # Same accounting as /generate-product: the completion went through, so the ideas are charged
+            charged = job["data"].num_ideas
+            try:
+                # Still inside the bounded section: the re-ask of missing ideas is a model call too,
+                # covered by the job's concurrency slot and rate-limit token
+                ideas = await finalize_product_ideas(job["data"], job["fields"], response.choices[0].message["content"], endpoint="generate_product_batch")
+            except ValueError as e:
+                return job, None, charged, (500, f"La réponse d'OpenAI n'était pas au format JSON attendu : {e}")
+        if use_cache:
+            generation_cache.set(cache_key, ideas)
+        return job, ideas, charged, None
+
+    async def result_stream():
+        charged_total = 0
+        succeeded = 0
+        failed = len(rejected)
+        tasks = [asyncio.ensure_future(run_job(cache_key, job)) for cache_key, job in jobs.items()]
+        try:
+            for index, status_code, detail in rejected:
+                yield ndjson_line({"type": "error", "index": index, "status_code": status_code, "detail": detail})
+            for next_done in asyncio.as_completed(tasks):
+                job, ideas, charged, error = await next_done
+                charged_total += charged
+                for index in job["indexes"]:
+                    if error is None:
+                        succeeded += 1
+                        yield ndjson_line({"type": "result", "index": index, "result": ideas})
+                    else:
+                        failed += 1
+                        yield ndjson_line({"type": "error", "index": index, "status_code": error[0], "detail": error[1]})
+            yield ndjson_line({"type": "done", "succeeded": succeeded, "failed": failed, "unique_prompts": len(jobs)})
+        finally:
+            # Client disconnect: stop the remaining generations, only what was delivered upstream is charged
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+            if reservation is not None:
+                new_count = quota_manager.commit(reservation, charged_total)
+                log.info("generation_batch_succeeded", "Lot de génération terminé", api_key=current_user["api_key"], charged=charged_total, monthly_count=new_count)
+            ticket.release()
+
+    return StreamingResponse(result_stream(), media_type="application/x-ndjson", background=BackgroundTask(ticket.release))
+
 # New endpoint for AI store setup assistance (Premium only, Free one-time)
 @app.post("/assist-store-setup")
-async def assist_store_setup(data: StoreSetupPrompt, current_user: dict = Depends(get_current_user), db: sqlite3.Connection = Depends(get_db)):
+async def assist_store_setup(data: StoreSetupPrompt, current_user: dict = Depends(admitted_user)):
     user_plan = current_user.get("plan")
-    cursor = db.cursor() # Get cursor early to use in checks
 
     # Check if the user is on the Premium plan or Free
     if user_plan != "Premium" and user_plan != "Gratuit":
@@ -302,74 +3088,225 @@ async def assist_store_setup(data: StoreSetupPrompt, current_user: dict = Depend
     if current_user.get("subscription_status") != "active":
          raise HTTPException(status_code=403, detail="Abonnement inactif. Veuillez activer votre abonnement.")
 
-    # Check for Free plan one-time usage limit for this specific endpoint
+    # Check for Free plan one-time usage limit for this specific endpoint (fast path on the cached user;
+    # the flag itself is claimed atomically right before the completion)
     if user_plan == "Gratuit":
         if current_user.get("store_assistance_used", False):
              raise HTTPException(status_code=403, detail="Vous avez déjà utilisé votre assistance IA unique pour la création de boutique avec le plan Gratuit.")
 
+    # Construct the prompt based on the assistance type requested (unknown types are rejected with a 400)
+    with metrics.stage("prompt_build"):
+        prompt = prompt_templates.render_store_setup_prompt(data)
+        max_tokens = token_budgeter.store_setup_budget(prompt, data.assistance_type, data.details)
+
+    # Mode "reuse similar": a close prior text of this user, for the same assistance type, instead of a new completion
+    if data.reuse_similar and not data.details:
+        similar = await asyncio.to_thread(find_similar_generation, current_user["api_key"], "store_setup", data.niche, data.target_audience,
+                                          check_similarity_threshold(data.similarity_threshold), store_type=data.store_type, assistance_type=data.assistance_type)
+        if similar is not None:
+            log.info("generation_reused", "Texte de boutique proche réutilisé depuis l'historique", api_key=current_user["api_key"], history_id=similar["id"], similarity=similar["similarity"])
+            return {"result": similar["output"], "reused_from": {"id": similar["id"], "similarity": similar["similarity"]}}
+
+    # Gratuit: claim the one-time assistance before the completion, so a concurrent call or bundle cannot also get it
+    claimed = False
+    if user_plan == "Gratuit":
+        claimed = await asyncio.to_thread(claim_store_assistance, current_user["api_key"])
+        if not claimed:
+            raise HTTPException(status_code=403, detail="Vous avez déjà utilisé votre assistance IA unique pour la création de boutique avec le plan Gratuit.")
 
+    succeeded = False
     try:
-        # Construct the prompt based on the assistance type requested
-        base_prompt = (
-            f"Tu es un expert en création de boutiques e-commerce pour la niche '{data.niche}' "
-            f"et ciblant le public '{data.target_audience}'. "
-            f"La boutique est de type '{data.store_type}'. "
-        )
-
-        if data.assistance_type == "generate_about_us":
-            prompt = base_prompt + (
-                "Génère un texte convaincant pour la page 'À propos de nous' de cette boutique. "
-                "Le texte doit raconter l'histoire de la marque, expliquer sa mission, et créer un lien émotionnel avec le public cible. "
-                f"Détails supplémentaires : {data.details if data.details else 'Aucun.'}"
-            )
-        elif data.assistance_type == "suggest_branding":
-             prompt = base_prompt + (
-                 "Suggère des idées de branding (nom de boutique, slogan, style visuel) pour cette boutique. "
-                 "Fournis les suggestions dans un format clair et structuré. "
-                 f"Détails supplémentaires : {data.details if data.details else 'Aucun.'}"
-             )
-        elif data.assistance_type == "faq_content":
-             prompt = base_prompt + (
-                 "Génère des questions-réponses courantes (FAQ) pertinentes pour les clients potentiels de cette boutique. "
-                 "Structure la réponse en une liste de questions et leurs réponses. "
-                 f"Détails supplémentaires : {data.details if data.details else 'Aucun.'}"
-             )
-        # Add more assistance types here as needed
-        elif data.assistance_type == "generate_product_fiche":
-             # This type is specifically for the Free user's one-time product fiche assistance
-             prompt = base_prompt + (
-                 "Génère une fiche produit détaillée pour un produit potentiel dans cette niche et pour ce public cible. "
-                 "Inclure le nom du produit, une description détaillée, les avantages clés, une idée de prix, et une suggestion d'image. "
-                 f"Détails supplémentaires : {data.details if data.details else 'Aucun.'}"
-             )
-        else:
-            raise HTTPException(status_code=400, detail=f"Type d'assistance '{data.assistance_type}' non reconnu.")
-
         # Call OpenAI API
-        response = openai.ChatCompletion.create(
+        response = await create_chat_completion(
+            endpoint="assist_store_setup",
             model="gpt-3.5-turbo", # You might consider gpt-4 for more creative tasks
             messages=[{"role": "user", "content": prompt}],
             temperature=0.8, # Adjust temperature for creativity
-            max_tokens=1500 # Increased max tokens based on expected response length
+            max_tokens=max_tokens # Sized by token_budgeter from the expected response length
         )
 
-        # If the user is on the Free plan and successfully used this endpoint, mark it as used
-        if user_plan == "Gratuit":
-             cursor.execute('UPDATE users SET store_assistance_used = ? WHERE api_key = ?', (True, current_user["api_key"]))
-             db.commit()
-             print("Assistance IA pour la création de boutique marquée comme utilisée pour l'utilisateur Gratuit.")
+        content = response.choices[0].message["content"]
+        succeeded = True
+        if claimed:
+             log.info("store_assistance_used", "Assistance IA pour la création de boutique marquée comme utilisée pour l'utilisateur Gratuit.", api_key=current_user["api_key"])
 
+        await save_generation_history(current_user["api_key"], "store_setup", data.niche, data.target_audience, content,
+                                      store_type=data.store_type, assistance_type=data.assistance_type, details=data.details)
 
         # Return the generated content
-        return {"result": response.choices[0].message["content"]}
+        return {"result": content}
 
+    except UpstreamUnavailableError as e:
+        log.warning("openai_unavailable", "OpenAI indisponible pour l'assistance à la création de boutique", reason=e.reason, retry_after=e.retry_after)
+        raise upstream_unavailable_http_error(e)
     except Exception as e:
-        print(f"Erreur lors de l'assistance à la création de boutique : {e}")
+        log.exception("store_assistance_failed", "Erreur lors de l'assistance à la création de boutique", error=str(e))
         raise HTTPException(status_code=500, detail=f"Une erreur est survenue lors de l'assistance à la création de boutique : {str(e)}")
+    finally:
+        if claimed and not succeeded:
+            # The completion failed: the one-time assistance is given back (shielded, like the bundle)
+            await asyncio.shield(asyncio.to_thread(release_store_assistance, current_user["api_key"]))
+
+
+# Gratuit: the one-time store assistance is claimed by a conditional UPDATE, so two concurrent calls to
+# /assist-store-setup or its bundle (or workers) can never both get it; it is given back if nothing was generated.
+def claim_store_assistance(api_key):
+    with db_connection() as conn, metrics.stage("db_write"):
+        cursor = conn.execute('UPDATE users SET store_assistance_used = ? WHERE api_key = ? AND NOT COALESCE(store_assistance_used, ?)', (True, api_key, False))
+        conn.commit()
+    invalidate_cached_user(api_key)
+    return cursor.rowcount == 1
+
+def release_store_assistance(api_key):
+    with db_connection() as conn, metrics.stage("db_write"):
+        conn.execute('UPDATE users SET store_assistance_used = ? WHERE api_key = ?', (False, api_key))
+        conn.commit()
+    invalidate_cached_user(api_key)
+
+# Bundle variant of /assist-store-setup to build a whole store in one call: one authentication, one plan
+# check and one shared prompt context for every section, generated concurrently (the total time is that of
+# the slowest section). Sections are streamed as NDJSON in completion order: one {"type": "section"} or
+# {"type": "error"} line per assistance type, then a final {"type": "done"} line.
+@app.post("/assist-store-setup/bundle")
+async def assist_store_setup_bundle(data: StoreSetupBundlePrompt, current_user: dict = Depends(get_current_user)):
+    user_plan = current_user.get("plan")
+    if user_plan != "Premium" and user_plan != "Gratuit":
+        raise HTTPException(status_code=403, detail=f"Cette fonctionnalité est réservée aux utilisateurs des plans Premium et Gratuit. Votre plan actuel est : {user_plan}.")
+    if current_user.get("subscription_status") != "active":
+        raise HTTPException(status_code=403, detail="Abonnement inactif. Veuillez activer votre abonnement.")
+
+    assistance_types = list(dict.fromkeys(data.assistance_types)) # A type asked twice is generated once
+    if not assistance_types:
+        raise HTTPException(status_code=400, detail="Le lot ne contient aucun type d'assistance.")
+    with metrics.stage("prompt_build"):
+        prompts = prompt_templates.render_store_setup_bundle_prompts(data, assistance_types)
+        budgets = {assistance_type: token_budgeter.store_setup_budget(prompt, assistance_type, data.details) for assistance_type, prompt in prompts.items()}
+    # One rate-limit token per section (capped at the plan's burst: a bundle has at most one section per assistance type)
+    await asyncio.to_thread(consume_rate_limit, current_user, len(assistance_types))
+
+    # Fail fast with a real 503 while the circuit is open, before the 200 streaming response starts
+    try:
+        get_upstream_guard("assist_store_setup_bundle").breaker.check_available()
+    except UpstreamUnavailableError as e:
+        raise upstream_unavailable_http_error(e)
+    # One admission slot for the whole bundle, held until the stream ends
+    ticket = await acquire_admission()
+    # The whole bundle counts as the Gratuit plan's single store assistance
+    claimed = False
+    if user_plan == "Gratuit":
+        try:
+            claimed = await asyncio.to_thread(claim_store_assistance, current_user["api_key"])
+        except Exception:
+            ticket.release()
+            raise
+        if not claimed:
+            ticket.release()
+            raise HTTPException(status_code=403, detail="Vous avez déjà utilisé votre assistance IA unique pour la création de boutique avec le plan Gratuit.")
+
+    async def run_section(assistance_type):
+        prompt, max_tokens = prompts[assistance_type], budgets[assistance_type]
+        try:
+            response = await create_chat_completion(
+                endpoint="assist_store_setup_bundle",
+                model="gpt-3.5-turbo",
+                messages=[{"role": "user", "content": prompt}],
+                temperature=0.8,
+                max_tokens=max_tokens
+            )
+        except UpstreamUnavailableError as e:
+            log.warning("openai_unavailable", "OpenAI indisponible pour une section de l'assistance à la création de boutique", assistance_type=assistance_type, reason=e.reason, retry_after=e.retry_after)
+            error = upstream_unavailable_http_error(e)
+            return assistance_type, None, (error.status_code, error.detail)
+        except Exception as e:
+            log.exception("store_assistance_failed", "Erreur lors d'une section de l'assistance à la création de boutique", assistance_type=assistance_type, error=str(e))
+            return assistance_type, None, (500, f"Une erreur est survenue lors de l'assistance à la création de boutique : {str(e)}")
+        content = response.choices[0].message["content"]
+        await save_generation_history(current_user["api_key"], "store_setup", data.niche, data.target_audience, content,
+                                      store_type=data.store_type, assistance_type=assistance_type, details=data.details)
+        return assistance_type, content, None
+
+    async def section_stream():
+        succeeded = 0
+        failed = 0
+        tasks = [asyncio.ensure_future(run_section(assistance_type)) for assistance_type in assistance_types]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                assistance_type, content, error = await next_done
+                if error is None:
+                    succeeded += 1
+                    yield ndjson_line({"type": "section", "assistance_type": assistance_type, "result": content})
+                else:
+                    failed += 1
+                    yield ndjson_line({"type": "error", "assistance_type": assistance_type, "status_code": error[0], "detail": error[1]})
+            yield ndjson_line({"type": "done", "succeeded": succeeded, "failed": failed})
+        finally:
+            # Client disconnect: stop the remaining generations
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+            ticket.release()
+            if claimed:
+                if succeeded:
+                    log.info("store_assistance_used", "Assistance IA pour la création de boutique marquée comme utilisée pour l'utilisateur Gratuit.", api_key=current_user["api_key"], sections=succeeded)
+                else:
+                    # Shielded: also completes when the stream is cancelled, the assistance must not stay consumed
+                    await asyncio.shield(asyncio.to_thread(release_store_assistance, current_user["api_key"]))
+
+    return StreamingResponse(section_stream(), media_type="application/x-ndjson", background=BackgroundTask(ticket.release))
+
+# Historique paginé des générations de l'utilisateur, le plus récent d'abord.
+# Avec q, recherche plein texte (niche, persona, sortie) triée par pertinence, avec un extrait du passage trouvé.
+@app.get("/history")
+def generation_history(q: Optional[str] = None, kind: Optional[str] = None, page: int = 1, page_size: int = 20,
+                       current_user: dict = Depends(get_current_user), db: sqlite3.Connection = Depends(get_db)):
+    # Sync route: the FTS query runs in the threadpool, never on the event loop
+    if kind is not None and kind not in HISTORY_KINDS:
+        raise HTTPException(status_code=400, detail=f"Type d'historique '{kind}' non reconnu. Types disponibles : {', '.join(HISTORY_KINDS)}.")
+    if page < 1 or not 1 <= page_size <= HISTORY_PAGE_SIZE_MAX:
+        raise HTTPException(status_code=400, detail=f"page doit être >= 1 et page_size compris entre 1 et {HISTORY_PAGE_SIZE_MAX}.")
+
+    conditions, params = ["h.api_key = ?"], [current_user["api_key"]]
+    if kind is not None:
+        conditions.append("h.kind = ?")
+        params.append(kind)
+    # One extra row tells whether there is a next page without a COUNT(*)
+    paging = (page_size + 1, (page - 1) * page_size)
+
+    with metrics.stage("history_lookup"):
+        if q:
+            query = fts_query(q)
+            if not query:
+                raise HTTPException(status_code=400, detail="La recherche doit contenir au moins un mot.")
+            rows = db.execute(
+                "SELECT h.*, snippet(generation_history_fts, -1, '[', ']', '…', 12) AS snippet "
+                "FROM generation_history_fts JOIN generation_history h ON h.id = generation_history_fts.rowid "
+                f"WHERE generation_history_fts MATCH ? AND {' AND '.join(conditions)} "
+                "ORDER BY generation_history_fts.rank LIMIT ? OFFSET ?",
+                (query, *params, *paging)
+            ).fetchall()
+        else:
+            rows = db.execute(
+                f"SELECT h.*, NULL AS snippet FROM generation_history h WHERE {' AND '.join(conditions)} "
+                "ORDER BY h.created_at DESC, h.id DESC LIMIT ? OFFSET ?",
+                (*params, *paging)
+            ).fetchall()
+
+    return {
+        "items": [history_item(row, row["snippet"]) for row in rows[:page_size]],
+        "page": page,
+        "page_size": page_size,
+        "has_more": len(rows) > page_size,
+    }
 
 
+def store_pending_subscription(api_key, subscription_id):
+    with db_connection() as db, metrics.stage("db_write"):
+        db.execute('UPDATE users SET paypal_subscription_id = ?, subscription_status = ? WHERE api_key = ?', (subscription_id, 'pending', api_key))
+        db.commit()
+    invalidate_cached_user(api_key)
+
 @app.post("/subscribe")
-async def create_subscription(data: SubscribeRequest, current_user: dict = Depends(get_current_user), db: sqlite3.Connection = Depends(get_db)):
+async def create_subscription(data: SubscribeRequest, current_user: dict = Depends(get_current_user)):
     plan_name = data.plan_name
     plan_details = subscription_plans.get(plan_name)
 
@@ -385,23 +3322,16 @@ async def create_subscription(data: SubscribeRequest, current_user: dict = Depen
 
     try:
 
-        # Configurez l'environnement PayPal (Sandbox pour les tests)
-        # Utilisez LiveEnvironment pour la production
-        from paypalrestsdk import Api as PayPalApi # Importation correcte de l'API
+        # Client PayPal partagé (mode sandbox/live via PAYPAL_MODE), créé au premier appel hors de la boucle d'événements (import du SDK)
+        client = await run_paypal_call(get_paypal_client)
 
         # Assurez-vous que les clés sont définies avant d'initialiser
-        if not PAYPAL_CLIENT_ID or not PAYPAL_CLIENT_SECRET:
+        if client is None:
              raise HTTPException(status_code=500, detail="Les clés API PayPal ne sont pas configurées dans les variables d'environnement du serveur.")
 
-        # Initialiser l'API PayPal REST SDK
-        paypalrestsdk.configure({
-          "mode": "sandbox", # Ou "live" pour la production - ASSUREZ-VOUS QUE CECI CORRESPOND À VOS CLÉS
-          "client_id": PAYPAL_CLIENT_ID,
-          "client_secret": PAYPAL_CLIENT_SECRET })
-
 
-        # Créez l'objet d'abonnement
-        subscription = paypalrestsdk.Subscription({
+        # Créez l'abonnement (API Subscriptions v1, que le SDK n'expose pas sous forme de ressource)
+        subscription_request = {
             "plan_id": paypal_plan_id,
             "subscriber": {
                 # Remplacez par les informations réelles de l'utilisateur si disponibles
@@ -420,48 +3350,176 @@ async def create_subscription(data: SubscribeRequest, current_user: dict = Depen
                  # Vérifiez la documentation de l'API PayPal pour savoir où placer un custom_id ou équivalent pour les abonnements
                 # "custom_id": str(current_user["api_key"]) # Ceci est un exemple, la localisation peut varier
             }
-        })
+        }
 
-        if subscription.create():
-            print(f"Abonnement PayPal créé avec ID: {subscription.id}")
-            cursor = db.cursor()
+        with metrics.stage("paypal_create_subscription"):
+            subscription = await run_paypal_call(client.post, "v1/billing/subscriptions", subscription_request)
+        if "error" not in subscription:
+            log.info("paypal_subscription_created", "Abonnement PayPal créé", subscription_id=subscription["id"])
 
             # Stocker l'ID de l'abonnement PayPal et potentiellement d'autres infos (statut initial, plan demandé)
             # Assurez-vous que la colonne 'paypal_subscription_id' existe dans votre table users
             # Vous pourriez aussi stocker le statut initial comme 'pending' jusqu'au webhook d'activation
-            cursor.execute('UPDATE users SET paypal_subscription_id = ?, subscription_status = ? WHERE api_key = ?', (subscription.id, 'pending', current_user["api_key"]))
-            db.commit()
-            print(f"PayPal Subscription ID {subscription.id} stored (status pending) for user {current_user['api_key']}")
+            # The connection is taken only now, not for the whole PayPal round trips above, and in the threadpool
+            await asyncio.to_thread(store_pending_subscription, current_user["api_key"], subscription["id"])
+            log.info("paypal_subscription_stored", "Abonnement PayPal enregistré (statut pending)", subscription_id=subscription["id"], api_key=current_user["api_key"])
 
 
-            for link in subscription.links:
-                if link.rel == "approve":
+            for link in subscription.get("links", []):
+                if link.get("rel") == "approve":
                     # Retourner l'URL d'approbation où l'utilisateur doit être redirigé
-                    return {"paypal_approval_url": str(link.href)}
+                    return {"paypal_approval_url": str(link["href"])}
             # Si l'URL d'approbation n'est pas trouvée, c'est une erreur inattendue
-            print("Erreur: URL d'approbation PayPal non trouvée dans la réponse de création d'abonnement.")
+            log.error("paypal_approval_url_missing", "URL d'approbation PayPal non trouvée dans la réponse de création d'abonnement.", subscription_id=subscription.get("id"))
             raise HTTPException(status_code=500, detail="Erreur: Impossible d'obtenir l'URL d'approbation PayPal.")
         else:
-             print(f"Erreur lors de la création de l'abonnement PayPal: {subscription.error}")
-             # Loguez les détails de l'erreur PayPal si disponibles pour un meilleur diagnostic
-             if hasattr(subscription.error, 'details'):
-                 print(f"Détails de l'erreur PayPal: {subscription.error.details}")
-             raise HTTPException(status_code=500, detail=f"Erreur PayPal: {subscription.error}")
+             # Les détails de l'erreur PayPal (si disponibles) sont logués pour un meilleur diagnostic
+             details = subscription["error"].get("details") if isinstance(subscription["error"], dict) else None
+             log.error("paypal_subscription_rejected", "Erreur lors de la création de l'abonnement PayPal", error=str(subscription["error"]), details=str(details) if details else None)
+             raise HTTPException(status_code=500, detail=f"Erreur PayPal: {subscription['error']}")
 
     except Exception as e:
-        print(f"Erreur lors de l'initiation de l'abonnement PayPal : {e}")
+        log.exception("paypal_subscription_failed", "Erreur lors de l'initiation de l'abonnement PayPal", error=str(e))
         # Gérer spécifiquement l'erreur si les clés API ne sont pas définies
         if "Les clés API PayPal ne sont pas configurées" in str(e):
              raise HTTPException(status_code=500, detail=str(e))
         # Gérer les erreurs liées à l'initialisation du SDK ou à la requête
         raise HTTPException(status_code=500, detail=f"Erreur lors de l'initiation de l'abonnement PayPal : {str(e)}")
+# Applies one stored PayPal event inside the batch transaction of process_webhook_batch.
+# `touched` collects (api_key, reset_quota) so the in-memory caches are refreshed after the commit.
+def apply_paypal_event(cursor, event, touched):
+    event_type = event.get("event_type")
+    resource = event.get("resource", {})
+
+    # Exemple de gestion des événements d'abonnement
+    if event_type == "BILLING.SUBSCRIPTION.ACTIVATED":
+        subscription_id = resource.get("id")
+        # Le champ 'plan_id' est également disponible dans le resource si besoin
+        # plan_id = resource.get("plan_id")
+        # L'objet resource contient aussi les détails du 'subscriber' si nécessaire
+        # subscriber = resource.get("subscriber", {})
+
+        if subscription_id:
+             # Rechercher l'utilisateur par l'ID d'abonnement PayPal stocké
+             # Dans un système de production robuste, vous pourriez aussi utiliser un 'custom_id'
+             # passé lors de la création de l'abonnement pour identifier l'utilisateur.
+             cursor.execute('SELECT * FROM users WHERE paypal_subscription_id = ?', (subscription_id,))
+             user = cursor.fetchone()
+             if user:
+                  # Mettre à jour le statut de l'utilisateur dans votre BDD
+                  # Assurez-vous que le plan est correct (ici on suppose 'Premium' si activé)
+                  cursor.execute('UPDATE users SET subscription_status = ?, plan = ?, monthly_generations_count = ?, billing_period = ? WHERE api_key = ?', ('active', 'Premium', 0, current_billing_period(), user["api_key"]))
+                  touched.append((user["api_key"], True))
+                  log.info("subscription_activated", "Statut d'abonnement mis à jour à 'active'", api_key=user["api_key"], subscription_id=subscription_id)
+             else:
+                  log.warning("subscription_user_not_found", "Webhook 'ACTIVATED' reçu, mais utilisateur non trouvé dans la BDD avec cet ID d'abonnement.", subscription_id=subscription_id)
+
+
+    elif event_type == "BILLING.SUBSCRIPTION.CANCELLED":
+         subscription_id = resource.get("id")
+         if subscription_id:
+             cursor.execute('SELECT * FROM users WHERE paypal_subscription_id = ?', (subscription_id,))
+             user = cursor.fetchone()
+             if user:
+                  # Marquer l'abonnement comme inactif. Vous pourriez aussi définir une date de fin de période si PayPal la fournit.
+                  cursor.execute('UPDATE users SET subscription_status = ? WHERE api_key = ?', ('inactive', user["api_key"]))
+                  touched.append((user["api_key"], False))
+                  log.info("subscription_cancelled", "Statut d'abonnement mis à jour à 'inactive'", api_key=user["api_key"], subscription_id=subscription_id)
+             else:
+                  log.warning("subscription_user_not_found", "Webhook 'CANCELLED' reçu, mais utilisateur non trouvé dans la BDD avec cet ID d'abonnement.", subscription_id=subscription_id)
+
+    # Ajoutez d'autres cas elif pour gérer d'autres types d'événements importants (ex: paiement échoué BILLING.SUBSCRIPTION.PAYMENT.FAILED, renouvellement réussi BILLING.SUBSCRIPTION.PAYMENT.APPROVED, etc.)
+    # elif event_type == "BILLING.SUBSCRIPTION.SUSPENDED":
+    #     # Gérer la suspension de l'abonnement
+    #     pass
+    # elif event_type == "BILLING.SUBSCRIPTION.EXPIRED":
+    #     # Gérer l'expiration de l'abonnement
+    #     pass
+
+# Webhook ingestion
+WEBHOOK_BATCH_SIZE = int(os.getenv("WEBHOOK_BATCH_SIZE", "100"))
+WEBHOOK_POLL_INTERVAL_SECONDS = float(os.getenv("WEBHOOK_POLL_INTERVAL_SECONDS", "5"))
+WEBHOOK_MAX_ATTEMPTS = int(os.getenv("WEBHOOK_MAX_ATTEMPTS", "5"))
+
+def process_webhook_batch(limit=WEBHOOK_BATCH_SIZE):
+    # BEGIN IMMEDIATE takes the write lock up front, so two workers never apply the same events
+    touched = []
+    with db_connection() as conn, metrics.stage("webhook_batch"):
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(
+                'SELECT event_id, payload FROM paypal_webhook_events WHERE processed_at IS NULL AND attempts < ? ORDER BY received_at LIMIT ?',
+                (WEBHOOK_MAX_ATTEMPTS, limit)
+            ).fetchall()
+            cursor = conn.cursor()
+            for row in rows:
+                event_touched = []
+                cursor.execute("SAVEPOINT webhook_event")
+                try:
+                    apply_paypal_event(cursor, json.loads(row["payload"]), event_touched)
+                    cursor.execute("RELEASE webhook_event")
+                    cursor.execute('UPDATE paypal_webhook_events SET processed_at = ?, attempts = attempts + 1 WHERE event_id = ?', (time.time(), row["event_id"]))
+                    touched.extend(event_touched)
+                except Exception as e:
+                    # Only this event is rolled back; it is retried by a later batch up to WEBHOOK_MAX_ATTEMPTS
+                    cursor.execute("ROLLBACK TO webhook_event")
+                    cursor.execute("RELEASE webhook_event")
+                    cursor.execute('UPDATE paypal_webhook_events SET attempts = attempts + 1, last_error = ? WHERE event_id = ?', (str(e), row["event_id"]))
+                    log.error("webhook_event_failed", "Erreur lors du traitement de l'événement PayPal", event_id=row["event_id"], error=str(e))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+    for api_key, reset_quota in touched:
+        invalidate_cached_user(api_key)
+        if reset_quota:
+            quota_manager.reset(api_key)
+    return len(rows)
+
+
+_webhook_wakeup = None
+_webhook_worker_task = None
+
+def wake_webhook_worker():
+    if _webhook_wakeup is not None:
+        _webhook_wakeup.set()
+
+async def webhook_worker_loop():
+    while True:
+        try:
+            await asyncio.wait_for(_webhook_wakeup.wait(), timeout=WEBHOOK_POLL_INTERVAL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+        _webhook_wakeup.clear()
+        try:
+            # Drain the backlog (month-end renewals) batch by batch
+            while await asyncio.to_thread(process_webhook_batch) >= WEBHOOK_BATCH_SIZE:
+                pass
+        except Exception as e:
+            log.exception("webhook_worker_failed", "Erreur du worker de webhooks PayPal", error=str(e))
+
+def start_webhook_worker():
+    global _webhook_wakeup, _webhook_worker_task
+    _webhook_wakeup = asyncio.Event()
+    _webhook_worker_task = asyncio.create_task(webhook_worker_loop())
+
+
+def store_webhook_event(event_id, event_type, payload):
+    # Returns False when the event was already received
+    with db_connection() as db, metrics.stage("db_write"):
+        cursor = db.execute(
+            'INSERT OR IGNORE INTO paypal_webhook_events (event_id, event_type, payload, received_at) VALUES (?, ?, ?, ?)',
+            (event_id, event_type, payload, time.time())
+        )
+        db.commit()
+    return cursor.rowcount == 1
+
 
 @app.post("/webhooks/paypal")
-async def paypal_webhook(request: Request, db: sqlite3.Connection = Depends(get_db)):
-    # Pour une intégration robuste, VOUS DEVEZ VALIDER LE WEBHOOK.
-    # Cela implique d'utiliser l'API de validation des webhooks de PayPal
-    # en utilisant les en-têtes de la requête et le corps brut de la requête.
-    # Vous aurez besoin de votre Webhook ID configuré dans PayPal.
+async def paypal_webhook(request: Request):
+    # Le webhook est validé localement : CRC32 du corps brut + signature RSA du certificat PayPal (mis en cache),
+    # sans aller-retour vers l'API de vérification de PayPal pour chaque événement.
 
     webhook_id = PAYPAL_WEBHOOK_ID # Votre ID de webhook PayPal
     request_headers = dict(request.headers)
@@ -470,50 +3528,17 @@ async def paypal_webhook(request: Request, db: sqlite3.Connection = Depends(get_
 
     # Vérifiez si l'ID du Webhook PayPal est configuré
     if not webhook_id or webhook_id == "YOUR_PAYPAL_WEBHOOK_ID": # REMPLACEZ CECI
-         print("Attention: L'ID du Webhook PayPal n'est pas configuré. Validation du webhook ignorée.")
+         log.warning("webhook_not_verified", "L'ID du Webhook PayPal n'est pas configuré. Validation du webhook ignorée.")
          # Pour la production, vous devriez retourner une erreur 500 ou 400 ici si l'ID n'est pas configuré.
          # Pour les tests, nous pouvons continuer but soyez conscient que le webhook n'est PAS VALIDÉ.
-
-
-    # --------- Validation de webhook (nécessite la configuration du client) ---------
-    # Cette partie nécessite le client PayPal HttpClient, qui fait partie du SDK PayPal Checkout.
-    # Le code original utilisait paypalrestsdk, qui peut avoir une approche légèrement différente
-    # ou nécessiter l'installation du SDK checkout séparément.
-    # Pour l'instant, la validation est commentée car elle nécessite une configuration et potentiellement
-    # l'ajout d'un autre SDK (paypal-checkout-sdk) ou l'adaptation au SDK paypalrestsdk.
-    # Si vous activez la validation, assurez-vous d'avoir le bon SDK et la bonne configuration.
-
-    # from paypalcheckoutsdk.core import SandboxEnvironment, LiveEnvironment # Nécessite paypal-checkout-sdk
-    # from paypalcheckoutsdk.notifications.webhooks import VerificationApi # Nécessite paypal-checkout-sdk
-    # from paypalhttp import HttpHeaders # Nécessite paypal-checkout-sdk
-
-    # try:
-    #      # Assurez-vous d'avoir instancié le client PayPal HttpClient (voir commentaires plus haut)
-    #      # Si vous utilisez paypal-checkout-sdk:
-    #      # environment = SandboxEnvironment(PAYPAL_CLIENT_ID, PAYPAL_CLIENT_SECRET)
-    #      # client = paypalcheckoutsdk.core.PayPalHttpClient(environment) # Nécessite paypal-checkout-sdk
-    #      # signature_verification = VerificationApi(client)
-    #      # request_data = GenerateWebhookEventRequest()
-    #      # request_data.headers = HttpHeaders(request_headers)
-    #      # request_data.body = request_body.decode('utf-8') # Le corps doit être une chaîne
-    #      # request_data.auth_algorithm = request_headers.get("paypal-auth-algo")
-    #      # request_data.cert_url = request_headers.get("paypal-cert-url")
-    #      # request_data.transmission_id = request_headers.get("paypal-transmission-id")
-    #      # request_data.transmission_signature = request_headers.get("paypal-transmission-sig")
-    #      # request_data.transmission_time = request_headers.get("paypal-transmission-time")
-    #      # request_data.webhook_id = webhook_id
-
-    #      # response = signature_verification.verify_webhook_signature(request_data)
-    #      # if response.status_code != 200:
-    #      #     print("Validation de webhook échouée.")
-    #      #     raise HTTPException(status_code=400, detail="Signature de webhook invalide")
-    #      # else:
-    #      #     print("Validation de webhook réussie.")
-
-    # except Exception as e:
-    #      print(f"Erreur lors de la validation du webhook : {e}")
-    #      raise HTTPException(status_code=400, detail=f"Erreur de validation du webhook: {e}")
-    # ---------------------------------------------------------------------------------------
+    elif PAYPAL_WEBHOOK_VERIFY:
+        try:
+            await verify_paypal_webhook(request_headers, request_body, webhook_id)
+            webhook_signature_results["valid"] += 1
+        except WebhookSignatureError as e:
+            webhook_signature_results["invalid"] += 1
+            log.warning("webhook_signature_invalid", "Validation de webhook échouée", error=str(e), transmission_id=request_headers.get("paypal-transmission-id"))
+            raise HTTPException(status_code=400, detail="Signature de webhook invalide")
 
 
     try:
@@ -521,73 +3546,130 @@ async def paypal_webhook(request: Request, db: sqlite3.Connection = Depends(get_
         # Convertir le corps en JSON APRES validation
         event = json.loads(request_body.decode('utf-8'))
         event_type = event.get("event_type")
-        resource = event.get("resource", {})
-
-        print(f"Webhook PayPal reçu: Type = {event_type}")
-
-        # Exemple de gestion des événements d'abonnement
-        if event_type == "BILLING.SUBSCRIPTION.ACTIVATED":
-            subscription_id = resource.get("id")
-            # Le champ 'plan_id' est également disponible dans le resource si besoin
-            # plan_id = resource.get("plan_id")
-            # L'objet resource contient aussi les détails du 'subscriber' si nécessaire
-            # subscriber = resource.get("subscriber", {})
-
-            if subscription_id:
-                 cursor = db.cursor()
-                 # Rechercher l'utilisateur par l'ID d'abonnement PayPal stocké
-                 # Dans un système de production robuste, vous pourriez aussi utiliser un 'custom_id'
-                 # passé lors de la création de l'abonnement pour identifier l'utilisateur.
-                 cursor.execute('SELECT * FROM users WHERE paypal_subscription_id = ?', (subscription_id,))
-                 user = cursor.fetchone()
-                 if user:
-                      # Mettre à jour le statut de l'utilisateur dans votre BDD
-                      # Assurez-vous que le plan est correct (ici on suppose 'Premium' si activé)
-                      cursor.execute('UPDATE users SET subscription_status = ?, plan = ?, monthly_generations_count = ? WHERE api_key = ?', ('active', 'Premium', 0, user["api_key"]))
-                      db.commit()
-                      print(f"Statut d'abonnement mis à jour à 'active' pour l'utilisateur: {user['api_key']} (Abonnement PayPal ID: {subscription_id})")
-                 else:
-                      print(f"Webhook 'ACTIVATED' reçu pour l'abonnement {subscription_id}, but utilisateur non trouvé dans la BDD avec cet ID d'abonnement.")
-
-
-        elif event_type == "BILLING.SUBSCRIPTION.CANCELLED":
-             subscription_id = resource.get("id")
-             if subscription_id:
-                 cursor = db.cursor()
-                 cursor.execute('SELECT * FROM users WHERE paypal_subscription_id = ?', (subscription_id,))
-                 user = cursor.fetchone()
-                 if user:
-                      # Marquer l'abonnement comme inactif. Vous pourriez aussi définir une date de fin de période si PayPal la fournit.
-                      cursor.execute('UPDATE users SET subscription_status = ? WHERE api_key = ?', ('inactive', user["api_key"]))
-                      db.commit()
-                      print(f"Statut d'abonnement mis à jour à 'inactive' pour l'utilisateur: {user['api_key']} (Abonnement PayPal ID: {subscription_id})")
-                 else:
-                      print(f"Webhook 'CANCELLED' reçu pour l'abonnement {subscription_id}, but utilisateur non trouvé dans la BDD avec cet ID d'abonnement.")
-
-        # Ajoutez d'autres cas elif pour gérer d'autres types d'événements importants (ex: paiement échoué BILLING.SUBSCRIPTION.PAYMENT.FAILED, renouvellement réussi BILLING.SUBSCRIPTION.PAYMENT.APPROVED, etc.)
-        # elif event_type == "BILLING.SUBSCRIPTION.SUSPENDED":
-        #     # Gérer la suspension de l'abonnement
-        #     pass
-        # elif event_type == "BILLING.SUBSCRIPTION.EXPIRED":
-        #     # Gérer l'expiration de l'abonnement
-        #     pass
 
+        log.info("webhook_received", "Webhook PayPal reçu", event_type=event_type, event_id=event.get("id"))
+
+        # PayPal renvoie le même événement (même id) tant qu'il n'a pas reçu de 2xx :
+        # l'id rend l'ingestion idempotente. Le traitement est fait par le worker en arrière-plan.
+        event_id = event.get("id") or hashlib.sha256(request_body).hexdigest()
+        # In the threadpool: the INSERT can wait up to busy_timeout while the worker holds BEGIN IMMEDIATE
+        duplicate = not await asyncio.to_thread(store_webhook_event, event_id, event_type, request_body.decode('utf-8'))
+        if duplicate:
+            log.info("webhook_duplicate", "Webhook PayPal déjà reçu, ignoré.", event_id=event_id)
+        else:
+            wake_webhook_worker()
 
         # Toujours retourner une réponse 200 OK pour indiquer à PayPal que le webhook a été reçu et traité (même si l'utilisateur n'est pas trouvé, on a bien reçu le webhook)
-        return {"status": "success", "received_event_type": event_type}
+        return {"status": "success", "received_event_type": event_type, "duplicate": duplicate}
 
     except json.JSONDecodeError:
-         print("Erreur de décodage JSON du corps du webhook.")
+         log.warning("webhook_body_invalid", "Erreur de décodage JSON du corps du webhook.", body=request_body.decode("utf-8", "replace"))
          # Retourner une erreur pour indiquer à PayPal que la requête était mal formée
          raise HTTPException(status_code=400, detail="Corps de la requête non valide ou non-JSON")
     except Exception as e:
-        print(f"Erreur lors du traitement du webhook PayPal : {e}")
+        log.exception("webhook_failed", "Erreur lors du traitement du webhook PayPal", error=str(e))
         # Retourner 500 Internal Server Error si le traitement interne échoue
         raise HTTPException(status_code=500, detail=f"Erreur interne lors du traitement du webhook: {str(e)}")
 
 
+def _metric_family(lines, name, metric_type, help_text, samples):
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} {metric_type}")
+    lines.extend(f"{name}{_metric_labels(**labels) if labels else ''} {value}" for labels, value in samples)
+
+BREAKER_STATE_VALUES = {"closed": 0, "half_open": 1, "open": 2}
+
+def require_metrics_token(authorization: Optional[str] = Header(None)):
+    # Per-route and per-plan traffic is not public: only the scraper holding METRICS_TOKEN reads it
+    if not METRICS_TOKEN:
+        raise HTTPException(status_code=403, detail="Les métriques sont désactivées : METRICS_TOKEN n'est pas configuré.")
+    scheme, _, token = (authorization or "").partition(" ")
+    if scheme.lower() != "bearer" or not hmac.compare_digest(token.strip().encode("utf-8"), METRICS_TOKEN.encode("utf-8")):
+        raise HTTPException(status_code=401, detail="Jeton d'accès aux métriques manquant ou invalide.", headers={"WWW-Authenticate": "Bearer"})
+
+
+@app.get("/metrics", dependencies=[Depends(require_metrics_token)])
+def prometheus_metrics():
+    # Sync route: the webhook backlog query runs in the threadpool, never on the event loop
+    lines = metrics.render()
+    _metric_family(lines, "dropia_log_records_total", "counter", "Lignes de log écrites, abandonnées (file pleine) ou écartées par l'échantillonnage.",
+                   [({"result": result}, count) for result, count in log.stats().items() if result != "queued"])
+    _metric_family(lines, "dropia_startup_seconds", "gauge", "Durées du démarrage à froid de ce worker (import du module, puis étapes du lifespan).",
+                   [({"phase": phase}, round(seconds, 6)) for phase, seconds in startup_timings.items()])
+    if idempotency_middleware is not None:
+        _metric_family(lines, "dropia_idempotency_requests_total", "counter", "Requêtes avec Idempotency-Key : exécutées, rejouées, mises en attente d'un doublon en cours, ou refusées (409/422).",
+                       [({"outcome": outcome}, count) for outcome, count in idempotency_middleware.stats.items()])
+
+    caches = {"generation": generation_cache.stats(), "auth": auth_cache.stats(), "auth_negative": invalid_api_key_cache.stats()}
+    _metric_family(lines, "dropia_cache_entries", "gauge", "Entrées présentes dans chaque cache.", [({"cache": name}, stats["size"]) for name, stats in caches.items()])
+    for counter in ("hits", "misses", "evictions"):
+        _metric_family(lines, f"dropia_cache_{counter}_total", "counter", f"Compteur {counter} de chaque cache.", [({"cache": name}, stats[counter]) for name, stats in caches.items()])
+
+    if db_pool is not None:
+        pool_stats = db_pool.stats()
+        _metric_family(lines, "dropia_db_pool_connections", "gauge", "Connexions SQLite du pool, par état.",
+                       [({"state": state}, pool_stats[state]) for state in ("in_use", "idle", "overflow")])
+
+    flight = completion_single_flight.stats()
+    _metric_family(lines, "dropia_openai_in_flight", "gauge", "Appels OpenAI partagés en cours.", [({}, flight["in_flight"])])
+    for counter in ("upstream_calls", "coalesced", "abandoned"):
+        _metric_family(lines, f"dropia_openai_{counter}_total", "counter", f"Appels OpenAI ({counter}) du single-flight.", [({}, flight[counter])])
+
+    guards = {endpoint: guard.stats() for endpoint, guard in list(upstream_guards.items())}
+    for counter in ("attempts", "retries", "timeouts", "hedges", "hedge_wins"):
+        _metric_family(lines, f"dropia_openai_{counter}_total", "counter", f"Tentatives OpenAI ({counter}), par endpoint.", [({"endpoint": endpoint}, stats[counter]) for endpoint, stats in guards.items()])
+    _metric_family(lines, "dropia_openai_breaker_state", "gauge", "État du circuit OpenAI (0 fermé, 1 semi-ouvert, 2 ouvert).",
+                   [({"endpoint": endpoint}, BREAKER_STATE_VALUES[stats["breaker"]["state"]]) for endpoint, stats in guards.items()])
+    _metric_family(lines, "dropia_openai_breaker_rejected_total", "counter", "Appels refusés par le circuit ouvert.",
+                   [({"endpoint": endpoint}, stats["breaker"]["rejected"]) for endpoint, stats in guards.items()])
+
+    tokens = token_budgeter.stats()
+    _metric_family(lines, "dropia_openai_tokens_total", "counter", "Tokens OpenAI consommés (prompt, completion) et budget max_tokens accordé, par endpoint.",
+                   [({"endpoint": endpoint, "kind": kind}, stats[f"{kind}_tokens"]) for endpoint, stats in tokens.items() for kind in ("prompt", "completion", "budget")])
+    _metric_family(lines, "dropia_openai_completions_total", "counter", "Complétions OpenAI, par endpoint.", [({"endpoint": endpoint}, stats["requests"]) for endpoint, stats in tokens.items()])
+    _metric_family(lines, "dropia_openai_truncated_total", "counter", "Complétions coupées par max_tokens, par endpoint.", [({"endpoint": endpoint}, stats["truncated"]) for endpoint, stats in tokens.items()])
+
+    if paypal_client is not None:
+        _metric_family(lines, "dropia_paypal_token_refreshes_total", "counter", "Jetons OAuth PayPal obtenus par ce processus.", [({}, paypal_client.token_refreshes)])
+    _metric_family(lines, "dropia_webhook_signatures_total", "counter", "Signatures de webhooks PayPal vérifiées, par résultat.",
+                   [({"result": result}, count) for result, count in webhook_signature_results.items()])
+    _metric_family(lines, "dropia_paypal_cert_fetches_total", "counter", "Certificats PayPal téléchargés (hors cache).", [({}, paypal_cert_flight.leaders)])
+
+    admission = admission_controller.stats()
+    _metric_family(lines, "dropia_admission_requests", "gauge", "Requêtes IA admises en cours et en file d'attente (par worker).",
+                   [({"state": "in_flight"}, admission["in_flight"]), ({"state": "queued"}, admission["queued"])])
+    _metric_family(lines, "dropia_admission_shed_total", "counter", "Requêtes IA rejetées par la file d'attente (503).", [({}, admission["shed"])])
+    if rate_limiter is not None:
+        _metric_family(lines, "dropia_rate_limited_total", "counter", "Requêtes rejetées par la limite de débit par clé (429).", [({}, rate_limiter.stats()["rejected"])])
+
+    quota = quota_manager.stats()
+    _metric_family(lines, "dropia_quota_generations", "gauge", "Générations réservées ou en attente d'écriture dans ce processus.",
+                   [({"state": "reserved"}, quota["reserved"]), ({"state": "pending"}, quota["pending"])])
+
+    try:
+        with db_connection() as conn:
+            backlog = conn.execute('SELECT COUNT(*) FROM paypal_webhook_events WHERE processed_at IS NULL AND attempts < ?', (WEBHOOK_MAX_ATTEMPTS,)).fetchone()[0]
+        _metric_family(lines, "dropia_webhook_backlog", "gauge", "Webhooks PayPal reçus et pas encore appliqués.", [({}, backlog)])
+    except Exception as e:
+        log.error("webhook_backlog_unavailable", "Erreur lors de la lecture du backlog de webhooks", error=str(e))
+
+    return Response(content="\n".join(lines) + "\n", media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+startup_timings["import"] = time.perf_counter() - _import_started
+
+
 # Ajouter ce bloc pour exécuter l'application FastAPI avec uvicorn
 if __name__ == "__main__":
+    import uvicorn
+    try:
+        # Notebook (Colab/Jupyter) : une boucle d'événements tourne déjà, uvicorn.run doit pouvoir s'y imbriquer.
+        # En mode serveur (uvicorn dropia_api:app, Cloud Run), la boucle n'est jamais patchée.
+        asyncio.get_running_loop()
+        import nest_asyncio
+        nest_asyncio.apply()
+    except RuntimeError:
+        pass
     # Assurez-vous que l'application n'est pas déjà en cours d'exécution dans une autre cellule
     # car cela provoquerait une erreur (l'adresse est déjà utilisée)
     print("Démarrage de l'API FastAPI...")
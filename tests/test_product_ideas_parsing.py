@@ -0,0 +1,62 @@
+# Parsing of the model output for /generate-product (extract_product_ideas and the streaming parser)
+import json
+
+import pytest
+
+from dropia_api import IncrementalIdeaParser, extract_product_ideas, parse_product_ideas
+
+IDEAS = [{"nom_produit": "Tapis antidérapant", "idee_prix": "29,90 €"}, {"nom_produit": "Bloc en liège", "idee_prix": "14,90 €"}]
+ARRAY = json.dumps(IDEAS, ensure_ascii=False)
+
+
+def stream(text, chunk_size=7):
+    parser = IncrementalIdeaParser()
+    ideas = []
+    for i in range(0, len(text), chunk_size):
+        ideas += parser.feed(text[i:i + chunk_size])
+    return ideas, parser
+
+
+@pytest.mark.parametrize("text", [
+    ARRAY,
+    f"Voici les idées demandées :\n{ARRAY}\nBonne vente !",
+    f"```json\n{ARRAY}\n```",
+    f"Voici [2] idées :\n{ARRAY}",
+    f"Note {{important}}: {ARRAY}",
+    f'Note : {{"a": 1}} puis {ARRAY}',
+    f"Format [3, 4] puis {ARRAY}",
+])
+def test_complete_array_is_found_after_prose_and_decoys(text):
+    assert extract_product_ideas(text) == (IDEAS, None)
+    assert stream(text)[0] == IDEAS
+
+
+def test_single_object_is_salvaged():
+    text = '```json\n{"nom_produit": "Solo"}\n```'
+    assert extract_product_ideas(text) == ([{"nom_produit": "Solo"}], None)
+    assert stream(text)[0] == [{"nom_produit": "Solo"}]
+
+
+def test_truncated_array_keeps_complete_ideas_and_repairs_the_last_one():
+    text = 'Voici [2] idées : [{"nom_produit": "A", "idee_prix": "10 €"}, {"nom_produit": "B", "idee_prix": "12 €", "description_courte": "Un bloc tr'
+    ideas, repaired = extract_product_ideas(text)
+    assert ideas == [{"nom_produit": "A", "idee_prix": "10 €"}]
+    assert repaired == {"nom_produit": "B", "idee_prix": "12 €"}
+
+    streamed, parser = stream(text)
+    assert streamed == ideas
+    assert not parser.done
+    assert parser.repair_pending() == repaired
+
+
+def test_nothing_usable():
+    for text in ("Désolé, je ne peux pas répondre.", "[3]", 'Note : {"a": 1}'):
+        assert extract_product_ideas(text) == ([], None)
+        assert stream(text)[0] == []
+
+
+def test_parse_keeps_requested_fields_and_drops_invalid_ideas():
+    text = f'{ARRAY[:-1]}, {{"idee_prix": "sans nom"}}, {{"nom_produit": "C", "avantages_client": "un seul", "autre": 1}}]'
+    ideas = parse_product_ideas(text, ("nom_produit", "avantages_client"))
+    assert ideas == [{"nom_produit": "Tapis antidérapant"}, {"nom_produit": "Bloc en liège"}, {"nom_produit": "C", "avantages_client": ["un seul"]}]
+    assert parse_product_ideas("rien", ("nom_produit",)) == []